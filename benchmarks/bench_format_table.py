@@ -0,0 +1,63 @@
+"""Micro-benchmark de build_format_table con listas sintéticas de formatos.
+
+Simula lo que devuelve yt-dlp para manifiestos DASH/HLS grandes (directos, muchas
+variantes por resolución y códec) y mide el tiempo por llamada y por formato.
+
+Uso:
+    python benchmarks/bench_format_table.py [--sizes 50,500,5000] [--repeat 5]
+"""
+import argparse
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import build_format_table  # noqa: E402
+
+HEIGHTS = (144, 240, 360, 480, 720, 1080, 1440, 2160)
+VCODECS = ('avc1.64001F', 'vp09.00.40.08', 'av01.0.08M.08', 'avc1.4d401e')
+PROTOCOLS = ('https', 'm3u8_native', 'http_dash_segments')
+
+
+def synthetic_formats(n: int, seed: int = 0) -> list:
+    rng = random.Random(seed)
+    formats = []
+    for i in range(n):
+        if rng.random() < 0.2:
+            formats.append({
+                'format_id': f'a{i}', 'vcodec': 'none', 'acodec': rng.choice(('mp4a.40.2', 'opus')),
+                'ext': rng.choice(('m4a', 'webm')), 'tbr': rng.uniform(48, 256),
+                'filesize': rng.choice((None, rng.randint(1, 50) * 1024 ** 2)),
+                'protocol': rng.choice(PROTOCOLS),
+            })
+            continue
+        formats.append({
+            'format_id': f'v{i}', 'vcodec': rng.choice(VCODECS), 'acodec': rng.choice(('none', 'mp4a.40.2')),
+            'ext': 'mp4', 'height': rng.choice(HEIGHTS), 'tbr': rng.uniform(100, 20000),
+            'filesize': rng.choice((None, None, rng.randint(1, 900) * 1024 ** 2)),
+            'filesize_approx': rng.choice((None, rng.randint(1, 900) * 1024 ** 2)),
+            'protocol': rng.choice(PROTOCOLS),
+        })
+    return formats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='50,500,5000')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'formatos':>9} {'filas':>6} {'ms/llamada':>11} {'us/formato':>11}")
+    for n in (int(s) for s in args.sizes.split(',')):
+        formats = synthetic_formats(n)
+        videos, _ = build_format_table(formats, duration=3600)
+        number = max(1, 20000 // n)
+        best = min(timeit.repeat(lambda: build_format_table(formats, duration=3600),
+                                 number=number, repeat=args.repeat)) / number
+        print(f"{n:>9} {len(videos):>6} {best * 1e3:>11.3f} {best / n * 1e6:>11.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""Benchmark de arranque en frío: import de main.py, puerto abierto y readiness.
+
+Cada medición usa un proceso nuevo (como un contenedor que escala desde cero):
+  - import:  lo que tarda `import main` (el valor que también reporta /ready).
+  - puerto:  desde lanzar uvicorn hasta la primera respuesta HTTP.
+  - ready:   desde lanzar uvicorn hasta que /ready devuelve 200 (calentamiento terminado).
+
+Uso:
+    python benchmarks/bench_startup.py [--runs 5] [--no-warmup]
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT_SNIPPET = (
+    "import time; t = time.perf_counter(); import main; "
+    "print(time.perf_counter() - t)"
+)
+
+
+def measure_import() -> float:
+    out = subprocess.run([sys.executable, '-c', IMPORT_SNIPPET], cwd=ROOT, check=True,
+                         capture_output=True, text=True).stdout
+    return float(out.strip().splitlines()[-1])
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _status(url: str):
+    try:
+        with urllib.request.urlopen(url, timeout=1) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, None
+    except OSError:
+        return None, None
+
+
+def measure_server(warmup: bool, timeout: float = 60.0) -> dict:
+    port = _free_port()
+    env = {**os.environ, 'WARMUP': 'true' if warmup else 'false'}
+    started = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'main:app', '--host', '127.0.0.1', '--port', str(port),
+         '--log-level', 'warning'],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    result = {'port': None, 'ready': None, 'steps': {}}
+    try:
+        while time.perf_counter() - started < timeout:
+            status, body = _status(f'http://127.0.0.1:{port}/ready')
+            elapsed = time.perf_counter() - started
+            if status is not None and result['port'] is None:
+                result['port'] = elapsed
+            if status == 200:
+                result['ready'] = elapsed
+                result['steps'] = body.get('steps', {})
+                break
+            time.sleep(0.02)
+    finally:
+        proc.terminate()
+        proc.wait(timeout=10)
+    return result
+
+
+def _fmt(values) -> str:
+    values = [v for v in values if v is not None]
+    if not values:
+        return f"{'-':>9} {'-':>9}"
+    return f"{min(values) * 1e3:>9.0f} {statistics.median(values) * 1e3:>9.0f}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--no-warmup', action='store_true', help='arrancar con WARMUP=false')
+    args = parser.parse_args()
+
+    imports = [measure_import() for _ in range(args.runs)]
+    servers = [measure_server(not args.no_warmup) for _ in range(args.runs)]
+
+    print(f"{'fase':<8} {'min ms':>9} {'med ms':>9}")
+    print(f"{'import':<8} {_fmt(imports)}")
+    print(f"{'puerto':<8} {_fmt([s['port'] for s in servers])}")
+    print(f"{'ready':<8} {_fmt([s['ready'] for s in servers])}")
+    steps = servers[-1]['steps']
+    if steps:
+        print("pasos del calentamiento (última ejecución): "
+              + ", ".join(f"{name}={seconds * 1e3:.0f}ms" for name, seconds in steps.items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""Benchmark del pool de YoutubeDL: coste por petición con y sin reutilizar instancias.
+
+Sirve un MP4 sintético desde un servidor HTTP local y repite extract_info (extractor
+genérico) con las opciones de una estrategia de /analyze, incluido un cookie file con
+muchas cookies, de dos formas:
+  - nuevo: `with yt_dlp.YoutubeDL(opts)` en cada petición (lo que se hacía antes).
+  - pool:  `with ydl_pool.lease(opts)` (instancias reutilizadas, cookie jar compartido).
+
+Uso:
+    python benchmarks/bench_ydl_pool.py [--requests 50] [--cookies 300]
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import DEFAULT_HEADERS, YoutubeDLPool, yt_dlp  # noqa: E402
+
+PAYLOAD = b'\x00\x00\x00\x18ftypmp42' + os.urandom(64 * 1024)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_HEAD(self):
+        self._headers()
+
+    def do_GET(self):
+        self._headers()
+        self.wfile.write(PAYLOAD)
+
+    def _headers(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'video/mp4')
+        self.send_header('Content-Length', str(len(PAYLOAD)))
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        pass   # yt-dlp cierra conexiones keep-alive a medias al descartar una instancia
+
+
+def synthetic_cookiefile(path: str, n: int):
+    expires = int(time.time()) + 86400 * 365
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('# Netscape HTTP Cookie File\n\n')
+        for i in range(n):
+            f.write(f'.example{i % 20}.com\tTRUE\t/\tTRUE\t{expires}\tcookie{i}\t{"v" * 120}\n')
+
+
+def run(label: str, lease, url: str, requests: int) -> float:
+    # La primera petición de cada modo no cuenta (imports, primera conexión)
+    with lease() as ydl:
+        ydl.extract_info(url, download=False)
+    started = time.perf_counter()
+    for _ in range(requests):
+        with lease() as ydl:
+            ydl.extract_info(url, download=False)
+    per_request = (time.perf_counter() - started) / requests
+    print(f"{label:<6} {per_request * 1e3:>10.2f}")
+    return per_request
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=50)
+    parser.add_argument('--cookies', type=int, default=300)
+    args = parser.parse_args()
+
+    server = _Server(('127.0.0.1', 0), _Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_port}/video.mp4'
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        cookiefile = os.path.join(tmpdir, 'cookies.txt')
+        synthetic_cookiefile(cookiefile, args.cookies)
+        opts = {
+            'quiet': True, 'no_warnings': True, 'noplaylist': True, 'nocheckcertificate': True,
+            'socket_timeout': 30, 'ignoreerrors': True, 'check_formats': False,
+            'cookiefile': cookiefile, 'http_headers': DEFAULT_HEADERS,
+            'extractor_args': {'youtube': {'player_client': ['tv_embedded']}},
+        }
+        pool = YoutubeDLPool(max_idle=4, max_uses=10 ** 6)
+
+        print(f"{'modo':<6} {'ms/petición':>10}")
+        before = run('nuevo', lambda: yt_dlp.YoutubeDL(opts), url, args.requests)
+        after = run('pool', lambda: pool.lease(opts), url, args.requests)
+        print(f"ahorro por petición: {(before - after) * 1e3:.2f} ms ({before / after:.1f}x); pool: {pool.snapshot()}")
+    finally:
+        server.shutdown()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,588 @@
+"""Prueba de carga offline: orígenes locales, extractor simulado y escenarios concurrentes.
+
+Todo corre en este proceso y sin salir a Internet:
+  - origen falso: /page/<id> con un iframe a /embed/<id>, que a su vez lleva un .m3u8
+    en un <script> (el camino de VideoExtractor), y /watch/<id> sin nada que resolver.
+  - servidor de medios: MP4 progresivo (/media/<id>.mp4) y una lista HLS con segmentos
+    (/hls/<id>/index.m3u8), generada con FFmpeg si está disponible.
+  - extractor de yt-dlp simulado para /watch/<id>, con latencia y tasa de fallos por
+    estrategia (tv_embedded, ios, android, mweb, web, no_cookies). Los ids que empiezan
+    por "fail" fallan con todas.
+  - la app en uvicorn, en un hilo.
+
+Escenarios (--scenarios, separados por comas):
+  analyze         /analyze de videos distintos (extractor simulado, sin caché).
+  analyze-cached  /analyze del mismo video (caché de análisis).
+  analyze-page    /analyze de páginas: resolución iframe -> m3u8 y extractor genérico de HLS.
+  failing         /analyze de videos que fallan siempre (caché negativa y circuit breaker).
+  download        /analyze + /download-selected + /progress hasta 'ready' + /get-file (MP4).
+  download-hls    lo mismo con la lista HLS (descarga nativa por segmentos + FFmpeg).
+
+Por escenario informa throughput, latencias p50/p95/p99 por endpoint, pico de RSS, de
+hilos y de disco en DOWNLOAD_DIR (RSS e hilos son los del proceso entero: app, orígenes
+y cliente). El resultado se guarda en benchmarks/results/ y --compare muestra la
+diferencia con una ejecución anterior.
+
+Uso:
+    python benchmarks/loadtest.py [--scenarios analyze,download] [--concurrency 8] [--requests 40]
+        [--latency tv_embedded=0.2,no_cookies=0.05] [--fail tv_embedded=0.3] [--size-mb 4]
+        [--label antes] [--compare benchmarks/results/antes.json] [--verbose]
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import itertools
+import json
+import os
+import random
+import re
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+RESULTS_DIR = os.path.join(ROOT, 'benchmarks', 'results')
+SCENARIOS = ('analyze', 'analyze-cached', 'analyze-page', 'failing', 'download', 'download-hls')
+STRATEGY_NAMES = ('tv_embedded', 'ios', 'android', 'mweb', 'web', 'no_cookies')
+DONE_STATUSES = {'ready', 'error'}
+
+# Métricas que --compare contrasta, además del p95 de cada endpoint
+COMPARED = ('throughput', 'mb_per_s', 'rss_peak_mb', 'threads_peak', 'disk_peak_mb')
+
+
+# --- ORÍGENES LOCALES ---
+
+# Lista maestra con resolución y códecs: así el formato HLS entra en la tabla de videos
+MASTER_PLAYLIST = (
+    '#EXTM3U\n'
+    '#EXT-X-STREAM-INF:BANDWIDTH=800000,RESOLUTION=320x240,CODECS="avc1.42c00d,mp4a.40.2"\n'
+    'media.m3u8\n'
+)
+
+
+class Media:
+    """Contenido que sirven los orígenes: un MP4 progresivo y una lista HLS con sus segmentos."""
+
+    def __init__(self, size: int, ffmpeg: str, workdir: str):
+        self.mp4 = b'\x00\x00\x00\x18ftypmp42' + os.urandom(max(size - 16, 0))
+        self.playlist, self.segments = self._build_hls(ffmpeg, workdir)
+
+    @staticmethod
+    def _build_hls(ffmpeg: str, workdir: str):
+        hls_dir = os.path.join(workdir, 'hls')
+        os.makedirs(hls_dir, exist_ok=True)
+        cmd = [ffmpeg, '-hide_banner', '-loglevel', 'error', '-y',
+               '-f', 'lavfi', '-i', 'testsrc=duration=12:size=320x240:rate=25',
+               '-f', 'lavfi', '-i', 'sine=duration=12',
+               '-c:v', 'libx264', '-preset', 'ultrafast', '-c:a', 'aac', '-shortest',
+               '-f', 'hls', '-hls_time', '2', '-hls_segment_filename', os.path.join(hls_dir, 'seg%d.ts'),
+               os.path.join(hls_dir, 'index.m3u8')]
+        try:
+            subprocess.run(cmd, check=True, capture_output=True, timeout=60)
+            with open(os.path.join(hls_dir, 'index.m3u8'), encoding='utf-8') as f:
+                playlist = f.read()
+            segments = {}
+            for name in re.findall(r'^(seg\d+\.ts)$', playlist, re.MULTILINE):
+                with open(os.path.join(hls_dir, name), 'rb') as f:
+                    segments[name] = f.read()
+            if segments:
+                return playlist, segments
+        except (OSError, subprocess.SubprocessError):
+            pass
+        # Sin FFmpeg utilizable: segmentos de paquetes TS nulos. Bastan para analizar y para
+        # medir la descarga por segmentos, pero un FFmpeg real no sacará un archivo de ellos.
+        print('[WARN] No se pudo generar HLS con FFmpeg; se usan segmentos sintéticos')
+        packet = b'\x47\x1f\xff\x10' + b'\xff' * 184
+        segments = {f'seg{i}.ts': packet * 2000 for i in range(6)}
+        playlist = '#EXTM3U\n#EXT-X-VERSION:3\n#EXT-X-TARGETDURATION:2\n#EXT-X-MEDIA-SEQUENCE:0\n'
+        playlist += ''.join(f'#EXTINF:2.0,\n{name}\n' for name in segments) + '#EXT-X-ENDLIST\n'
+        return playlist, segments
+
+
+class _OriginHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_HEAD(self):
+        self._dispatch(head=True)
+
+    def do_GET(self):
+        self._dispatch(head=False)
+
+    def _dispatch(self, head: bool):
+        media = self.server.media
+        base = f'http://127.0.0.1:{self.server.server_port}'
+        path = self.path.split('?', 1)[0]
+        parts = path.strip('/').split('/')
+        if parts[0] == 'page' and len(parts) == 2:
+            body = f'<html><body><iframe width="640" src="{base}/embed/{parts[1]}"></iframe></body></html>'
+            return self._send(body.encode(), 'text/html', head)
+        if parts[0] == 'embed' and len(parts) == 2:
+            body = f'<html><script>var source = "{base}/hls/{parts[1]}/index.m3u8";</script></html>'
+            return self._send(body.encode(), 'text/html', head)
+        if parts[0] == 'watch' and len(parts) == 2:
+            return self._send(b'<html><body><video></video></body></html>', 'text/html', head)
+        if parts[0] == 'media' and len(parts) == 2:
+            return self._send(media.mp4, 'video/mp4', head, ranged=True)
+        if parts[0] == 'thumb' and len(parts) == 2:
+            return self._send(b'\xff\xd8\xff\xe0' + b'\x00' * 2048, 'image/jpeg', head)
+        if parts[0] == 'hls' and len(parts) == 3:
+            if parts[2] == 'index.m3u8':
+                return self._send(MASTER_PLAYLIST.encode(), 'application/vnd.apple.mpegurl', head)
+            if parts[2] == 'media.m3u8':
+                return self._send(media.playlist.encode(), 'application/vnd.apple.mpegurl', head)
+            if parts[2] in media.segments:
+                return self._send(media.segments[parts[2]], 'video/mp2t', head)
+        self._send(b'not found', 'text/plain', head, status=404)
+
+    def _send(self, body: bytes, content_type: str, head: bool, status: int = 200, ranged: bool = False):
+        start, end = 0, len(body) - 1
+        match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range') or '') if ranged else None
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2) or end), end)
+            status = 206
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(end - start + 1))
+        if ranged:
+            self.send_header('Accept-Ranges', 'bytes')
+        if status == 206:
+            self.send_header('Content-Range', f'bytes {start}-{end}/{len(body)}')
+        self.end_headers()
+        if not head:
+            self.wfile.write(body[start:end + 1])
+
+    def log_message(self, *args):
+        pass
+
+
+class _OriginServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, media: Media):
+        super().__init__(('127.0.0.1', 0), _OriginHandler)
+        self.media = media
+
+    def handle_error(self, request, client_address):
+        pass   # clientes que cortan la conexión a mitad de respuesta
+
+
+# --- EXTRACTOR SIMULADO ---
+
+def _parse_profile(text: str) -> dict:
+    """'tv_embedded=0.2,no_cookies=0.05' -> {'tv_embedded': 0.2, ...}; '0.1' vale para todas."""
+    profile = {}
+    for item in filter(None, (text or '').split(',')):
+        name, _, value = item.rpartition('=')
+        for strategy in ([name] if name else STRATEGY_NAMES):
+            if strategy not in STRATEGY_NAMES:
+                raise SystemExit(f'Estrategia desconocida: {strategy}')
+            profile[strategy] = float(value)
+    return profile
+
+
+def _strategy_of(params: dict) -> str:
+    """Nombre de la estrategia de /analyze (o de la descarga) a partir de las opciones de yt-dlp."""
+    clients = ((params.get('extractor_args') or {}).get('youtube') or {}).get('player_client')
+    if clients:
+        return clients[0]
+    return 'web' if params.get('cookiefile') else 'no_cookies'
+
+
+def install_fake_extractor(latency: dict, failures: dict, size: int):
+    """Registra delante de los de yt-dlp un extractor para /watch/<id> de los orígenes locales."""
+    import yt_dlp
+    from yt_dlp.extractor.common import InfoExtractor
+    from yt_dlp.utils import ExtractorError
+
+    class FakeOriginIE(InfoExtractor):
+        IE_NAME = 'loadtest'
+        _VALID_URL = r'https?://127\.0\.0\.1:\d+/watch/(?P<id>[\w-]+)'
+
+        def _real_extract(self, url):
+            video_id = self._match_id(url)
+            strategy = _strategy_of(self._downloader.params)
+            time.sleep(latency.get(strategy, 0.0))
+            if video_id.startswith('fail') or random.random() < failures.get(strategy, 0.0):
+                raise ExtractorError(f'[{strategy}] fallo inyectado por loadtest', expected=True)
+            base = url.split('/watch/', 1)[0]
+            return {
+                'id': video_id,
+                'title': f'Video de prueba {video_id}',
+                'duration': 60,
+                'thumbnail': f'{base}/thumb/{video_id}.jpg',
+                'formats': [{
+                    'format_id': '18', 'url': f'{base}/media/{video_id}.mp4', 'ext': 'mp4',
+                    'protocol': 'http', 'vcodec': 'avc1.42001E', 'acodec': 'mp4a.40.2',
+                    'width': 640, 'height': 360, 'fps': 25, 'filesize': size,
+                }],
+            }
+
+    original = yt_dlp.YoutubeDL.add_default_info_extractors
+
+    def add_default_info_extractors(self):
+        self.add_info_extractor(FakeOriginIE())
+        original(self)
+
+    yt_dlp.YoutubeDL.add_default_info_extractors = add_default_info_extractors
+
+
+# --- MEDICIÓN ---
+
+class Sampler:
+    """Muestrea RSS, hilos y disco usado en DOWNLOAD_DIR mientras dura un escenario."""
+
+    def __init__(self, download_dir: str, interval: float = 0.05):
+        self.download_dir = download_dir
+        self.interval = interval
+        self.rss_peak = self.threads_peak = self.disk_peak = self.disk_start = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def rss() -> int:
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError):
+            import resource
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def disk(self) -> int:
+        total = 0
+        for dirpath, _, filenames in os.walk(self.download_dir):
+            for name in filenames:
+                try:
+                    total += os.path.getsize(os.path.join(dirpath, name))
+                except OSError:
+                    pass
+        return total
+
+    def _sample(self):
+        self.rss_peak = max(self.rss_peak, self.rss())
+        self.threads_peak = max(self.threads_peak, threading.active_count())
+        self.disk_peak = max(self.disk_peak, self.disk())
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def __enter__(self):
+        self.disk_start = self.disk()
+        self._sample()
+        self._thread = threading.Thread(target=self._loop, name='loadtest-sampler', daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+
+
+class Recorder:
+    """Latencias por endpoint y resultado de cada operación del escenario."""
+
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}                # {endpoint: {estado HTTP: n}}
+        self.ops = self.failed_ops = self.bytes = 0
+
+    async def call(self, session, client: str, endpoint: str, method: str, url: str, **kwargs):
+        started = time.perf_counter()
+        try:
+            # Cada worker simula un cliente distinto (límites de equidad por IP del planificador)
+            async with session.request(method, url, headers={'X-Forwarded-For': client}, **kwargs) as response:
+                if endpoint == 'get-file':
+                    body = b''
+                    async for chunk in response.content.iter_chunked(256 * 1024):
+                        self.bytes += len(chunk)
+                else:
+                    body = await response.read()
+                status = response.status
+        except Exception:
+            status, body = None, b''
+        self.latencies.setdefault(endpoint, []).append(time.perf_counter() - started)
+        if status != 200:
+            errors = self.errors.setdefault(endpoint, {})
+            errors[str(status)] = errors.get(str(status), 0) + 1
+            return None
+        return json.loads(body) if body else {}
+
+    def summary(self, wall: float, sampler: Sampler) -> dict:
+        endpoints = {}
+        for endpoint, values in self.latencies.items():
+            endpoints[endpoint] = {
+                'count': len(values),
+                'errors': self.errors.get(endpoint, {}),
+                'p50_ms': _percentile(values, 50) * 1e3,
+                'p95_ms': _percentile(values, 95) * 1e3,
+                'p99_ms': _percentile(values, 99) * 1e3,
+            }
+        return {
+            'ops': self.ops,
+            'failed_ops': self.failed_ops,
+            'wall_s': wall,
+            'throughput': self.ops / wall if wall else 0.0,
+            'mb_per_s': self.bytes / 1024 ** 2 / wall if wall else 0.0,
+            'rss_peak_mb': sampler.rss_peak / 1024 ** 2,
+            'threads_peak': sampler.threads_peak,
+            'disk_peak_mb': (sampler.disk_peak - sampler.disk_start) / 1024 ** 2,
+            'endpoints': endpoints,
+        }
+
+
+def _percentile(values, pct: float) -> float:
+    if len(values) < 2:
+        return values[0] if values else 0.0
+    return statistics.quantiles(values, n=100, method='inclusive')[int(pct) - 1]
+
+
+# --- ESCENARIOS ---
+
+class LoadTest:
+    def __init__(self, app_url: str, origin_url: str, args):
+        self.app_url = app_url
+        self.origin_url = origin_url
+        self.args = args
+        self.run_id = f'{os.getpid()}{int(time.time()) % 100000}'
+        self._ids = itertools.count()
+
+    def video_id(self, prefix: str = 'v') -> str:
+        return f'{prefix}{self.run_id}x{next(self._ids)}'
+
+    async def analyze(self, session, rec: Recorder, client: str, url: str):
+        return await rec.call(session, client, 'analyze', 'GET', f'{self.app_url}/analyze', params={'url': url})
+
+    async def download(self, session, rec: Recorder, client: str, url: str) -> bool:
+        info = await self.analyze(session, rec, client, url)
+        if not info or not info.get('videos'):
+            return False
+        # Como la UI: se manda la URL que se analizó (currentUrl); el token va ligado a ella
+        params = {'url': info['original_url'], 'format_id': info['videos'][0]['format_id']}
+        if info.get('token'):
+            params['token'] = info['token']
+        submitted = await rec.call(session, client, 'download-selected', 'GET',
+                                   f'{self.app_url}/download-selected', params=params)
+        if not submitted:
+            return False
+        file_id = submitted['file_id']
+        deadline = time.monotonic() + self.args.timeout
+        while time.monotonic() < deadline:
+            progress = await rec.call(session, client, 'progress', 'GET', f'{self.app_url}/progress/{file_id}')
+            if progress and progress.get('status') in DONE_STATUSES:
+                if progress['status'] != 'ready':
+                    return False
+                got = await rec.call(session, client, 'get-file', 'GET', f'{self.app_url}/get-file/{file_id}')
+                return got is not None
+            await asyncio.sleep(self.args.poll)
+        return False
+
+    def target(self, scenario: str, cached_url: str) -> str:
+        if scenario == 'analyze-cached':
+            return cached_url
+        if scenario == 'failing':
+            return f'{self.origin_url}/watch/{self.video_id("fail")}'
+        if scenario in ('analyze-page', 'download-hls'):
+            return f'{self.origin_url}/page/{self.video_id()}'
+        return f'{self.origin_url}/watch/{self.video_id()}'
+
+    async def run(self, scenario: str, download_dir: str) -> dict:
+        import aiohttp
+
+        timeout = aiohttp.ClientTimeout(total=self.args.timeout)
+        connector = aiohttp.TCPConnector(limit=self.args.concurrency * 2)
+        async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+            cached_url = f'{self.origin_url}/watch/{self.video_id()}'
+            if scenario == 'analyze-cached':
+                await self.analyze(session, Recorder(), '10.0.0.1', cached_url)   # llena la caché
+            op = self.download if scenario.startswith('download') else self.analyze
+            rec = Recorder()
+            pending = iter(range(self.args.requests))
+
+            async def worker(n: int):
+                client = f'10.0.{n // 250}.{n % 250 + 1}'
+                for _ in pending:
+                    ok = await op(session, rec, client, self.target(scenario, cached_url))
+                    rec.ops += 1
+                    rec.failed_ops += 0 if ok else 1
+
+            with Sampler(download_dir) as sampler:
+                started = time.perf_counter()
+                await asyncio.gather(*(worker(n) for n in range(self.args.concurrency)))
+                wall = time.perf_counter() - started
+        return rec.summary(wall, sampler)
+
+
+def reset_source_state(main):
+    """Breaker, caché negativa, planificador y perfiles del resolver nuevos: un escenario no
+    hereda lo que la app aprendió del origen (127.0.0.1) en el anterior."""
+    main.resolution_cache = main.ResolutionCache(
+        ttl=main.RESOLVE_CACHE_TTL, media_ttl=main.RESOLVE_CACHE_MEDIA_TTL,
+        max_entries=main.RESOLVE_CACHE_MAX_ENTRIES, profile_ttl=main.RESOLVE_PROFILE_TTL,
+    )
+    main.negative_cache = main.NegativeCache(main.NEGATIVE_TTLS, main.NEGATIVE_CACHE_MAX_ENTRIES)
+    main.domain_breaker = main.DomainBreaker(main.BREAKER_FAILURES, main.BREAKER_OPEN_SECONDS,
+                                             main.BREAKER_OPEN_MAX, main.BREAKER_PROBE_TIMEOUT)
+    main.strategy_scheduler = main.StrategyScheduler(
+        window=main.STRATEGY_WINDOW, probe_interval=main.STRATEGY_PROBE_INTERVAL,
+        backoff_base=main.STRATEGY_BACKOFF_BASE, backoff_max=main.STRATEGY_BACKOFF_MAX,
+    )
+
+
+# --- ARRANQUE E INFORME ---
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_app(main, timeout: float = 60.0) -> tuple:
+    import urllib.error
+    import urllib.request
+    import uvicorn
+
+    port = _free_port()
+    server = uvicorn.Server(uvicorn.Config(main.app, host='127.0.0.1', port=port, log_level='warning'))
+    thread = threading.Thread(target=server.run, name='loadtest-uvicorn', daemon=True)
+    thread.start()
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(f'http://127.0.0.1:{port}/ready', timeout=1):
+                return server, thread, f'http://127.0.0.1:{port}'
+        except (urllib.error.URLError, OSError):
+            time.sleep(0.05)
+    raise SystemExit('La app no llegó a estar lista')
+
+
+def _git_revision() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return ''
+
+
+def print_report(results: dict, previous: dict = None):
+    print(f"\n{'escenario':<15} {'ops':>5} {'fallos':>6} {'ops/s':>8} {'MB/s':>7} "
+          f"{'RSS MB':>7} {'hilos':>5} {'disco MB':>8}")
+    for name, r in results.items():
+        print(f"{name:<15} {r['ops']:>5} {r['failed_ops']:>6} {r['throughput']:>8.2f} {r['mb_per_s']:>7.2f} "
+              f"{r['rss_peak_mb']:>7.1f} {r['threads_peak']:>5} {r['disk_peak_mb']:>8.1f}")
+        for endpoint, e in r['endpoints'].items():
+            errors = ' '.join(f'{status}x{n}' for status, n in e['errors'].items()) or '-'
+            print(f"  {endpoint:<18} n={e['count']:<5} p50={e['p50_ms']:>8.1f}ms p95={e['p95_ms']:>8.1f}ms "
+                  f"p99={e['p99_ms']:>8.1f}ms  errores: {errors}")
+    if not previous:
+        return
+    print(f"\ncomparado con {previous.get('label')} ({previous.get('revision') or '?'}, {previous.get('created_at')}):")
+    for name, r in results.items():
+        before = previous.get('scenarios', {}).get(name)
+        if not before:
+            continue
+        deltas = [_delta(metric, before.get(metric), r.get(metric)) for metric in COMPARED]
+        for endpoint, e in r['endpoints'].items():
+            old = before.get('endpoints', {}).get(endpoint)
+            if old:
+                deltas.append(_delta(f'{endpoint}.p95_ms', old['p95_ms'], e['p95_ms']))
+        print(f"  {name:<15} " + ', '.join(d for d in deltas if d))
+
+
+def _delta(metric: str, before, after) -> str:
+    if before is None or after is None or before == after == 0:
+        return ''
+    if not before:
+        return f'{metric} {before:.4g}->{after:.4g}'
+    return f'{metric} {(after - before) / before * 100:+.0f}%'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=40, help='operaciones por escenario')
+    parser.add_argument('--latency', default='0.05', help='latencia (s) del extractor por estrategia')
+    parser.add_argument('--fail', default='', help='probabilidad de fallo del extractor por estrategia')
+    parser.add_argument('--size-mb', type=float, default=4.0, help='tamaño del MP4 progresivo')
+    parser.add_argument('--timeout', type=float, default=120.0, help='límite por operación (s)')
+    parser.add_argument('--poll', type=float, default=0.1, help='intervalo de sondeo de /progress (s)')
+    parser.add_argument('--label', default='', help='nombre del archivo de resultados')
+    parser.add_argument('--compare', help='resultados anteriores (JSON) con los que comparar')
+    parser.add_argument('--verbose', action='store_true', help='mostrar el log de la app')
+    args = parser.parse_args()
+
+    scenarios = [s.strip() for s in args.scenarios.split(',') if s.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        raise SystemExit(f"Escenarios desconocidos: {', '.join(sorted(unknown))}")
+    latency, failures = _parse_profile(args.latency), _parse_profile(args.fail)
+    previous = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            previous = json.load(f)
+
+    # Los clientes simulados se distinguen por X-Forwarded-For desde 127.0.0.1
+    os.environ.setdefault('TRUSTED_PROXIES', '127.0.0.1')
+    import main as app_main
+
+    workdir = tempfile.mkdtemp(prefix='loadtest-')
+    try:
+        # Copia de las cookies: el pool de YoutubeDL las guarda al cerrar instancias
+        if app_main.YOUTUBE_COOKIES_FILE:
+            cookies = os.path.join(workdir, 'cookies.txt')
+            shutil.copyfile(app_main.YOUTUBE_COOKIES_FILE, cookies)
+            app_main.YOUTUBE_COOKIES_FILE = cookies
+        size = int(args.size_mb * 1024 ** 2)
+        origin = _OriginServer(Media(size, app_main.FFMPEG_BIN, workdir))
+        threading.Thread(target=origin.serve_forever, name='loadtest-origin', daemon=True).start()
+        origin_url = f'http://127.0.0.1:{origin.server_port}'
+        install_fake_extractor(latency, failures, size)
+
+        results = {}
+        with contextlib.ExitStack() as log:
+            if not args.verbose:
+                log.enter_context(contextlib.redirect_stdout(io.StringIO()))
+                log.enter_context(contextlib.redirect_stderr(io.StringIO()))
+            server, thread, app_url = start_app(app_main)
+            test = LoadTest(app_url, origin_url, args)
+            for scenario in scenarios:
+                reset_source_state(app_main)
+                results[scenario] = asyncio.run(test.run(scenario, str(app_main.DOWNLOAD_DIR)))
+                print(f'[INFO] loadtest: escenario {scenario} terminado', file=sys.__stderr__)
+            server.should_exit = True
+            thread.join(timeout=10)
+            origin.shutdown()
+
+        created_at = datetime.now().isoformat(timespec='seconds')
+        label = args.label or datetime.now().strftime('%Y%m%d-%H%M%S')
+        report = {
+            'label': label,
+            'created_at': created_at,
+            'revision': _git_revision(),
+            'config': {k: v for k, v in vars(args).items() if k not in ('compare', 'verbose')},
+            'scenarios': results,
+        }
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        path = os.path.join(RESULTS_DIR, f'{label}.json')
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print_report(results, previous)
+        print(f'\nresultados guardados en {os.path.relpath(path, ROOT)}')
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
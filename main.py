@@ -1,21 +1,72 @@
 import os
+import time
+_MODULE_LOAD_STARTED = time.perf_counter()
+import codecs
 import socket
 import shutil
 import uuid
+import hashlib
+import copy
 import re
+import io
+import json
+import asyncio
+import random
+import sqlite3
+import subprocess
 import threading
-import requests
+import importlib
+import ipaddress
+import queue
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import asynccontextmanager, contextmanager
+from collections import OrderedDict, deque
 from pathlib import Path
 from typing import List, Optional, Tuple
+from urllib.parse import urlparse, parse_qsl, urlencode, urlunparse, urljoin, quote
 from fastapi import FastAPI, Request, BackgroundTasks, HTTPException
-from fastapi.responses import FileResponse, HTMLResponse, JSONResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import (FileResponse, HTMLResponse, JSONResponse, PlainTextResponse, RedirectResponse, Response,
+                               StreamingResponse)
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
-import yt_dlp
+from starlette.background import BackgroundTask
 import tempfile
 
-app = FastAPI()
+
+class _LazyModule:
+    """Importa el módulo en el primer acceso a uno de sus atributos.
+
+    yt_dlp y aiohttp no hacen falta para abrir el puerto; cargarlos al importar main.py
+    alarga cada arranque en frío (el calentamiento los carga después en segundo plano).
+    """
+
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+yt_dlp = _LazyModule('yt_dlp')
+aiohttp = _LazyModule('aiohttp')
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Arranca los servicios en segundo plano al iniciar la app."""
+    global _app_loop
+    _app_loop = asyncio.get_running_loop()
+    start_background_services()
+    yield
+    await close_http_session()
+
+
+app = FastAPI(lifespan=lifespan)
 
 # Directorios
 BASE_DIR = Path(__file__).resolve().parent
@@ -54,6 +105,149 @@ else:
     else:
         print("[WARN] Sin cookies - YouTube puede bloquear en IPs de servidor.")
 
+# Runtime de JavaScript para los retos EJS de YouTube (paquete yt-dlp-ejs). yt-dlp lo llama
+# 'node' (con 'nodejs' avisa de que no lo reconoce y lo ignora).
+YTDLP_JS_RUNTIME = os.environ.get('YTDLP_JS_RUNTIME', 'node')
+
+# --- MÉTRICAS (formato de exposición de Prometheus) ---
+# Registro mínimo sin dependencias: contadores, gauges e histogramas con etiquetas.
+# METRICS_LOG_SPANS=true además imprime cada span como una línea JSON para los logs.
+METRICS_LOG_SPANS = os.environ.get('METRICS_LOG_SPANS', 'false').lower() == 'true'
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+THROUGHPUT_BUCKETS = tuple(2 ** p * 1024 for p in range(6, 17, 2))  # 64 KB/s .. 64 MB/s
+
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = labelnames
+        self._values = {}  # {tupla de valores de etiquetas: valor}
+        self._lock = threading.Lock()
+        metrics_registry.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def _fmt_labels(self, key: tuple, extra: str = '') -> str:
+        parts = [f'{n}="{v}"' for n, v in zip(self.labelnames, key)]
+        if extra:
+            parts.append(extra)
+        return '{' + ','.join(parts) + '}' if parts else ''
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            lines.append(f"{self.name}{self._fmt_labels(key)} {value}")
+        return lines
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """Gauge cuyo valor se calcula al hacer scrape con `collect()` -> número o {tupla etiquetas: número}."""
+    kind = 'gauge'
+
+    def __init__(self, name: str, help_text: str, collect, labelnames: Tuple[str, ...] = ()):
+        super().__init__(name, help_text, labelnames)
+        self.collect = collect
+
+    def render(self) -> List[str]:
+        try:
+            value = self.collect()
+        except Exception:
+            value = None
+        with self._lock:
+            self._values = dict(value) if isinstance(value, dict) else ({(): value} if value is not None else {})
+        return super().render()
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...] = (), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # [cuentas por bucket..., total de observaciones, suma]
+                state = self._values[key] = [0] * len(self.buckets) + [0, 0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[i] += 1
+            state[-2] += 1
+            state[-1] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = [(key, list(state)) for key, state in self._values.items()]
+        for key, state in items:
+            for bound, n in zip(self.buckets + ('+Inf',), state[:-2] + [state[-2]]):
+                le = 'le="%s"' % bound
+                lines.append(f"{self.name}_bucket{self._fmt_labels(key, le)} {n}")
+            lines.append(f"{self.name}_sum{self._fmt_labels(key)} {round(state[-1], 6)}")
+            lines.append(f"{self.name}_count{self._fmt_labels(key)} {state[-2]}")
+        return lines
+
+
+metrics_registry = []
+
+
+def observe_span(histogram: Histogram, seconds: float, **labels):
+    """Registra la duración de una fase en su histograma y, opcionalmente, como log estructurado."""
+    histogram.observe(seconds, **labels)
+    if METRICS_LOG_SPANS:
+        print("[SPAN] " + json.dumps({'span': histogram.name, 'seconds': round(seconds, 4), **labels}))
+
+
+RESOLVE_FETCH_SECONDS = Histogram(
+    'sygnal_resolve_fetch_seconds', 'Petición HTTP de aggressive_resolve', ('status',))
+RESOLVE_SCANNED_BYTES = Counter(
+    'sygnal_resolve_scanned_bytes_total', 'Bytes de HTML leídos por el escáner de aggressive_resolve')
+RESOLVE_OUTCOMES = Counter(
+    'sygnal_resolve_total', 'Resultados de aggressive_resolve (skipped = dominio directo, sin petición)', ('outcome',))
+ANALYZE_SECONDS = Histogram(
+    'sygnal_analyze_seconds', 'Duración total de /analyze', ('cache', 'outcome'))
+ANALYZE_ATTEMPT_SECONDS = Histogram(
+    'sygnal_analyze_attempt_seconds', 'Duración de cada intento de estrategia en /analyze',
+    ('extractor', 'strategy', 'outcome'))
+QUEUE_WAIT_SECONDS = Histogram(
+    'sygnal_queue_wait_seconds', 'Tiempo de espera en la cola de descargas', ('lane',))
+DOWNLOAD_THROUGHPUT = Histogram(
+    'sygnal_download_throughput_bytes_per_second', 'Velocidad media de cada stream descargado por yt-dlp',
+    ('extractor',), buckets=THROUGHPUT_BUCKETS)
+DOWNLOAD_BYTES = Counter(
+    'sygnal_download_bytes_total', 'Bytes descargados de origen', ('extractor',))
+POSTPROCESS_SECONDS = Histogram(
+    'sygnal_postprocess_seconds', 'Duración de los postprocesadores de yt-dlp (merge/transcodificación FFmpeg)',
+    ('postprocessor',))
+DOWNLOAD_JOBS = Counter(
+    'sygnal_download_jobs_total', 'Trabajos de descarga terminados', ('outcome',))
+FAST_FAILS = Counter(
+    'sygnal_fast_fail_total', 'Peticiones rechazadas sin intentar (caché negativa o circuit breaker abierto)',
+    ('reason',))
+SERVED_BYTES = Counter(
+    'sygnal_served_bytes_total', 'Bytes entregados por get_file y los ZIP de /batch/download', ('mode',))
+
+# --- FIN MÉTRICAS ---
+
+
 # --- CONFIGURACIÓN DE VIDEO EXTRACTOR ---
 
 # Headers para emulación de navegador Chrome
@@ -70,560 +264,4320 @@ DEFAULT_HEADERS = {
     # 'Referer' se añadirá dinámicamente según la URL
 }
 
+# Cliente HTTP compartido para la resolución de páginas: pool de conexiones con keep-alive,
+# límite por host y caché de DNS. Se crea en el event loop de la app y se cierra al apagarla.
+# (aiohttp habla HTTP/1.1; las conexiones persistentes cubren el coste del handshake TLS.)
+RESOLVER_MAX_CONNECTIONS = int(os.environ.get('RESOLVER_MAX_CONNECTIONS', 100))
+RESOLVER_MAX_PER_HOST = int(os.environ.get('RESOLVER_MAX_PER_HOST', 8))
+RESOLVER_DNS_TTL = int(os.environ.get('RESOLVER_DNS_TTL', 300))
+RESOLVER_KEEPALIVE = float(os.environ.get('RESOLVER_KEEPALIVE', 30))
+RESOLVER_TIMEOUT = float(os.environ.get('RESOLVER_TIMEOUT', 10))
+
+_http_session = None
+# Event loop de la app (lo fija lifespan): los workers de descarga le envían corrutinas que
+# usan el cliente compartido con asyncio.run_coroutine_threadsafe
+_app_loop = None
+
+
+async def get_http_session() -> 'aiohttp.ClientSession':
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=RESOLVER_MAX_CONNECTIONS,
+            limit_per_host=RESOLVER_MAX_PER_HOST,
+            ttl_dns_cache=RESOLVER_DNS_TTL,
+            keepalive_timeout=RESOLVER_KEEPALIVE,
+        )
+        _http_session = aiohttp.ClientSession(
+            connector=connector,
+            headers=DEFAULT_HEADERS,
+            timeout=aiohttp.ClientTimeout(total=RESOLVER_TIMEOUT),
+        )
+    return _http_session
+
+
+async def close_http_session():
+    global _http_session
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+    _http_session = None
+
+
+# --- RESOLUCIÓN MULTI-SALTO CON CACHÉ Y PERFILES POR DOMINIO ---
+# aggressive_resolve sigue iframes de reproductores embebidos hasta RESOLVE_MAX_DEPTH saltos
+# (con detección de ciclos) y recuerda, por página, la URL final y, por dominio, qué suele
+# dar: 'iframe' (hay que saltar al reproductor), 'm3u8' (manifiesto directo en el HTML) o
+# 'direct' (pasar la URL tal cual a yt-dlp). Los dominios 'direct' se saltan la petición HTML.
+RESOLVE_MAX_DEPTH = int(os.environ.get('RESOLVE_MAX_DEPTH', 3))
+RESOLVE_CACHE_TTL = int(os.environ.get('RESOLVE_CACHE_TTL', 1800))          # página -> iframe / sin resultado
+RESOLVE_CACHE_MEDIA_TTL = int(os.environ.get('RESOLVE_CACHE_MEDIA_TTL', 300))  # página -> .m3u8 (suelen ir firmados)
+RESOLVE_CACHE_MAX_ENTRIES = int(os.environ.get('RESOLVE_CACHE_MAX_ENTRIES', 4096))
+RESOLVE_PROFILE_TTL = int(os.environ.get('RESOLVE_PROFILE_TTL', 6 * 3600))
+RESOLVE_PROFILE_CONFIRMATIONS = 3  # páginas seguidas sin nada que resolver antes de marcar un dominio 'direct'
+RESOLVE_PROFILE_PROBE_INTERVAL = 10  # un dominio 'direct' aprendido se vuelve a comprobar cada N peticiones
+
+# Sitios con extractor propio en yt-dlp: su HTML no aporta nada, se pasan directamente
+RESOLVE_DIRECT_DOMAINS = tuple(d.strip().lower() for d in os.environ.get(
+    'RESOLVE_DIRECT_DOMAINS',
+    'youtube.com,youtu.be,youtube-nocookie.com,vimeo.com,dailymotion.com,dai.ly,ok.ru,'
+    'tiktok.com,instagram.com,facebook.com,fb.watch,twitter.com,x.com,twitch.tv,soundcloud.com,'
+    'bilibili.com,reddit.com,streamable.com'
+).split(',') if d.strip())
+
+# Escaneo de páginas en streaming: se lee por trozos, se busca con un único patrón sobre una
+# ventana deslizante y se deja de descargar en cuanto aparece un reproductor conocido.
+RESOLVE_MAX_PAGE_BYTES = int(os.environ.get('RESOLVE_MAX_PAGE_BYTES', 2 * 1024 * 1024))
+RESOLVE_CHUNK_SIZE = 64 * 1024
+RESOLVE_SCAN_OVERLAP = 4096  # caracteres que se conservan entre ventanas para no partir coincidencias
+
+# Un solo patrón precompilado; el grupo que coincide indica el tipo:
+#   player: iframe de un reproductor conocido (el src es la fuente real del video)
+#   embed:  iframe de reproductor genérico (sólo se sigue, nunca se devuelve si no lleva a nada)
+#   m3u8:   URL que termina en .m3u8 dentro de comillas o JSON (también con barras escapadas)
+_PAGE_SCAN_RE = re.compile(
+    r'<iframe[^>]+src=["\']'
+    r'(?:(?P<player>http[s]?://(?:www\.)?(?:youtube\.com|player\.vimeo\.com|dailymotion\.com|ok\.ru|sb\w+\.com)[^"\']+)'
+    r'|(?P<embed>(?:https?:)?//[^"\']*(?:/embed|/e/|/v/|player)[^"\']*))["\']'
+    r'|["\'](?P<m3u8>http[s]?:\\?/\\?/[^"\']+\.m3u8(?:[^"\']*)?)["\']',
+    re.IGNORECASE
+)
+
+
+def resolver_domain(url: str) -> str:
+    host = (urlparse(url).hostname or '').lower()
+    return host[4:] if host.startswith('www.') else host
+
+
+def _is_direct_domain(domain: str) -> bool:
+    return any(domain == d or domain.endswith('.' + d) for d in RESOLVE_DIRECT_DOMAINS)
+
+
+class ResolutionCache:
+    """Página -> URL final (LRU con TTL) y perfil aprendido de cada dominio."""
+
+    def __init__(self, ttl: int, media_ttl: int, max_entries: int, profile_ttl: int):
+        self.ttl = ttl
+        self.media_ttl = media_ttl
+        self.max_entries = max_entries
+        self.profile_ttl = profile_ttl
+        self._pages = OrderedDict()  # {url canónica: (expires_at, url final, kind)}
+        self._profiles = {}          # {dominio: {'kind', 'streak', 'updated'}}
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'skipped': 0, 'evictions': 0}
+
+    def get(self, key: str) -> Optional[Tuple[str, str]]:
+        now = time.time()
+        with self._lock:
+            entry = self._pages.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._pages.move_to_end(key)
+                    self.stats['hits'] += 1
+                    return entry[1], entry[2]
+                del self._pages[key]
+            self.stats['misses'] += 1
+            return None
+
+    def set(self, key: str, final_url: str, kind: str):
+        ttl = self.media_ttl if kind == 'm3u8' else self.ttl
+        with self._lock:
+            self._pages.pop(key, None)
+            self._pages[key] = (time.time() + ttl, final_url, kind)
+            while len(self._pages) > self.max_entries:
+                self._pages.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def profile(self, domain: str) -> Optional[str]:
+        """'direct' sólo cuando está confirmado (lista estática o varias páginas seguidas sin nada)."""
+        if _is_direct_domain(domain):
+            return 'direct'
+        with self._lock:
+            profile = self._profiles.get(domain)
+            if profile is None or time.time() - profile['updated'] > self.profile_ttl:
+                return None
+            if profile['kind'] == 'direct' and profile['streak'] < RESOLVE_PROFILE_CONFIRMATIONS:
+                return None
+            return profile['kind']
+
+    def should_skip_fetch(self, domain: str) -> bool:
+        if _is_direct_domain(domain):
+            with self._lock:
+                self.stats['skipped'] += 1
+            return True
+        if self.profile(domain) != 'direct':
+            return False
+        with self._lock:
+            profile = self._profiles[domain]
+            profile['skips'] = profile.get('skips', 0) + 1
+            if profile['skips'] % RESOLVE_PROFILE_PROBE_INTERVAL == 0:
+                return False  # sondeo: quizá el sitio ahora sí embebe un reproductor
+            self.stats['skipped'] += 1
+            return True
+
+    def record(self, domain: str, kind: str):
+        with self._lock:
+            profile = self._profiles.get(domain)
+            if profile is None or profile['kind'] != kind:
+                profile = self._profiles[domain] = {'kind': kind, 'streak': 0}
+            profile['streak'] += 1
+            profile['updated'] = time.time()
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                **self.stats,
+                'entries': len(self._pages),
+                'max_entries': self.max_entries,
+                'max_depth': RESOLVE_MAX_DEPTH,
+                'profiles': {d: {'kind': p['kind'], 'streak': p['streak']} for d, p in self._profiles.items()},
+                'direct_domains': list(RESOLVE_DIRECT_DOMAINS),
+            }
+
+
+resolution_cache = ResolutionCache(
+    ttl=RESOLVE_CACHE_TTL,
+    media_ttl=RESOLVE_CACHE_MEDIA_TTL,
+    max_entries=RESOLVE_CACHE_MAX_ENTRIES,
+    profile_ttl=RESOLVE_PROFILE_TTL,
+)
+
+
 class VideoExtractor:
     def __init__(self, url: str):
         self.original_url = url
-        self.session = requests.Session()
-        self.session.headers.update(DEFAULT_HEADERS)
-        self.session.headers.update({'Referer': self.get_base_url(url)})
+        self.headers = {'Referer': self.get_base_url(url)}
 
     def get_base_url(self, url):
-        from urllib.parse import urlparse
         parsed = urlparse(url)
         return f"{parsed.scheme}://{parsed.netloc}"
 
-    def resolve_iframe(self, html_content: str) -> Optional[str]:
-        """Busca iframes de video y devuelve el src si es relevante."""
-        # Regex para buscar iframes comunes de video
-        iframe_pattern = re.compile(
-            r'<iframe[^>]+src=["\'](http[s]?://(?:www\.)?(?:youtube\.com|player\.vimeo\.com|dailymotion\.com|ok\.ru|sb\w+\.com)[^"\']+)["\']',
-            re.IGNORECASE
-        )
-        match = iframe_pattern.search(html_content)
-        if match:
-            return match.group(1)
-        return None
+    async def scan_page(self, url: Optional[str] = None, referer: Optional[str] = None,
+                        stop_on_m3u8: bool = False) -> dict:
+        """Descarga la página por trozos y devuelve la primera coincidencia de cada tipo."""
+        url = url or self.original_url
+        headers = {'Referer': referer} if referer else self.headers
+        session = await get_http_session()
+        started = time.monotonic()
+        async with session.get(url, headers=headers, allow_redirects=True) as response:
+            observe_span(RESOLVE_FETCH_SECONDS, time.monotonic() - started, status=response.status)
+            if response.status != 403:
+                return await self._scan(response, stop_on_m3u8)
 
-    def find_m3u8(self, html_content: str) -> Optional[str]:
-        """Busca enlaces directos a manifiestos HLS (.m3u8)."""
-        # Patrón para encontrar URLs que terminan en .m3u8 dentro de comillas o JSON
-        m3u8_pattern = re.compile(r'["\'](http[s]?://[^"\']+\.m3u8(?:[^"\']*)?)["\']', re.IGNORECASE)
-        match = m3u8_pattern.search(html_content)
-        if match:
-            return match.group(1)
-        return None
+        print("Detectado 403 Forbidden. Intentando bypass simple...")
+        # A veces ayuda refrescar la sesión o headers
+        headers = {'Referer': url}
+        started = time.monotonic()
+        async with session.get(url, headers=headers) as response:
+            observe_span(RESOLVE_FETCH_SECONDS, time.monotonic() - started, status=response.status)
+            return await self._scan(response, stop_on_m3u8)
+
+    async def _scan(self, response: 'aiohttp.ClientResponse', stop_on_m3u8: bool) -> dict:
+        try:
+            decoder = codecs.getincrementaldecoder(response.charset or 'utf-8')(errors='replace')
+        except LookupError:
+            decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        found = {}
+        tail = ''
+        read = 0
+        try:
+            async for chunk in response.content.iter_chunked(RESOLVE_CHUNK_SIZE):
+                read += len(chunk)
+                window = tail + decoder.decode(chunk)
+                for match in _PAGE_SCAN_RE.finditer(window):
+                    found.setdefault(match.lastgroup, match.group(match.lastgroup))
+                # Al salir sin leer el resto, aiohttp cierra la conexión en vez de devolverla al pool
+                if 'player' in found or (stop_on_m3u8 and 'm3u8' in found):
+                    break
+                if read >= RESOLVE_MAX_PAGE_BYTES:
+                    print(f"Página truncada a {read} bytes: {response.url}")
+                    break
+                tail = window[-RESOLVE_SCAN_OVERLAP:]
+        finally:
+            RESOLVE_SCANNED_BYTES.inc(read)
+        if 'm3u8' in found:
+            # Limpiar: quitar slash escapado, backslashes finales y espacios
+            found['m3u8'] = found['m3u8'].replace(r'\/', '/').replace('\\', '').strip()
+        return found
 
-    def aggressive_resolve(self) -> str:
+    async def aggressive_resolve(self) -> str:
         """Intenta resolver la URL real del video, saltando iframes y protecciones básicas."""
+        domain = resolver_domain(self.original_url)
+        if resolution_cache.should_skip_fetch(domain):
+            RESOLVE_OUTCOMES.inc(outcome='skipped')
+            return self.original_url
+
+        key = canonicalize_url(self.original_url)
+        cached = resolution_cache.get(key)
+        if cached is not None:
+            RESOLVE_OUTCOMES.inc(outcome='cached')
+            return cached[0]
+
         print(f"Analizando URL base: {self.original_url}")
-        
         try:
-            # 1. Petición inicial (imitando navegador)
-            response = self.session.get(self.original_url, timeout=10, allow_redirects=True)
-            if response.status_code == 403:
-                print("Detectado 403 Forbidden. Intentando bypass simple...")
-                # A veces ayuda refrescar la sesión o headers
-                self.session.headers.update({'Referer': self.original_url})
-                response = self.session.get(self.original_url, timeout=10)
-
-            html = response.text
-
-            # 2. Buscar Iframes (Prioridad 1: Si hay un player embebido, es mejor ir a la fuente)
-            iframe_src = self.resolve_iframe(html)
-            if iframe_src:
-                print(f"Iframe detectado saltando a: {iframe_src}")
-                # Podríamos hacer recursividad aquí si fuera necesario
-                return iframe_src
-
-            # 3. Buscar m3u8 directo (Prioridad 2)
-            m3u8_url = self.find_m3u8(html)
-            if m3u8_url:
-                print(f"Manifiesto HLS detectado: {m3u8_url}")
-                # Limpiar: quitar slash escapado, backslashes finales y espacios
-                clean_url = m3u8_url.replace(r'\/', '/').replace('\\', '').strip()
-                return clean_url
-
+            found = await self._resolve(self.original_url, 0, set(), None)
         except Exception as e:
+            # Sin caché ni perfil: un fallo de red no dice nada del sitio
             print(f"Error en resolución agresiva: {e}")
-        
+            RESOLVE_OUTCOMES.inc(outcome='error')
+            return self.original_url
+
+        final_url, kind = found or (self.original_url, 'direct')
+        resolution_cache.set(key, final_url, kind)
+        resolution_cache.record(domain, kind)
+        RESOLVE_OUTCOMES.inc(outcome=kind)
         # Si no encontramos nada especial, devolvemos la URL original para que yt-dlp se encargue
-        return self.original_url
+        return final_url
 
-# --- FIN CONFIGURACIÓN EXTRACTOR ---
+    async def _resolve(self, url: str, depth: int, visited: set, referer: Optional[str]) -> Optional[Tuple[str, str]]:
+        """Un salto: (url final, 'iframe'|'m3u8') o None si la página no lleva a nada reconocible."""
+        key = canonicalize_url(url)
+        if key in visited:
+            print(f"Ciclo de iframes detectado en: {url}")
+            return None
+        visited.add(key)
+        # El manifiesto va primero sólo si el dominio suele darlo directamente
+        m3u8_first = depth == 0 and resolution_cache.profile(resolver_domain(url)) == 'm3u8'
+        found = await self.scan_page(url, referer, stop_on_m3u8=m3u8_first)
 
+        if m3u8_first and 'm3u8' in found:
+            print(f"Manifiesto HLS detectado: {found['m3u8']}")
+            return found['m3u8'], 'm3u8'
 
-# Función de limpieza
-def cleanup_file(path: Path):
-    try:
-        if path.exists():
-            os.remove(path)
-            print(f"Archivo eliminado: {path}")
-    except Exception as e:
-        print(f"Error al eliminar archivo {path}: {e}")
+        # 1. Iframe de un reproductor conocido (Prioridad 1: es mejor ir a la fuente)
+        iframe_src = found.get('player')
+        if iframe_src:
+            print(f"Iframe detectado saltando a: {iframe_src}")
+            if _is_direct_domain(resolver_domain(iframe_src)) or depth + 1 >= RESOLVE_MAX_DEPTH:
+                return iframe_src, 'iframe'
+            nested = await self._follow(iframe_src, depth, visited, url)
+            # Se conserva el tipo del salto anidado: un m3u8 firmado mantiene el TTL corto de medios
+            return nested or (iframe_src, 'iframe')
 
-def format_size(size_bytes):
-    if size_bytes is None:
-        return "N/A"
-    for unit in ['B', 'KB', 'MB', 'GB']:
-        if size_bytes < 1024:
-            return f"{size_bytes:.1f} {unit}"
-        size_bytes /= 1024
-    return f"{size_bytes:.1f} TB"
+        # 2. m3u8 directo (Prioridad 2)
+        if 'm3u8' in found:
+            print(f"Manifiesto HLS detectado: {found['m3u8']}")
+            return found['m3u8'], 'm3u8'
 
-@app.get("/", response_class=HTMLResponse)
-async def read_root(request: Request):
-    return templates.TemplateResponse("index.html", {"request": request})
+        # 3. Reproductor genérico: se sigue, pero sólo cuenta si dentro hay algo reconocible
+        if 'embed' in found and depth + 1 < RESOLVE_MAX_DEPTH:
+            embed_src = urljoin(url, found['embed'])
+            print(f"Reproductor embebido, siguiendo: {embed_src}")
+            nested = await self._follow(embed_src, depth, visited, url)
+            if nested:
+                return nested
+        return None
 
-@app.get("/analyze")
-def analyze_video(url: str):
-    if not url:
-        raise HTTPException(status_code=400, detail="URL requerida")
+    async def _follow(self, url: str, depth: int, visited: set, referer: str) -> Optional[Tuple[str, str]]:
+        # Un reproductor anidado que falla no invalida lo encontrado en la página padre
+        try:
+            return await self._resolve(url, depth + 1, visited, referer)
+        except Exception as e:
+            print(f"No se pudo seguir {url}: {e}")
+            return None
 
-    try:
-        # 1. Resolución Agresiva
-        extractor = VideoExtractor(url)
-        target_url = extractor.aggressive_resolve() or url
-        
-        print(f"URL final a analizar: {target_url}")
+# --- FIN CONFIGURACIÓN EXTRACTOR ---
 
-        # Base de opciones - SOLO opciones confiables, sin experimentales
-        base_ydl_opts = {
-            'quiet': True,
-            'no_warnings': True,
-            'noplaylist': True,
-            'extract_flat': False,
-            'nocheckcertificate': True,
-            'geo_bypass': True,
-            'socket_timeout': 30,
-        }
 
-        # Lista de estrategias a intentar en orden de preferencia
-        strategies = []
+# --- CACHÉ DE ANÁLISIS (/analyze) ---
+# Guarda la respuesta ya procesada de analyze_video (formatos, título, duración, estrategia)
+# para no repetir aggressive_resolve + extract_info con enlaces populares.
+ANALYZE_CACHE_TTL = int(os.environ.get('ANALYZE_CACHE_TTL', 600))                  # segundos
+ANALYZE_CACHE_MAX_ENTRIES = int(os.environ.get('ANALYZE_CACHE_MAX_ENTRIES', 512))
+ANALYZE_CACHE_MAX_BYTES = int(os.environ.get('ANALYZE_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+# Ruta a un SQLite para que la caché sobreviva reinicios (vacío = sólo memoria)
+ANALYZE_CACHE_DB = os.environ.get('ANALYZE_CACHE_DB', '').strip() or None
 
-        if YOUTUBE_COOKIES_FILE:
-            # Estrategia 1: tv_embedded + cookies + check_formats=False (funciona para la mayoría)
-            strategies.append({
-                **base_ydl_opts,
-                'ignoreerrors': True,
-                'check_formats': False,
-                'cookiefile': YOUTUBE_COOKIES_FILE,
-                'extractor_args': {'youtube': {'player_client': ['tv_embedded']}},
-            })
-            # Estrategia 2: ios + cookies (cliente app iOS, diferente handshake)
-            strategies.append({
-                **base_ydl_opts,
-                'ignoreerrors': True,
-                'check_formats': False,
-                'cookiefile': YOUTUBE_COOKIES_FILE,
-                'extractor_args': {'youtube': {'player_client': ['ios']}},
-            })
-            # Estrategia 3: android + cookies
-            strategies.append({
-                **base_ydl_opts,
-                'ignoreerrors': True,
-                'check_formats': False,
-                'cookiefile': YOUTUBE_COOKIES_FILE,
-                'extractor_args': {'youtube': {'player_client': ['android']}},
-            })
-            # Estrategia 4: mweb + cookies (Mobile Web - robusto)
-            strategies.append({
-                **base_ydl_opts,
-                'ignoreerrors': True,
-                'check_formats': False,
-                'cookiefile': YOUTUBE_COOKIES_FILE,
-                'extractor_args': {'youtube': {'player_client': ['mweb']}},
-            })
-            # Estrategia 5: web + cookies sin restricciones adicionales
-            strategies.append({
-                **base_ydl_opts,
-                'ignoreerrors': True,
-                'check_formats': False,
-                'cookiefile': YOUTUBE_COOKIES_FILE,
-            })
+# Parámetros de tracking que no cambian el video y sólo fragmentan la caché
+_TRACKING_PARAMS = {
+    'si', 'feature', 'pp', 'fbclid', 'gclid', 'dclid', 'yclid', 'msclkid', 'igshid',
+    'igsh', 'ref', 'ref_src', 'ref_url', 'spm', 'mc_cid', 'mc_eid', '_ga', 'share_id',
+}
+_YOUTUBE_HOSTS = ('youtube.com', 'youtu.be', 'youtube-nocookie.com')
+_YOUTUBE_ID_RE = re.compile(r'(?:[?&]v=|/shorts/|/embed/|/live/|/v/|youtu\.be/)([A-Za-z0-9_-]{11})')
 
-        # Estrategia final: sin cookies (funciona si el video es público y la IP no está flaggeada)
-        strategies.append({
-            **base_ydl_opts,
-            'ignoreerrors': False,
-            'check_formats': False,
-        })
 
-        info = None
-        success_strategy = {"client": ["auto"], "cookies": False} # Default
+def canonicalize_url(url: str) -> str:
+    """Normaliza una URL para usarla como clave de caché (ID de YouTube, sin tracking)."""
+    url = (url or '').strip()
+    parsed = urlparse(url)
+    host = (parsed.hostname or '').lower()
+    if host.startswith('www.'):
+        host = host[4:]
+
+    # YouTube: todas las variantes (watch, shorts, embed, youtu.be, m.) comparten el ID
+    if any(host == h or host.endswith('.' + h) for h in _YOUTUBE_HOSTS):
+        match = _YOUTUBE_ID_RE.search(url)
+        if match:
+            return f"youtube:{match.group(1)}"
+
+    query = sorted(
+        (k, v) for k, v in parse_qsl(parsed.query, keep_blank_values=True)
+        if k.lower() not in _TRACKING_PARAMS and not k.lower().startswith('utm_')
+    )
+    netloc = host
+    if parsed.port and not ((parsed.scheme == 'http' and parsed.port == 80) or
+                            (parsed.scheme == 'https' and parsed.port == 443)):
+        netloc = f"{host}:{parsed.port}"
+    path = parsed.path.rstrip('/') or '/'
+    return urlunparse(((parsed.scheme or 'https').lower(), netloc, path, '', urlencode(query), ''))
+
 
-        for i, ydl_opts in enumerate(strategies):
-            client = ydl_opts.get('extractor_args', {}).get('youtube', {}).get('player_client', ['auto'])
-            has_cookies = 'cookiefile' in ydl_opts
-            print(f"[INFO] Intento {i+1}/{len(strategies)}: cliente={client}, cookies={has_cookies}")
+class AnalyzeCache:
+    """Caché LRU con TTL y límite de entradas/bytes, con respaldo opcional en SQLite."""
+
+    def __init__(self, ttl: int, max_entries: int, max_bytes: int, db_path: Optional[str] = None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # {key: (expires_at, size, value)}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'disk_hits': 0, 'evictions': 0, 'expired': 0}
+        self._db = None
+        if db_path:
             try:
-                with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                    info = ydl.extract_info(target_url, download=False)
-                if info:
-                    print(f"[INFO] ✅ Éxito con estrategia {i+1}")
-                    success_strategy = {"client": client, "cookies": has_cookies}
-                    break
-                else:
-                    print(f"[WARN] Estrategia {i+1} devolvió None, probando siguiente...")
-            except HTTPException:
-                raise
+                self._db = sqlite3.connect(db_path, check_same_thread=False)
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS analyze_cache ("
+                    "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+                )
+                self._db.commit()
+                print(f"[INFO] Caché de análisis persistente en: {db_path}")
             except Exception as e:
-                error_str = str(e)
-                print(f"[WARN] Estrategia {i+1} falló: {error_str[:200]}")
-                # Detectar errores de DNS / red
-                if 'NameResolutionError' in error_str or 'Failed to resolve' in error_str or 'No address associated' in error_str:
-                    from urllib.parse import urlparse
-                    domain = urlparse(url).netloc
-                    raise HTTPException(
-                        status_code=503,
-                        detail=f"El servidor no puede conectarse a '{domain}'. Este dominio puede estar bloqueado."
-                    )
-                continue
+                print(f"[WARN] No se pudo abrir la caché SQLite ({db_path}): {e}")
+                self._db = None
 
-        # --- Fuera del loop: procesar formatos del info obtenido ---
-        if not info:
-            raise HTTPException(status_code=404, detail="No se pudo extraer información del video.")
+    def get(self, key: str) -> Optional[dict]:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, _, value = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    self.stats['hits'] += 1
+                    return value
+                self._remove(key)
+                self.stats['expired'] += 1
 
-        video_formats = []
-        audio_formats = []
+            value = self._db_get(key, now)
+            if value is not None:
+                self.stats['hits'] += 1
+                self.stats['disk_hits'] += 1
+                return value
 
-        raw_formats = info.get('formats')
-        if raw_formats is None or not isinstance(raw_formats, list):
-            raw_formats = []
-        if not raw_formats:
-            raw_formats = [info]
+            self.stats['misses'] += 1
+            return None
 
-        # Set para deduplicación por resolución (Video)
-        seen_resolutions = set()
+    def set(self, key: str, value: dict):
+        payload = json.dumps(value, ensure_ascii=False)
+        size = len(payload)
+        if size > self.max_bytes:
+            return
+        expires_at = time.time() + self.ttl
+        with self._lock:
+            self._store(key, expires_at, size, value)
+            if self._db is not None:
+                try:
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO analyze_cache (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+                        (key, payload, expires_at, time.time())
+                    )
+                    self._db_prune()
+                    self._db.commit()
+                except Exception as e:
+                    print(f"[WARN] Error escribiendo caché SQLite: {e}")
 
-        # Ordenar por ALTURA (resolución) primero, luego por bitrate
-        def quality_key(f):
-            height = f.get('height') or 0
-            tbr = f.get('tbr') or 0
-            filesize = f.get('filesize') or 0
-            return (height, tbr, filesize)
+    def snapshot(self) -> dict:
+        with self._lock:
+            total = self.stats['hits'] + self.stats['misses']
+            return {
+                **self.stats,
+                'hit_ratio': round(self.stats['hits'] / total, 3) if total else 0.0,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'ttl': self.ttl,
+                'persistent': self._db is not None,
+            }
 
-        raw_formats.sort(key=quality_key, reverse=True)
-        print(f"Total de formatos encontrados por yt-dlp: {len(raw_formats)}")
-        for fmt in raw_formats[:10]:
-            print(f"  Format: {fmt.get('format_id')} | {fmt.get('height')}p | vcodec={fmt.get('vcodec')} | acodec={fmt.get('acodec')} | ext={fmt.get('ext')}")
+    # --- internos (llamar con el lock tomado) ---
 
-        # Calcular tamaño del mejor audio m4a (se descarga siempre junto al video)
-        best_audio_for_video = next(
-            (f for f in raw_formats if f.get('vcodec') == 'none' and f.get('ext') == 'm4a'),
-            next((f for f in raw_formats if f.get('vcodec') == 'none'), None)
-        )
-        audio_size_bytes = 0
-        if best_audio_for_video:
-            audio_size_bytes = best_audio_for_video.get('filesize') or best_audio_for_video.get('filesize_approx') or 0
-
-        for f in raw_formats:
-            if not f: continue
-
-            format_id = f.get('format_id')
-            vcodec = f.get('vcodec', 'none')
-            acodec = f.get('acodec', 'none')
-            is_video = vcodec != 'none'
-
-            if is_video:
-                height = f.get('height')
-                if not height: continue
-
-                resolution_key = f"{height}p"
-
-                # Calcular tamaño de VIDEO
-                # Prioridad REVISADA: filesize (exacto) > BR Calculado (mas preciso que approx) > filesize_approx
-                v_size = f.get('filesize')
-                
-                # FACTOR DE SEGURIDAD:
-                # Si yt-dlp no nos da el 'filesize' exacto (común en DASH/HLS), 
-                # las estimaciones (approx o bitrate) suelen ser SOLO del video track o estar comprimidas.
-                # Experiencia muestra que el archivo MP4 final (muxed) suele ser mayor.
-                # Aplicaremos un buffer si no hay filesize exacto.
-                is_estimate = False
-
-                if not v_size:
-                    # Calcular por bitrate (TBR = Total Bitrate en kbits/s)
-                    tbr = f.get('tbr') or f.get('vbr')
-                    duration_sec = info.get('duration')
-                    if tbr and duration_sec:
-                        # kbps -> bytes/sec: (tbr * 1000) / 8
-                        v_size = (tbr * 1000 / 8) * duration_sec
-                        is_estimate = True
-                
-                if not v_size:
-                     v_size = f.get('filesize_approx')
-                     is_estimate = True
-                
-                v_size = v_size or 0
-
-                # Sumar audio solo si NO usamos TBR (porque TBR ya incluye audio usualmente si es del container, 
-                # pero en DASH streams raw tbr es solo video? yt-dlp tbr suele ser video+audio target... 
-                # PROBEMOS: Si calculamos por TBR, asumimos que es el total del stream video.
-                # Si es DASH video-only, tbr es video bitrate. Necesitamos sumar audio.
-                
-                total_size = v_size + audio_size_bytes
-                
-                # Si es una estimación, a menudo yt-dlp subestima el overhead del contenedor MP4 y el audio real.
-                # Para evitar decepciones (ej: dice 300MB y baja 600MB), si es estimado, mostramos RANGO o aumentamos.
-                # En este caso, el usuario reportó DOBLE tamaño. Vamos a ser conservadores.
-                if is_estimate and total_size > 0:
-                     # Aplicar factor de corrección basado en reporte usuario (aprox 2x en worst case)
-                     # O simplemente mostrar "~"
-                     total_size = total_size * 1.5 
-                     size_str = f"~{format_size(total_size)}"
-                else:
-                     size_str = format_size(total_size) if total_size > 0 else "N/A"
-
-                # Simplificar codec para mostrar al usuario
-                codec_label = "MP4"
-                if "avc1" in vcodec or "h264" in vcodec:
-                    codec_label = "H.264"
-                elif "vp9" in vcodec:
-                    codec_label = "VP9"
-                elif "av01" in vcodec:
-                    codec_label = "AV1"
-                
-                # Label más descriptivo: "1080p (H.264) - MP4"
-                label = f"{resolution_key} ({codec_label})"
-
-                video_formats.append({
-                    "format_id": format_id,
-                    "extension": "mp4",
-                    "resolution": resolution_key,
-                    "filesize_str": size_str,
-                    "label": label,
-                    "is_video": True,
-                    "height": height, # Guardamos height para ordernar mejor
-                    "tbr": f.get('tbr') or 0 # Guardamos bitrate para ordenar mejor
-                })
+    def _store(self, key, expires_at, size, value):
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (expires_at, size, value)
+        self._bytes += size
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.stats['evictions'] += 1
 
-        # Ordenar videos por altura (resolución) DESC, luego por bitrate (tbr) DESC
-        video_formats.sort(key=lambda x: (x.get('height', 0), x.get('tbr', 0)), reverse=True)
-
-        # Opción de Audio (MP3)
-        best_audio = next((f for f in raw_formats if f.get('vcodec') == 'none'), None)
-        audio_size_str = "N/A"
-        if best_audio:
-            audio_size_str = format_size(best_audio.get('filesize') or best_audio.get('filesize_approx'))
-
-        audio_formats.append({
-            "format_id": "best_audio_mp3",
-            "extension": "mp3",
-            "resolution": "Audio High Quality",
-            "filesize_str": audio_size_str,
-            "label": "Audio Only - MP3",
-            "is_video": False
-        })
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
 
-        return {
-            "title": info.get('title') or 'Video Desconocido',
-            "thumbnail": info.get('thumbnail'),
-            "duration": info.get('duration'),
-            "videos": video_formats,
-            "audios": audio_formats,
-            "url": target_url,
-            "original_url": url,
-            "strategy": success_strategy
-        }
+    def _db_get(self, key, now) -> Optional[dict]:
+        if self._db is None:
+            return None
+        try:
+            row = self._db.execute(
+                "SELECT value, expires_at FROM analyze_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if not row:
+                return None
+            payload, expires_at = row
+            if expires_at <= now:
+                self._db.execute("DELETE FROM analyze_cache WHERE key = ?", (key,))
+                self._db.commit()
+                self.stats['expired'] += 1
+                return None
+            self._db.execute("UPDATE analyze_cache SET accessed_at = ? WHERE key = ?", (now, key))
+            self._db.commit()
+            value = json.loads(payload)
+            # Promocionar a memoria
+            self._store(key, expires_at, len(payload), value)
+            return value
+        except Exception as e:
+            print(f"[WARN] Error leyendo caché SQLite: {e}")
+            return None
 
-    except HTTPException:
-        # Re-lanzar HTTPExceptions sin modificar (no convertirlas en 500)
-        raise
-    except Exception as e:
-        import traceback
-        traceback.print_exc()
-        print(f"Error analizando (yt-dlp): {e}")
-        raise HTTPException(status_code=500, detail=f"Error al analizar el video: {str(e)}")
+    def _db_prune(self):
+        # En disco se permite más margen que en memoria, pero también está acotado
+        self._db.execute("DELETE FROM analyze_cache WHERE expires_at <= ?", (time.time(),))
+        self._db.execute(
+            "DELETE FROM analyze_cache WHERE key NOT IN ("
+            "SELECT key FROM analyze_cache ORDER BY accessed_at DESC LIMIT ?)",
+            (self.max_entries * 10,)
+        )
 
-@app.get("/download-selected")
-def download_selected(url: str, format_id: str, client: str = None, use_cookies: str = 'true'):
-    """Inicia la descarga en background y devuelve un file_id para seguir el progreso."""
-    if not url or not format_id:
-        raise HTTPException(status_code=400, detail="URL y format_id requeridos")
 
-    file_id = str(uuid.uuid4())
+analyze_cache = AnalyzeCache(
+    ttl=ANALYZE_CACHE_TTL,
+    max_entries=ANALYZE_CACHE_MAX_ENTRIES,
+    max_bytes=ANALYZE_CACHE_MAX_BYTES,
+    db_path=ANALYZE_CACHE_DB,
+)
 
-    # Procesar parámetros de estrategia
-    use_cookies_bool = use_cookies.lower() == 'true'
-    
-    # Determinar cliente
-    # Si viene del frontend, usarlo. Si no, fallback al default robusto.
-    if client and client != 'null':
-        target_clients = [client] if ',' not in client else client.split(',')
-    else:
-        target_clients = ['tv_embedded', 'android', 'ios', 'mweb']
+# --- FIN CACHÉ DE ANÁLISIS ---
 
-    print(f"[INFO] Iniciando descarga ({file_id}) con cliente={target_clients} cookies={use_cookies_bool}")
 
-    # Configuración base con EJS y Node.js para evitar el bot en la descarga también
-    base_opts = {
-        'noplaylist': True,
-        'quiet': True,
-        'http_headers': DEFAULT_HEADERS,
-        'nocheckcertificate': True,
-        'geo_bypass': True,
-        'retries': 10,
-        'outtmpl': str(DOWNLOAD_DIR / f"{file_id}.%(ext)s"),
-        'cookiefile': YOUTUBE_COOKIES_FILE if (YOUTUBE_COOKIES_FILE and use_cookies_bool) else None,
-        'js_runtimes': {'nodejs': {}},
-        'extractor_args': {'youtube': {'player_client': target_clients}},
-    }
+# --- TOKENS DE EXTRACCIÓN (analyze -> download-selected) ---
+# El info dict de yt-dlp que obtuvo /analyze (formatos con URLs ya firmadas y descifradas) se
+# guarda poco tiempo bajo un token. /download-selected?token=... lo reutiliza con
+# process_ie_result en vez de repetir extract_info (página, JS del player, runtime de Node).
+INFO_TOKEN_TTL = int(os.environ.get('INFO_TOKEN_TTL', 900))                 # segundos
+INFO_TOKEN_MAX_ENTRIES = int(os.environ.get('INFO_TOKEN_MAX_ENTRIES', 128))
+INFO_TOKEN_EXPIRY_MARGIN = 120  # margen antes de que caduquen las URLs firmadas
+# Campos pesados que no hacen falta para elegir formato y descargar
+_INFO_HEAVY_KEYS = ('automatic_captions', 'subtitles', 'requested_subtitles', 'thumbnails',
+                    'heatmap', 'description', 'comments', 'chapters')
 
-    ydl_opts = {**base_opts}
 
-    if format_id == "best_audio_mp3":
-        ydl_opts.update({
-            'format': 'bestaudio/best',
-            'postprocessors': [{
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': 'mp3',
-                'preferredquality': '192',
-            }],
-        })
-        final_ext = "mp3"
-    else:
-        # Descarga de Video MP4 - MODO RÁPIDO (Stream Copy)
-        # Forzamos EXACTAMENTE el format_id seleccionado + mejor audio
-        ydl_opts.update({
-            'format': f"{format_id}+bestaudio[ext=m4a]/bestaudio/best",
-            'merge_output_format': 'mp4',
-            'postprocessor_args': {
-                'ffmpeg': [
-                    '-c', 'copy',
-                    '-map', '0:v:0',
-                    '-map', '1:a:0',
-                    '-shortest'
-                ]
-            }
-        })
-        final_ext = "mp4"
+def _signed_urls_expire(info: dict) -> Optional[float]:
+    """Primera caducidad (epoch) de las URLs firmadas de los formatos, si la indican (expire=...)."""
+    expiry = None
+    for f in info.get('formats') or [info]:
+        params = dict(parse_qsl(urlparse(f.get('url') or '').query))
+        value = params.get('expire') or params.get('expires')
+        if value and value.isdigit():
+            expiry = min(expiry or float('inf'), float(value))
+    return expiry
 
-    # Agregar hook de progreso
-    ydl_opts['progress_hooks'] = [make_progress_hook(file_id)]
 
-    # Inicializar progreso
-    download_progress[file_id] = {
-        'percent': 0, 'status': 'downloading',
-        'message': 'Iniciando descarga...', 'filename': None, 'path': None
-    }
+class InfoTokenCache:
+    """Info dicts compactos de yt-dlp por token, con TTL acotado por la caducidad de sus URLs."""
 
-    # Lanzar descarga en hilo separado
-    thread = threading.Thread(
-        target=_run_download,
-        args=(file_id, url, final_ext, ydl_opts),
-        daemon=True
-    )
-    thread.start()
+    def __init__(self, ttl: int, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # {token: (expires_at, cache_key, info)}
+        self._by_key = {}              # {cache_key: token} para reutilizarlo en hits de /analyze
+        self._lock = threading.Lock()
+        self.stats = {'issued': 0, 'hits': 0, 'misses': 0, 'evictions': 0}
 
-    return JSONResponse({'file_id': file_id})
+    def issue(self, cache_key: str, info: dict) -> Optional[str]:
+        expires_at = time.time() + self.ttl
+        signed_expiry = _signed_urls_expire(info)
+        if signed_expiry is not None:
+            expires_at = min(expires_at, signed_expiry - INFO_TOKEN_EXPIRY_MARGIN)
+        if expires_at <= time.time():
+            return None
+        compact = {k: v for k, v in info.items() if k not in _INFO_HEAVY_KEYS}
+        token = uuid.uuid4().hex
+        with self._lock:
+            old = self._by_key.pop(cache_key, None)
+            if old is not None:
+                self._entries.pop(old, None)
+            self._entries[token] = (expires_at, cache_key, compact)
+            self._by_key[cache_key] = token
+            self.stats['issued'] += 1
+            while len(self._entries) > self.max_entries:
+                oldest, (_, oldest_key, _) = self._entries.popitem(last=False)
+                if self._by_key.get(oldest_key) == oldest:
+                    del self._by_key[oldest_key]
+                self.stats['evictions'] += 1
+        return token
 
+    def token_for(self, cache_key: str) -> Optional[str]:
+        with self._lock:
+            token = self._by_key.get(cache_key)
+            entry = self._entries.get(token) if token else None
+            return token if entry and entry[0] > time.time() else None
 
-# --- STORE GLOBAL DE PROGRESO ---
-download_progress = {}  # {file_id: {percent, status, message, filename, path}}
+    def get(self, token: Optional[str], cache_key: str) -> Optional[dict]:
+        """Copia del info dict (process_ie_result lo modifica), sólo si el token es de esta URL."""
+        with self._lock:
+            entry = self._entries.get(token) if token else None
+            if entry is None or entry[0] <= time.time() or entry[1] != cache_key:
+                self.stats['misses'] += 1
+                return None
+            self.stats['hits'] += 1
+            info = entry[2]
+        return copy.deepcopy(info)
 
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {**self.stats, 'entries': len(self._entries), 'max_entries': self.max_entries, 'ttl': self.ttl}
 
-def make_progress_hook(file_id: str):
-    """Crea un hook de progreso para yt-dlp que actualiza download_progress."""
+
+info_tokens = InfoTokenCache(ttl=INFO_TOKEN_TTL, max_entries=INFO_TOKEN_MAX_ENTRIES)
+
+# --- FIN TOKENS DE EXTRACCIÓN ---
+
+
+# --- POOL DE INSTANCIAS YoutubeDL ---
+# Construir un YoutubeDL por intento vuelve a leer COOKIES.txt, a registrar los extractores y a
+# montar el opener (perdiendo las conexiones abiertas). El pool guarda instancias ya construidas
+# por perfil de opciones (cliente de YouTube, cookies, etc.) y sólo cambia lo propio de cada
+# trabajo: formato, plantilla de salida y hooks. Todas comparten un único cookie jar en memoria,
+# cargado una vez. Una instancia se recicla tras YTDLP_POOL_MAX_USES usos o si su trabajo falla.
+YTDLP_POOL_MAX_IDLE = int(os.environ.get('YTDLP_POOL_MAX_IDLE', 4))     # instancias libres por perfil
+YTDLP_POOL_MAX_USES = int(os.environ.get('YTDLP_POOL_MAX_USES', 25))
+
+# Opciones que cambian en cada trabajo: no forman parte de la clave del pool
+_YDL_JOB_PARAMS = ('format', 'outtmpl', 'merge_output_format', 'postprocessor_args',
+                   'progress_hooks', 'postprocessor_hooks', 'ratelimit')
+
+
+class YoutubeDLPool:
+    """Instancias de YoutubeDL reutilizables, agrupadas por perfil de opciones (checkout/checkin)."""
+
+    def __init__(self, max_idle: int, max_uses: int):
+        self.max_idle = max_idle
+        self.max_uses = max_uses
+        self._idle = {}          # {clave: [YoutubeDL]}
+        self._labels = {}        # {clave: etiqueta legible}
+        self._cookiejar = None
+        self._lock = threading.Lock()
+        self._close_lock = threading.Lock()
+        self.stats = {'created': 0, 'reused': 0, 'recycled': 0, 'discarded': 0}
+
+    @staticmethod
+    def _key(opts: dict) -> str:
+        profile = {k: v for k, v in opts.items() if k not in _YDL_JOB_PARAMS}
+        return json.dumps(profile, sort_keys=True, default=str)
+
+    def _shared_cookiejar(self, cookiefile: str):
+        with self._lock:
+            if self._cookiejar is None or self._cookiejar.filename != cookiefile:
+                jar = yt_dlp.cookies.YoutubeDLCookieJar(cookiefile)
+                if os.access(cookiefile, os.R_OK):
+                    jar.load()
+                self._cookiejar = jar
+            return self._cookiejar
+
+    def checkout(self, opts: dict):
+        key = self._key(opts)
+        ydl = None
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                ydl = idle.pop()
+                self.stats['reused'] += 1
+        if ydl is None:
+            ydl = yt_dlp.YoutubeDL({k: v for k, v in opts.items() if k not in _YDL_JOB_PARAMS})
+            if opts.get('cookiefile'):
+                # cookiejar es un cached_property: fijarlo antes del primer uso evita releer el archivo
+                ydl.__dict__['cookiejar'] = self._shared_cookiejar(opts['cookiefile'])
+            ydl._pool_key = key
+            ydl._pool_uses = 0
+            with self._lock:
+                self.stats['created'] += 1
+                client = opts.get('extractor_args', {}).get('youtube', {}).get('player_client', ['auto'])
+                self._labels[key] = f"{','.join(client)}|cookies={bool(opts.get('cookiefile'))}"
+        self._prepare(ydl, opts)
+        return ydl
+
+    def checkin(self, ydl, healthy: bool = True):
+        ydl._pool_uses += 1
+        if healthy and ydl._pool_uses < self.max_uses:
+            with self._lock:
+                idle = self._idle.setdefault(ydl._pool_key, [])
+                if len(idle) < self.max_idle:
+                    idle.append(ydl)
+                    return
+        with self._lock:
+            self.stats['recycled' if healthy else 'discarded'] += 1
+        self._close(ydl)
+
+    @contextmanager
+    def lease(self, opts: dict):
+        """`with ydl_pool.lease(opts) as ydl:` en lugar de `with yt_dlp.YoutubeDL(opts) as ydl:`."""
+        ydl = self.checkout(opts)
+        healthy = False
+        try:
+            yield ydl
+            healthy = True
+        finally:
+            self.checkin(ydl, healthy)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            idle = {}
+            for key, instances in self._idle.items():
+                label = self._labels.get(key, '?')
+                idle[label] = idle.get(label, 0) + len(instances)
+            return {**self.stats, 'idle': idle, 'max_idle': self.max_idle, 'max_uses': self.max_uses}
+
+    def _prepare(self, ydl, opts: dict):
+        """Aplica las opciones del trabajo y limpia el estado del anterior.
+
+        yt-dlp no tiene una API para esto: se repite lo que hace YoutubeDL.__init__ con esas opciones.
+        """
+        for name in _YDL_JOB_PARAMS:
+            ydl.params.pop(name, None)
+            if name in opts:
+                ydl.params[name] = opts[name]
+        ydl._parse_outtmpl()
+        fmt = ydl.params.get('format')
+        ydl.format_selector = fmt if fmt in (None, '-') or callable(fmt) else ydl.build_format_selector(fmt)
+        ydl._progress_hooks = []
+        ydl._postprocessor_hooks = []
+        for hook in opts.get('progress_hooks') or []:
+            ydl.add_progress_hook(hook)
+        for hook in opts.get('postprocessor_hooks') or []:
+            ydl.add_postprocessor_hook(hook)
+        ydl._download_retcode = 0
+        ydl._num_downloads = 0
+        ydl._num_videos = 0
+        ydl._playlist_level = 0
+        ydl._playlist_urls = set()
+
+    def _close(self, ydl):
+        # close() también guarda el cookie jar compartido en COOKIES.txt: una escritura a la vez
+        try:
+            with self._close_lock:
+                ydl.close()
+        except Exception as e:
+            print(f"[WARN] Pool de YoutubeDL: error al cerrar una instancia: {e}")
+
+
+ydl_pool = YoutubeDLPool(YTDLP_POOL_MAX_IDLE, YTDLP_POOL_MAX_USES)
+
+# --- FIN POOL DE INSTANCIAS YoutubeDL ---
+
+
+# --- PLANIFICADOR ADAPTATIVO DE ESTRATEGIAS ---
+# Aprende qué player_client funciona en cada dominio y lo prueba primero, en vez de
+# recorrer siempre tv_embedded -> ios -> android -> mweb -> web -> sin cookies.
+STRATEGY_WINDOW = int(os.environ.get('STRATEGY_WINDOW', 20))                  # intentos recordados por estrategia
+STRATEGY_PROBE_INTERVAL = int(os.environ.get('STRATEGY_PROBE_INTERVAL', 20))  # cada N análisis se sondea una degradada
+STRATEGY_BACKOFF_BASE = float(os.environ.get('STRATEGY_BACKOFF_BASE', 30))    # segundos
+STRATEGY_BACKOFF_MAX = float(os.environ.get('STRATEGY_BACKOFF_MAX', 900))
+STRATEGY_FAILURES_TO_DEMOTE = 2
+STRATEGY_PRIOR_LATENCY = 5.0  # coste supuesto (s) de una estrategia sin historial
+
+
+def strategy_scope(url: str) -> str:
+    """Ámbito de las estadísticas de estrategia: el dominio (todo YouTube comparte uno)."""
+    host = (urlparse(url).hostname or '').lower()
+    if host.startswith('www.'):
+        host = host[4:]
+    if any(host == h or host.endswith('.' + h) for h in _YOUTUBE_HOSTS):
+        return 'youtube'
+    return host or 'unknown'
+
+
+def metric_scope(scope: str) -> str:
+    """Etiqueta `extractor` de las métricas: YouTube y los dominios directos conocidos (lista acotada
+    por configuración) conservan su nombre; cualquier otro sitio va a 'generic' para no crear una
+    serie temporal por cada dominio que envíe un usuario."""
+    if scope == 'youtube':
+        return scope
+    for domain in RESOLVE_DIRECT_DOMAINS:
+        if scope == domain or scope.endswith('.' + domain):
+            return domain
+    return 'generic'
+
+
+class StrategyScheduler:
+    """Ordena estrategias por tasa de éxito/latencia en una ventana deslizante, con backoff y sondeo."""
+
+    def __init__(self, window: int, probe_interval: int, backoff_base: float, backoff_max: float):
+        self.window = window
+        self.probe_interval = probe_interval
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._attempts = {}  # {(scope, name): deque[(ok, latency)]}
+        self._failures = {}  # {(scope, name): fallos consecutivos}
+        self._backoff = {}   # {(scope, name): timestamp hasta el que está degradada}
+        self._calls = {}     # {scope: nº de veces que se ha pedido un orden}
+        self._lock = threading.Lock()
+
+    def order(self, scope: str, names: List[str]) -> List[str]:
+        """Devuelve `names` reordenado: mejores primero, degradadas al final (nunca se descartan).
+
+        Cuenta como un intento del scope (puede tocar sondeo): quien lo llame debe registrar
+        el resultado con record(). Para sólo consultar el orden, ranking().
+        """
+        with self._lock:
+            self._calls[scope] = self._calls.get(scope, 0) + 1
+            ordered, demoted = self._rank(scope, names)
+
+            # Sondeo periódico: una estrategia degradada pasa al frente para comprobar si se recuperó
+            if demoted and self.probe_interval > 0 and self._calls[scope] % self.probe_interval == 0:
+                probe = min(demoted, key=lambda d: self._backoff.get((scope, d[2]), 0))[2]
+                ordered.remove(probe)
+                ordered.insert(0, probe)
+                print(f"[INFO] Sondeando estrategia degradada '{probe}' en {scope}")
+            return ordered
+
+    def ranking(self, scope: str, names: List[str]) -> List[str]:
+        """El orden actual, sin sondeo ni efectos: para quien no va a registrar el resultado."""
+        with self._lock:
+            return self._rank(scope, names)[0]
+
+    def record(self, scope: str, name: str, ok: bool, latency: float):
+        key = (scope, name)
+        with self._lock:
+            attempts = self._attempts.get(key)
+            if attempts is None:
+                attempts = self._attempts[key] = deque(maxlen=self.window)
+            attempts.append((ok, latency))
+            if ok:
+                self._failures[key] = 0
+                self._backoff.pop(key, None)
+                return
+            failures = self._failures.get(key, 0) + 1
+            self._failures[key] = failures
+            if failures >= STRATEGY_FAILURES_TO_DEMOTE:
+                delay = min(self.backoff_base * 2 ** (failures - STRATEGY_FAILURES_TO_DEMOTE), self.backoff_max)
+                self._backoff[key] = time.time() + delay
+
+    def snapshot(self) -> dict:
+        now = time.time()
+        with self._lock:
+            result = {}
+            for (scope, name), attempts in self._attempts.items():
+                latencies = [lat for _, lat in attempts]
+                result.setdefault(scope, {})[name] = {
+                    'attempts': len(attempts),
+                    'success_rate': round(sum(1 for ok, _ in attempts if ok) / len(attempts), 3),
+                    'avg_latency': round(sum(latencies) / len(latencies), 3),
+                    'consecutive_failures': self._failures.get((scope, name), 0),
+                    'backoff_remaining': max(0, round(self._backoff.get((scope, name), 0) - now, 1)),
+                }
+            return result
+
+    def _rank(self, scope: str, names: List[str]):
+        # Con el lock tomado. Devuelve (orden completo, degradadas como (-score, idx, name))
+        now = time.time()
+        healthy, demoted = [], []
+        for idx, name in enumerate(names):
+            key = (scope, name)
+            bucket = demoted if self._backoff.get(key, 0) > now else healthy
+            bucket.append((-self._score(key), idx, name))
+        healthy.sort()
+        demoted.sort()
+        return [n for _, _, n in healthy] + [n for _, _, n in demoted], demoted
+
+    def _score(self, key) -> float:
+        # Orden óptimo para una búsqueda secuencial: mayor P(éxito) / coste esperado del intento
+        attempts = self._attempts.get(key)
+        if not attempts:
+            return 0.5 / STRATEGY_PRIOR_LATENCY
+        successes = sum(1 for ok, _ in attempts if ok)
+        p_success = (successes + 1) / (len(attempts) + 2)
+        cost = sum(lat for _, lat in attempts) / len(attempts)
+        return p_success / max(cost, 0.05)
+
+
+strategy_scheduler = StrategyScheduler(
+    window=STRATEGY_WINDOW,
+    probe_interval=STRATEGY_PROBE_INTERVAL,
+    backoff_base=STRATEGY_BACKOFF_BASE,
+    backoff_max=STRATEGY_BACKOFF_MAX,
+)
+
+# --- FIN PLANIFICADOR DE ESTRATEGIAS ---
+
+
+# --- EXTRACCIÓN CONCURRENTE (HEDGING) ---
+# Límite global de extract_info simultáneos, para que el hedging no sature el host ni dispare
+# los rate limits de YouTube. Aplica también al modo secuencial.
+YTDLP_MAX_CONCURRENT_EXTRACTIONS = int(os.environ.get('YTDLP_MAX_CONCURRENT_EXTRACTIONS', 4))
+# Modo hedged opcional (también activable por petición con ?hedged=true)
+ANALYZE_HEDGED = os.environ.get('ANALYZE_HEDGED', 'false').lower() == 'true'
+ANALYZE_HEDGE_FANOUT = max(1, int(os.environ.get('ANALYZE_HEDGE_FANOUT', 3)))   # estrategias en vuelo a la vez
+ANALYZE_HEDGE_DELAY = float(os.environ.get('ANALYZE_HEDGE_DELAY', 0))           # 0 = todas a la vez; >0 = escalonar (s)
+
+_extraction_slots = threading.BoundedSemaphore(YTDLP_MAX_CONCURRENT_EXTRACTIONS)
+_hedge_executor = ThreadPoolExecutor(
+    max_workers=YTDLP_MAX_CONCURRENT_EXTRACTIONS * 2, thread_name_prefix='hedge'
+)
+
+
+def _strategy_summary(ydl_opts: dict) -> dict:
+    """Cliente y uso de cookies de una estrategia, tal como se devuelve al frontend."""
+    client = ydl_opts.get('extractor_args', {}).get('youtube', {}).get('player_client', ['auto'])
+    return {"client": client, "cookies": 'cookiefile' in ydl_opts}
+
+
+def _is_dns_error(error_str: str) -> bool:
+    return 'NameResolutionError' in error_str or 'Failed to resolve' in error_str or 'No address associated' in error_str
+
+
+def _unreachable_domain(url: str) -> HTTPException:
+    domain = urlparse(url).netloc
+    return HTTPException(
+        status_code=503,
+        detail=f"El servidor no puede conectarse a '{domain}'. Este dominio puede estar bloqueado."
+    )
+
+
+def _run_strategy(scope: str, name: str, ydl_opts: dict, target_url: str,
+                  cancelled: Optional[threading.Event] = None):
+    """Un intento de extract_info dentro del límite global; registra el resultado en el planificador."""
+    with _extraction_slots:
+        # Si otra estrategia ganó mientras esperábamos turno, no gastar una extracción
+        if cancelled is not None and cancelled.is_set():
+            return None
+        started = time.monotonic()
+        try:
+            with ydl_pool.lease(ydl_opts) as ydl:
+                info = ydl.extract_info(target_url, download=False)
+        except Exception:
+            elapsed = time.monotonic() - started
+            strategy_scheduler.record(scope, name, False, elapsed)
+            observe_span(ANALYZE_ATTEMPT_SECONDS, elapsed, extractor=metric_scope(scope), strategy=name,
+                         outcome='error')
+            raise
+    elapsed = time.monotonic() - started
+    strategy_scheduler.record(scope, name, bool(info), elapsed)
+    observe_span(ANALYZE_ATTEMPT_SECONDS, elapsed, extractor=metric_scope(scope), strategy=name,
+                 outcome='ok' if info else 'empty')
+    return info
+
+
+def _hedged_extract(scope: str, strategies: dict, ordered: List[str], target_url: str, cache_key: str):
+    """Lanza hasta ANALYZE_HEDGE_FANOUT estrategias a la vez y devuelve (nombre, info, None) de la primera
+    con éxito, o (None, None, error) con el error más grave si ninguna lo consigue."""
+    cancelled = threading.Event()
+    worst_error = None
+    waiting = list(ordered)
+    pending = {}  # {future: nombre}
+
+    def launch():
+        name = waiting.pop(0)
+        summary = _strategy_summary(strategies[name])
+        print(f"[INFO] Hedge: lanzando {name} (cliente={summary['client']}, cookies={summary['cookies']})")
+        future = _hedge_executor.submit(_run_strategy, scope, name, strategies[name], target_url, cancelled)
+        pending[future] = name
+
+    try:
+        launch()
+        while pending:
+            can_hedge = bool(waiting) and len(pending) < ANALYZE_HEDGE_FANOUT
+            if can_hedge and ANALYZE_HEDGE_DELAY <= 0:
+                launch()
+                continue
+            done, _ = wait(list(pending), timeout=ANALYZE_HEDGE_DELAY if can_hedge else None,
+                           return_when=FIRST_COMPLETED)
+            if not done:
+                # Nadie respondió dentro del hedge delay: lanzar la siguiente estrategia
+                launch()
+                continue
+            for future in done:
+                name = pending.pop(future)
+                try:
+                    info = future.result()
+                except Exception as e:
+                    error_str = str(e)
+                    print(f"[WARN] Hedge: {name} falló: {error_str[:200]}")
+                    if _is_dns_error(error_str):
+                        raise source_failure(target_url, error_str, cache_key)
+                    # Un 403/429 de una estrategia pesa más que el "vacío" de otra: es lo que ve el breaker
+                    if worst_error is None or _failure_severity(error_str) >= _failure_severity(worst_error):
+                        worst_error = error_str
+                    info = None
+                if info:
+                    print(f"[INFO] ✅ Hedge: éxito con estrategia {name}")
+                    return name, info, None
+                # Reemplazar el intento fallido sin esperar al hedge delay
+                if waiting and len(pending) < ANALYZE_HEDGE_FANOUT:
+                    launch()
+        return None, None, worst_error
+    finally:
+        # Las que no empezaron se cancelan; las que ya corren se abandonan (yt-dlp no se puede interrumpir)
+        cancelled.set()
+        for future in pending:
+            future.cancel()
+
+# --- FIN EXTRACCIÓN CONCURRENTE ---
+
+
+# --- CACHÉ NEGATIVA Y CIRCUIT BREAKER POR DOMINIO ---
+# Un video que no existe o un dominio bloqueado cuesta la resolución más todas las estrategias
+# antes de dar el 404/503, y se repite en cada petición. Los fallos se clasifican por su mensaje:
+#   - dns / rate_limited / forbidden: problema del dominio -> cuentan para su circuit breaker.
+#     Con BREAKER_FAILURES seguidos (o un fallo de DNS) se abre: las peticiones fallan al momento
+#     durante BREAKER_OPEN_SECONDS (doblando en cada reapertura); después deja pasar una sola de
+#     prueba (half-open) que lo cierra si va bien o lo vuelve a abrir si falla.
+#   - unavailable / empty: problema del video -> sólo caché negativa de la URL.
+# Cada clase de fallo tiene su TTL en la caché negativa (NEGATIVE_TTL_<CLASE>).
+NEGATIVE_TTLS = {
+    'dns': int(os.environ.get('NEGATIVE_TTL_DNS', 120)),
+    'rate_limited': int(os.environ.get('NEGATIVE_TTL_RATE_LIMITED', 60)),
+    'forbidden': int(os.environ.get('NEGATIVE_TTL_FORBIDDEN', 60)),
+    'unavailable': int(os.environ.get('NEGATIVE_TTL_UNAVAILABLE', 600)),   # privado, eliminado, geobloqueado
+    'empty': int(os.environ.get('NEGATIVE_TTL_EMPTY', 60)),                # ninguna estrategia devolvió info
+}
+NEGATIVE_CACHE_MAX_ENTRIES = int(os.environ.get('NEGATIVE_CACHE_MAX_ENTRIES', 2048))
+BREAKER_FAILURES = int(os.environ.get('BREAKER_FAILURES', 5))
+BREAKER_OPEN_SECONDS = float(os.environ.get('BREAKER_OPEN_SECONDS', 30))
+BREAKER_OPEN_MAX = float(os.environ.get('BREAKER_OPEN_MAX', 600))
+BREAKER_PROBE_TIMEOUT = float(os.environ.get('BREAKER_PROBE_TIMEOUT', 120))   # sonda que nunca informó
+
+_DOMAIN_FAILURES = ('dns', 'rate_limited', 'forbidden')
+_UNAVAILABLE_MARKERS = ('video unavailable', 'private video', 'has been removed', 'no longer available',
+                        'not available in your country', 'http error 404', 'unsupported url')
+
+
+def classify_failure(error_str: Optional[str]) -> str:
+    """Clase de un fallo de extracción/descarga a partir de su mensaje (yt-dlp o aiohttp)."""
+    if not error_str:
+        return 'empty'
+    if _is_dns_error(error_str):
+        return 'dns'
+    lowered = error_str.lower()
+    if 'http error 429' in lowered or 'too many requests' in lowered:
+        return 'rate_limited'
+    if 'http error 403' in lowered:
+        return 'forbidden'
+    if any(marker in lowered for marker in _UNAVAILABLE_MARKERS):
+        return 'unavailable'
+    return 'empty'
+
+
+_FAILURE_SEVERITY = ('empty', 'unavailable', 'forbidden', 'rate_limited', 'dns')
+
+
+def _failure_severity(error_str: Optional[str]) -> int:
+    """Orden entre clases de fallo: los del dominio (breaker) por encima de los del video."""
+    return _FAILURE_SEVERITY.index(classify_failure(error_str))
+
+
+class NegativeCache:
+    """URL canónica -> respuesta de error, con un TTL según la clase de fallo."""
+
+    def __init__(self, ttls: dict, max_entries: int):
+        self.ttls = ttls
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # {clave: (expires_at, kind, status, detail)}
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'stored': 0}
+
+    def get(self, key: str) -> Optional[Tuple[str, int, str, float]]:
+        """(clase, status, detalle, segundos restantes) si la URL falló hace poco."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= now:
+                del self._entries[key]
+                return None
+            self.stats['hits'] += 1
+            return entry[1], entry[2], entry[3], entry[0] - now
+
+    def set(self, key: str, kind: str, status: int, detail: str):
+        ttl = self.ttls.get(kind, 0)
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + ttl, kind, status, detail)
+            self.stats['stored'] += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def snapshot(self) -> dict:
+        now = time.time()
+        with self._lock:
+            kinds = {}
+            for expires_at, kind, _, _ in self._entries.values():
+                if expires_at > now:
+                    kinds[kind] = kinds.get(kind, 0) + 1
+            return {**self.stats, 'entries': kinds, 'ttls': self.ttls}
+
+
+class DomainBreaker:
+    """Circuit breaker por dominio (closed / open / half-open) para fallos del propio dominio."""
+
+    def __init__(self, threshold: int, open_seconds: float, open_max: float, probe_timeout: float):
+        self.threshold = threshold
+        self.open_seconds = open_seconds
+        self.open_max = open_max
+        self.probe_timeout = probe_timeout
+        self._domains = {}  # {dominio: {'failures', 'open_until', 'cooldown', 'probe_at', 'last_kind'}}
+        self._lock = threading.Lock()
+        self.stats = {'rejected': 0, 'opened': 0, 'closed': 0}
+
+    def allow(self, domain: str) -> Optional[float]:
+        """None si la petición puede pasar; si no, los segundos hasta el próximo intento."""
+        now = time.monotonic()
+        with self._lock:
+            state = self._domains.get(domain)
+            if state is None or state['open_until'] is None:
+                return None
+            if now < state['open_until']:
+                self.stats['rejected'] += 1
+                return state['open_until'] - now
+            # half-open: una sola petición de prueba a la vez
+            if state['probe_at'] is not None and now - state['probe_at'] < self.probe_timeout:
+                self.stats['rejected'] += 1
+                return 1.0
+            state['probe_at'] = now
+            print(f"[INFO] Circuit breaker de {domain}: half-open, dejando pasar una petición de prueba")
+            return None
+
+    def release_probe(self, domain: str):
+        """La petición que pasó allow() no llegó a contactar con el dominio: otra puede probar."""
+        with self._lock:
+            state = self._domains.get(domain)
+            if state is not None:
+                state['probe_at'] = None
+
+    def record(self, domain: str, kind: Optional[str]):
+        """kind=None: el dominio respondió. Una clase de _DOMAIN_FAILURES: fallo del dominio.
+
+        Cualquier otra clase (video no disponible...) no cambia el estado, sólo libera la sonda.
+        """
+        now = time.monotonic()
+        with self._lock:
+            state = self._domains.get(domain)
+            if kind is None:
+                if state is not None:
+                    if state['open_until'] is not None:
+                        self.stats['closed'] += 1
+                        print(f"[INFO] Circuit breaker de {domain}: cerrado")
+                    del self._domains[domain]
+                return
+            if kind not in _DOMAIN_FAILURES:
+                if state is not None:
+                    state['probe_at'] = None
+                return
+            if state is None:
+                state = self._domains[domain] = {
+                    'failures': 0, 'open_until': None, 'cooldown': 0.0, 'probe_at': None, 'last_kind': kind
+                }
+            state['failures'] += 1
+            state['last_kind'] = kind
+            half_open = state['open_until'] is not None
+            if half_open or state['failures'] >= self.threshold or kind == 'dns':
+                # Cada reapertura seguida dobla la espera, hasta open_max
+                state['cooldown'] = min(self.open_max, state['cooldown'] * 2 if half_open else self.open_seconds)
+                state['open_until'] = now + state['cooldown']
+                state['probe_at'] = None
+                self.stats['opened'] += 1
+                print(f"[WARN] Circuit breaker de {domain}: abierto {state['cooldown']:.0f}s ({kind})")
+
+    def snapshot(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            domains = {}
+            for domain, state in self._domains.items():
+                if state['open_until'] is None:
+                    status = 'closed'
+                elif now < state['open_until']:
+                    status = 'open'
+                else:
+                    status = 'half-open'
+                domains[domain] = {
+                    'state': status,
+                    'failures': state['failures'],
+                    'last_failure': state['last_kind'],
+                    'retry_in': round(max(0.0, state['open_until'] - now), 1) if state['open_until'] else None,
+                }
+            return {**self.stats, 'domains': domains}
+
+
+negative_cache = NegativeCache(NEGATIVE_TTLS, NEGATIVE_CACHE_MAX_ENTRIES)
+domain_breaker = DomainBreaker(BREAKER_FAILURES, BREAKER_OPEN_SECONDS, BREAKER_OPEN_MAX, BREAKER_PROBE_TIMEOUT)
+
+
+def check_source(url: str, cache_key: Optional[str] = None):
+    """Falla al momento si la URL falló hace poco o su dominio tiene el breaker abierto."""
+    if cache_key is not None:
+        cached = negative_cache.get(cache_key)
+        if cached is not None:
+            kind, status, detail, remaining = cached
+            FAST_FAILS.inc(reason='negative_cache')
+            raise HTTPException(status_code=status, detail=detail, headers={'Retry-After': str(int(remaining) + 1)})
+    scope = strategy_scope(url)
+    retry_in = domain_breaker.allow(scope)
+    if retry_in is not None:
+        FAST_FAILS.inc(reason='breaker_open')
+        raise HTTPException(
+            status_code=503, headers={'Retry-After': str(int(retry_in) + 1)},
+            detail=f"'{urlparse(url).hostname or scope}' está fallando ahora mismo. Inténtalo de nuevo en {int(retry_in) + 1}s."
+        )
+
+
+def source_failure(url: str, error_str: Optional[str], cache_key: Optional[str] = None) -> HTTPException:
+    """Registra el fallo (breaker y, con cache_key, caché negativa) y devuelve la respuesta de error."""
+    kind = classify_failure(error_str)
+    domain_breaker.record(strategy_scope(url), kind)
+    if kind == 'dns':
+        error = _unreachable_domain(url)
+    elif kind == 'rate_limited':
+        error = HTTPException(status_code=503, detail=f"'{urlparse(url).hostname}' está limitando las peticiones. Inténtalo más tarde.")
+    elif kind == 'unavailable':
+        error = HTTPException(status_code=404, detail="El video no está disponible (privado, eliminado o restringido).")
+    else:
+        error = HTTPException(status_code=404, detail="No se pudo extraer información del video.")
+    if cache_key is not None:
+        negative_cache.set(cache_key, kind, error.status_code, error.detail)
+    return error
+
+
+@app.get("/sources/stats")
+def sources_stats():
+    """Caché negativa por clase de fallo y estado del circuit breaker de cada dominio."""
+    return {'negative_cache': negative_cache.snapshot(), 'breakers': domain_breaker.snapshot()}
+
+# --- FIN CACHÉ NEGATIVA Y CIRCUIT BREAKER ---
+
+
+# Función de limpieza
+def cleanup_file(path: Path):
+    try:
+        if path.exists():
+            os.remove(path)
+            print(f"Archivo eliminado: {path}")
+    except Exception as e:
+        print(f"Error al eliminar archivo {path}: {e}")
+
+def format_size(size_bytes):
+    if size_bytes is None:
+        return "N/A"
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if size_bytes < 1024:
+            return f"{size_bytes:.1f} {unit}"
+        size_bytes /= 1024
+    return f"{size_bytes:.1f} TB"
+
+
+# --- TABLA DE FORMATOS (/analyze) ---
+# Una sola pasada sobre los formatos de yt-dlp: elige el mejor audio, deduplica los videos por
+# (altura, códec) y estima tamaños. Los manifiestos DASH/HLS de directos traen cientos de formatos.
+
+def _codec_label(vcodec: str) -> str:
+    # Simplificar codec para mostrar al usuario
+    if "avc1" in vcodec or "h264" in vcodec:
+        return "H.264"
+    if "vp9" in vcodec:
+        return "VP9"
+    if "av01" in vcodec:
+        return "AV1"
+    return "MP4"
+
+
+class FormatEntry:
+    """Formato de video candidato (el mejor visto para su altura y códec)."""
+    __slots__ = ('format_id', 'height', 'tbr', 'codec', 'size', 'is_estimate', 'streamable', 'has_audio', 'rank')
+
+    def __init__(self, f: dict, height: int, codec: str, rank: tuple, duration: Optional[float]):
+        self.format_id = f.get('format_id')
+        self.height = height
+        self.tbr = f.get('tbr') or 0
+        self.codec = codec
+        self.rank = rank
+        self.streamable = _is_streamable(f)
+        self.has_audio = f.get('acodec', 'none') != 'none'
+
+        # Prioridad: filesize (exacto) > calculado por bitrate (más preciso que approx) > filesize_approx
+        self.size = f.get('filesize')
+        self.is_estimate = False
+        if not self.size:
+            # TBR = Total Bitrate en kbits/s -> bytes/s: (tbr * 1000) / 8
+            tbr = f.get('tbr') or f.get('vbr')
+            if tbr and duration:
+                self.size = (tbr * 1000 / 8) * duration
+                self.is_estimate = True
+        if not self.size:
+            self.size = f.get('filesize_approx')
+            self.is_estimate = True
+        self.size = self.size or 0
+
+    def to_dict(self, audio_size: float, audio_streamable: bool) -> dict:
+        # El audio m4a se descarga siempre junto al video
+        total_size = self.size + audio_size
+        # Las estimaciones (approx o bitrate) suelen quedarse cortas frente al MP4 final (muxed):
+        # se aplica un factor conservador y se marca con "~"
+        if self.is_estimate and total_size > 0:
+            size_str = f"~{format_size(total_size * 1.5)}"
+        else:
+            size_str = format_size(total_size) if total_size > 0 else "N/A"
+
+        resolution_key = f"{self.height}p"
+        return {
+            "format_id": self.format_id,
+            "extension": "mp4",
+            "resolution": resolution_key,
+            "filesize_str": size_str,
+            "label": f"{resolution_key} ({self.codec})",
+            "is_video": True,
+            "height": self.height,  # Guardamos height para ordenar mejor
+            "tbr": self.tbr,        # Guardamos bitrate para ordenar mejor
+            # Se puede entregar por pipe mientras FFmpeg la produce (sin archivo temporal)
+            "streamable": self.streamable and (self.has_audio or audio_streamable) and _offer_stream(total_size),
+        }
+
+
+def build_format_table(raw_formats: List[dict], duration: Optional[float] = None) -> Tuple[List[dict], List[dict]]:
+    """Devuelve (videos deduplicados por altura y códec, mejor calidad primero; opciones de audio)."""
+    best_videos = {}  # {(height, codec): FormatEntry}
+    best_audio = best_m4a = best_opus = None
+    best_audio_rank = best_m4a_rank = best_opus_rank = None
+
+    for f in raw_formats:
+        if not f:
+            continue
+        rank = (f.get('height') or 0, f.get('tbr') or 0, f.get('filesize') or 0)
+
+        if f.get('vcodec') == 'none':
+            if best_audio is None or rank > best_audio_rank:
+                best_audio, best_audio_rank = f, rank
+            if f.get('ext') == 'm4a' and (best_m4a is None or rank > best_m4a_rank):
+                best_m4a, best_m4a_rank = f, rank
+            if (f.get('acodec') or '').startswith('opus') and (best_opus is None or rank > best_opus_rank):
+                best_opus, best_opus_rank = f, rank
+            continue
+
+        vcodec = f.get('vcodec', 'none')
+        height = f.get('height')
+        if vcodec == 'none' or not height:
+            continue
+        key = (height, _codec_label(vcodec or ''))
+        current = best_videos.get(key)
+        if current is None or rank > current.rank:
+            best_videos[key] = FormatEntry(f, height, key[1], rank, duration)
+
+    # Audio que acompaña al video: mejor m4a, o el mejor audio disponible
+    audio_for_video = best_m4a or best_audio
+    audio_size = 0
+    if audio_for_video:
+        audio_size = audio_for_video.get('filesize') or audio_for_video.get('filesize_approx') or 0
+    audio_streamable = _is_streamable(audio_for_video)
+
+    # Ordenar videos por altura (resolución) DESC, luego por bitrate (tbr) DESC
+    entries = sorted(best_videos.values(), key=lambda e: (e.height, e.tbr), reverse=True)
+    videos = [e.to_dict(audio_size, audio_streamable) for e in entries]
+
+    # Opciones de audio: MP3 por niveles (recodificado) y, si existen, los originales sin recodificar
+    audios = []
+    originals = {'m4a': best_m4a, 'opus': best_opus}
+    for format_id, preset in AUDIO_PRESETS.items():
+        source = best_audio if preset['codec'] != 'copy' else originals.get(preset['ext'])
+        if source is None and preset['codec'] == 'copy':
+            continue
+        size_str = "N/A"
+        size = 0
+        if preset['codec'] != 'copy' and duration:
+            # Tamaño del MP3 por bitrate objetivo
+            size = int(preset['bitrate'][:-1]) * 1000 / 8 * duration
+            size_str = f"~{format_size(size)}"
+        elif source:
+            size_str = format_size(source.get('filesize') or source.get('filesize_approx'))
+        audios.append({
+            "format_id": format_id,
+            "extension": preset['ext'],
+            "resolution": preset['resolution'],
+            "filesize_str": size_str,
+            "label": f"Audio Only - {preset['ext'].upper()}",
+            "is_video": False,
+            "streamable": preset['codec'] != 'copy' and _is_streamable(source) and _offer_stream(size),
+        })
+    return videos, audios
+
+# --- FIN TABLA DE FORMATOS ---
+
+
+# --- MINIATURAS: PROXY CON CACHÉ EN DISCO ---
+# /analyze devuelve, además de la URL original de la miniatura, /thumb/{key}. La imagen se
+# descarga una sola vez (en segundo plano, mientras el cliente recibe el análisis), se guarda
+# junto a sus variantes ya redimensionadas (WebP o JPEG según Accept) y se sirve desde aquí
+# con ETag fuerte. Pillow es opcional: sin él se sirve la imagen original tal cual.
+THUMB_DIR = DOWNLOAD_DIR / "thumbs"
+THUMB_CACHE_MAX_BYTES = int(os.environ.get('THUMB_CACHE_MAX_BYTES', 64 * 1024 ** 2))
+THUMB_MAX_SOURCE_BYTES = int(os.environ.get('THUMB_MAX_SOURCE_BYTES', 5 * 1024 ** 2))
+THUMB_WIDTHS = tuple(sorted(int(w) for w in os.environ.get('THUMB_WIDTHS', '320,640').split(',') if w.strip()))
+THUMB_QUALITY = int(os.environ.get('THUMB_QUALITY', 80))
+THUMB_FETCH_TIMEOUT = float(os.environ.get('THUMB_FETCH_TIMEOUT', 10))
+THUMB_RETRY_AFTER = float(os.environ.get('THUMB_RETRY_AFTER', 60))      # s sin reintentar un origen que falló
+THUMB_BROWSER_MAX_AGE = int(os.environ.get('THUMB_BROWSER_MAX_AGE', 7 * 86400))
+THUMB_MAX_KNOWN = 5000  # claves registradas (key -> URL de origen) que aún no se han descargado
+
+_THUMB_FORMATS = {'webp': ('WEBP', 'image/webp', 'webp'), 'jpeg': ('JPEG', 'image/jpeg', 'jpg')}
+_THUMB_KEY_RE = re.compile(r'[0-9a-f]{24}')
+
+_pil_image = None  # False = Pillow no está instalado
+
+
+def _pillow():
+    """PIL.Image si Pillow está instalado; None si no (se sirven las originales)."""
+    global _pil_image
+    if _pil_image is None:
+        try:
+            from PIL import Image
+            _pil_image = Image
+        except ImportError:
+            print("[WARN] Pillow no está instalado: las miniaturas se sirven sin redimensionar")
+            _pil_image = False
+    return _pil_image or None
+
+
+def thumb_width(requested: Optional[int]) -> int:
+    """El ancho pre-generado más pequeño que cubre el pedido (el mayor si ninguno llega)."""
+    if requested:
+        for width in THUMB_WIDTHS:
+            if width >= requested:
+                return width
+    return THUMB_WIDTHS[-1]
+
+
+class ThumbCache:
+    """Miniaturas en disco por clave (hash de la URL de origen), con desalojo LRU por tamaño.
+
+    Por clave: {key}.src (la original), {key}.json (URL y tipo) y {key}-{ancho}.{webp|jpg}.
+    Se desaloja la clave entera (original y variantes) de la menos usada a la más usada.
+    """
+
+    def __init__(self, root: Path, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._entries = OrderedDict()  # {key: {'files': {nombre: bytes}, 'etags': {nombre: etag}}}
+        self._urls = OrderedDict()     # {key: URL de origen}
+        self._failed = {}              # {key: monotonic del último fallo}
+        self._bytes = 0
+        self._inflight = {}            # {key: asyncio.Future}; sólo se toca desde el event loop
+        self._tasks = set()
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'fetches': 0, 'fetch_errors': 0, 'renders': 0, 'evictions': 0}
+        self._load()
+
+    @staticmethod
+    def key_for(url: str) -> str:
+        return hashlib.sha256(url.encode('utf-8')).hexdigest()[:24]
+
+    def register(self, url: Optional[str]) -> Optional[str]:
+        """Apunta la URL de origen y devuelve su clave (None si no es una URL http(s))."""
+        if not url or urlparse(url).scheme not in ('http', 'https'):
+            return None
+        key = self.key_for(url)
+        with self._lock:
+            self._urls[key] = url
+            self._urls.move_to_end(key)
+            while len(self._urls) > THUMB_MAX_KNOWN:
+                self._urls.popitem(last=False)
+        return key
+
+    def origin_url(self, key: str) -> Optional[str]:
+        with self._lock:
+            url = self._urls.get(key)
+        if url is None:
+            try:
+                url = json.loads((self.root / f"{key}.json").read_text(encoding='utf-8')).get('url')
+            except (OSError, ValueError):
+                pass
+        return url
+
+    def prefetch(self, key: str):
+        """Descarga la miniatura en segundo plano (llamar desde el event loop)."""
+        task = asyncio.get_running_loop().create_task(self.ensure(key))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def ensure(self, key: str) -> bool:
+        """True si la original está en disco, descargándola si hace falta (una vez por clave)."""
+        with self._lock:
+            if key in self._entries and f"{key}.src" in self._entries[key]['files']:
+                return True
+            failed_at = self._failed.get(key)
+        if failed_at is not None and time.monotonic() - failed_at < THUMB_RETRY_AFTER:
+            return False
+        if key in self._inflight:
+            return await asyncio.shield(self._inflight[key])
+        url = self.origin_url(key)
+        if url is None:
+            return False
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        ok = False
+        try:
+            ok = await self._fetch(key, url)
+        except Exception as e:
+            print(f"[WARN] Miniatura {key}: {e}")
+        finally:
+            self._inflight.pop(key, None)
+            future.set_result(ok)
+            with self._lock:
+                if ok:
+                    self._failed.pop(key, None)
+                else:
+                    self.stats['fetch_errors'] += 1
+                    self._failed[key] = time.monotonic()
+        return ok
+
+    async def _fetch(self, key: str, url: str) -> bool:
+        session = await get_http_session()
+        self.stats['fetches'] += 1
+        async with session.get(url, timeout=aiohttp.ClientTimeout(total=THUMB_FETCH_TIMEOUT)) as response:
+            content_type = response.headers.get('Content-Type', '').split(';')[0].strip()
+            if response.status != 200 or not content_type.startswith('image/'):
+                print(f"[WARN] Miniatura {key}: HTTP {response.status} ({content_type or 'sin tipo'})")
+                return False
+            body = bytearray()
+            async for chunk in response.content.iter_chunked(64 * 1024):
+                body.extend(chunk)
+                if len(body) > THUMB_MAX_SOURCE_BYTES:
+                    print(f"[WARN] Miniatura {key}: más de {format_size(THUMB_MAX_SOURCE_BYTES)}, descartada")
+                    return False
+        # Escribir y pre-generar las variantes no debe ocupar el event loop
+        await run_in_threadpool(self._store, key, url, bytes(body), content_type)
+        return True
+
+    def variant(self, key: str, width: int, fmt: str) -> Tuple[bytes, str, str]:
+        """(contenido, tipo, ETag) de la variante pedida, generándola si aún no existe."""
+        image_format, content_type, ext = _THUMB_FORMATS[fmt]
+        name = f"{key}-{width}.{ext}"
+        with self._lock:
+            raw = self._entries.get(key, {}).get('raw')
+        if raw or _pillow() is None:
+            name, content_type = f"{key}.src", self._source_type(key)
+        path = self.root / name
+        if not path.exists():
+            with self._lock:
+                self.stats['misses'] += 1
+            if not self._render(key, width, image_format, path):
+                name, content_type = f"{key}.src", self._source_type(key)
+                path = self.root / name
+        else:
+            with self._lock:
+                self.stats['hits'] += 1
+        body = path.read_bytes()
+        with self._lock:
+            entry = self._entries.get(key)
+            etag = entry['etags'].get(name) if entry else None
+            if etag is None:
+                etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+                if entry:
+                    entry['etags'][name] = etag
+            if entry:
+                self._entries.move_to_end(key)
+        return body, content_type, etag
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'known_urls': len(self._urls),
+                'widths': list(THUMB_WIDTHS),
+                'pillow': _pillow() is not None,
+                **self.stats,
+            }
+
+    # --- internos ---
+
+    def _store(self, key: str, url: str, body: bytes, content_type: str):
+        self._write(key, f"{key}.json", json.dumps({'url': url, 'content_type': content_type}).encode('utf-8'))
+        self._write(key, f"{key}.src", body)
+        if _pillow() is None:
+            return
+        for width in THUMB_WIDTHS:
+            for image_format, _, ext in _THUMB_FORMATS.values():
+                if not self._render(key, width, image_format, self.root / f"{key}-{width}.{ext}"):
+                    return
+
+    def _source_type(self, key: str) -> str:
+        try:
+            meta = json.loads((self.root / f"{key}.json").read_text(encoding='utf-8'))
+            return meta.get('content_type') or 'image/jpeg'
+        except (OSError, ValueError):
+            return 'image/jpeg'
+
+    def _render(self, key: str, width: int, image_format: str, dest: Path) -> bool:
+        """Redimensiona la original (sólo hacia abajo, manteniendo la proporción) a `dest`."""
+        Image = _pillow()
+        try:
+            with Image.open(self.root / f"{key}.src") as img:
+                img.draft('RGB', (width, width))   # JPEG: decodificar ya reducida
+                has_alpha = img.mode in ('RGBA', 'LA') or 'transparency' in img.info
+                img = img.convert('RGBA' if has_alpha and image_format == 'WEBP' else 'RGB')
+                img.thumbnail((width, width * 4))
+                out = io.BytesIO()
+                img.save(out, image_format, quality=THUMB_QUALITY)
+        except Exception as e:
+            # Pillow no la entiende: se servirá la original sin volver a intentarlo
+            print(f"[WARN] Miniatura {key}: no se pudo generar {dest.name}: {e}")
+            with self._lock:
+                if key in self._entries:
+                    self._entries[key]['raw'] = True
+            return False
+        self._write(key, dest.name, out.getvalue())
+        with self._lock:
+            self.stats['renders'] += 1
+        return True
+
+    def _write(self, key: str, name: str, data: bytes):
+        tmp = self.root / f"{name}.tmp"
+        tmp.write_bytes(data)
+        os.replace(tmp, self.root / name)
+        with self._lock:
+            entry = self._entries.setdefault(key, {'files': {}, 'etags': {}})
+            self._bytes += len(data) - entry['files'].get(name, 0)
+            entry['files'][name] = len(data)
+            entry['etags'].pop(name, None)
+            self._entries.move_to_end(key)
+            self._evict(keep=key)
+
+    def _load(self):
+        # Recuperar las miniaturas de una ejecución anterior, en orden de uso
+        for path in sorted(self.root.iterdir(), key=lambda p: p.stat().st_mtime):
+            if not path.is_file():
+                continue
+            if path.suffix == '.tmp':
+                path.unlink(missing_ok=True)
+                continue
+            key = path.name.split('.')[0].split('-')[0]
+            size = path.stat().st_size
+            entry = self._entries.setdefault(key, {'files': {}, 'etags': {}})
+            entry['files'][path.name] = size
+            self._entries.move_to_end(key)
+            self._bytes += size
+        with self._lock:
+            self._evict()
+
+    def _evict(self, keep: Optional[str] = None):
+        # Con el lock tomado. `keep` es la clave que se está escribiendo: no se desaloja a sí misma
+        for key in list(self._entries):
+            if self._bytes <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            entry = self._entries.pop(key)
+            for name, size in entry['files'].items():
+                self._bytes -= size
+                try:
+                    (self.root / name).unlink()
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    print(f"[WARN] No se pudo borrar {name}: {e}")
+            self.stats['evictions'] += 1
+
+
+thumb_cache = ThumbCache(THUMB_DIR, THUMB_CACHE_MAX_BYTES)
+
+
+def attach_thumb(result: dict) -> dict:
+    """Añade a la respuesta de /analyze la URL de la miniatura cacheada y lanza su descarga."""
+    key = thumb_cache.register(result.get('thumbnail'))
+    if key is None:
+        return result
+    thumb_cache.prefetch(key)
+    return {**result, 'thumb': f"/thumb/{key}"}
+
+
+@app.get("/thumbs/stats")
+def thumbs_stats():
+    """Ocupación y aciertos de la caché de miniaturas."""
+    return thumb_cache.snapshot()
+
+
+@app.get("/thumb/{key}")
+async def get_thumb(key: str, request: Request, w: Optional[int] = None, fmt: Optional[str] = None):
+    """Miniatura desde la caché: WebP si el navegador lo acepta (o fmt=webp|jpeg), al ancho
+    pre-generado más cercano a `w`. Si el origen no responde, redirige a él."""
+    if not _THUMB_KEY_RE.fullmatch(key):
+        raise HTTPException(status_code=404, detail="Miniatura no encontrada")
+    if fmt is None:
+        fmt = 'webp' if 'image/webp' in request.headers.get('accept', '') else 'jpeg'
+    if fmt not in _THUMB_FORMATS:
+        raise HTTPException(status_code=400, detail="fmt debe ser webp o jpeg")
+    try:
+        if not await thumb_cache.ensure(key):
+            raise FileNotFoundError(key)
+        body, content_type, etag = await run_in_threadpool(thumb_cache.variant, key, thumb_width(w), fmt)
+    except FileNotFoundError:
+        url = thumb_cache.origin_url(key)
+        if url is None:
+            raise HTTPException(status_code=404, detail="Miniatura no encontrada")
+        return RedirectResponse(url, status_code=307)
+
+    headers = {
+        'ETag': etag,
+        'Cache-Control': f"public, max-age={THUMB_BROWSER_MAX_AGE}",
+        'Vary': 'Accept',
+    }
+    if etag in [t.strip() for t in request.headers.get('if-none-match', '').split(',')]:
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type=content_type, headers=headers)
+
+# --- FIN MINIATURAS ---
+
+@app.get("/", response_class=HTMLResponse)
+async def read_root(request: Request):
+    return templates.TemplateResponse("index.html", {"request": request})
+
+@app.get("/analyze")
+async def analyze_video(url: str, hedged: bool = False):
+    if not url:
+        raise HTTPException(status_code=400, detail="URL requerida")
+
+    # 0. Caché de análisis (clave canónica: mismo video con distinto tracking = misma entrada)
+    analyze_started = time.monotonic()
+    cache_key = canonicalize_url(url)
+    # Con ANALYZE_CACHE_DB un fallo de memoria lee SQLite: nunca en el event loop
+    cached = await run_in_threadpool(analyze_cache.get, cache_key)
+    if cached is not None:
+        print(f"[INFO] Caché de análisis: HIT para {cache_key}")
+        observe_span(ANALYZE_SECONDS, time.monotonic() - analyze_started, cache='hit', outcome='ok')
+        return attach_thumb({**cached, "original_url": url, "token": info_tokens.token_for(cache_key)})
+
+    # Falla al momento si esta URL falló hace poco o su dominio está caído/bloqueado
+    check_source(url, cache_key)
+
+    # 1. Resolución Agresiva (asíncrona: una página lenta no ocupa un hilo del threadpool)
+    extractor = VideoExtractor(url)
+    target_url = await extractor.aggressive_resolve() or url
+    if strategy_scope(target_url) != strategy_scope(url):
+        # La página respondió y apunta a otro dominio: el breaker que importa es el del reproductor
+        domain_breaker.record(strategy_scope(url), None)
+        check_source(target_url)
+
+    print(f"URL final a analizar: {target_url}")
+
+    # 2. yt-dlp es bloqueante: se ejecuta en el threadpool
+    result = await run_in_threadpool(_analyze_with_ytdlp, url, target_url, cache_key, hedged, analyze_started)
+    # 3. La miniatura se descarga y redimensiona mientras el cliente pinta el resultado
+    return attach_thumb(result)
+
+
+def _analyze_with_ytdlp(url: str, target_url: str, cache_key: str, hedged: bool, analyze_started: float):
+    """Extrae la información con yt-dlp (estrategias) y construye la respuesta de /analyze."""
+    try:
+
+        # Base de opciones - SOLO opciones confiables, sin experimentales
+        base_ydl_opts = {
+            'quiet': True,
+            'no_warnings': True,
+            'noplaylist': True,
+            'extract_flat': False,
+            'nocheckcertificate': True,
+            'geo_bypass': True,
+            'socket_timeout': 30,
+        }
+
+        # Estrategias disponibles, por nombre, en el orden de preferencia por defecto.
+        # El orden real lo decide strategy_scheduler según el historial reciente del dominio.
+        strategies = {}
+
+        if YOUTUBE_COOKIES_FILE:
+            # Estrategia 1: tv_embedded + cookies + check_formats=False (funciona para la mayoría)
+            strategies['tv_embedded'] = {
+                **base_ydl_opts,
+                'ignoreerrors': True,
+                'check_formats': False,
+                'cookiefile': YOUTUBE_COOKIES_FILE,
+                'extractor_args': {'youtube': {'player_client': ['tv_embedded']}},
+            }
+            # Estrategia 2: ios + cookies (cliente app iOS, diferente handshake)
+            strategies['ios'] = {
+                **base_ydl_opts,
+                'ignoreerrors': True,
+                'check_formats': False,
+                'cookiefile': YOUTUBE_COOKIES_FILE,
+                'extractor_args': {'youtube': {'player_client': ['ios']}},
+            }
+            # Estrategia 3: android + cookies
+            strategies['android'] = {
+                **base_ydl_opts,
+                'ignoreerrors': True,
+                'check_formats': False,
+                'cookiefile': YOUTUBE_COOKIES_FILE,
+                'extractor_args': {'youtube': {'player_client': ['android']}},
+            }
+            # Estrategia 4: mweb + cookies (Mobile Web - robusto)
+            strategies['mweb'] = {
+                **base_ydl_opts,
+                'ignoreerrors': True,
+                'check_formats': False,
+                'cookiefile': YOUTUBE_COOKIES_FILE,
+                'extractor_args': {'youtube': {'player_client': ['mweb']}},
+            }
+            # Estrategia 5: web + cookies sin restricciones adicionales
+            strategies['web'] = {
+                **base_ydl_opts,
+                'ignoreerrors': True,
+                'check_formats': False,
+                'cookiefile': YOUTUBE_COOKIES_FILE,
+            }
+
+        # Estrategia final: sin cookies (funciona si el video es público y la IP no está flaggeada)
+        strategies['no_cookies'] = {
+            **base_ydl_opts,
+            'ignoreerrors': False,
+            'check_formats': False,
+        }
+
+        info = None
+        last_error = None
+        success_strategy = {"client": ["auto"], "cookies": False} # Default
+
+        scope = strategy_scope(target_url)
+        ordered = strategy_scheduler.order(scope, list(strategies))
+
+        if hedged or ANALYZE_HEDGED:
+            # Modo hedged: varias estrategias en paralelo, gana la primera que devuelva info
+            winner, info, last_error = _hedged_extract(scope, strategies, ordered, target_url, cache_key)
+            if info:
+                success_strategy = _strategy_summary(strategies[winner])
+        else:
+            for i, name in enumerate(ordered):
+                ydl_opts = strategies[name]
+                summary = _strategy_summary(ydl_opts)
+                print(f"[INFO] Intento {i+1}/{len(ordered)} ({name}): cliente={summary['client']}, cookies={summary['cookies']}")
+                try:
+                    info = _run_strategy(scope, name, ydl_opts, target_url)
+                    if info:
+                        print(f"[INFO] ✅ Éxito con estrategia {name}")
+                        success_strategy = summary
+                        break
+                    else:
+                        print(f"[WARN] Estrategia {name} devolvió None, probando siguiente...")
+                except HTTPException:
+                    raise
+                except Exception as e:
+                    error_str = str(e)
+                    last_error = error_str
+                    print(f"[WARN] Estrategia {name} falló: {error_str[:200]}")
+                    # Detectar errores de DNS / red
+                    if _is_dns_error(error_str):
+                        raise source_failure(target_url, error_str, cache_key)
+                    continue
+
+        # --- Fuera del loop: procesar formatos del info obtenido ---
+        if not info:
+            raise source_failure(target_url, last_error, cache_key)
+        domain_breaker.record(scope, None)
+
+        # La descarga podrá reutilizar esta extracción
+        token = info_tokens.issue(cache_key, info)
+
+        raw_formats = info.get('formats')
+        if raw_formats is None or not isinstance(raw_formats, list):
+            raw_formats = []
+        if not raw_formats:
+            raw_formats = [info]
+
+        print(f"Total de formatos encontrados por yt-dlp: {len(raw_formats)}")
+        video_formats, audio_formats = build_format_table(raw_formats, info.get('duration'))
+        for fmt in video_formats[:10]:
+            print(f"  Format: {fmt['format_id']} | {fmt['label']} | {fmt['filesize_str']}")
+
+        result = {
+            "title": info.get('title') or 'Video Desconocido',
+            "thumbnail": info.get('thumbnail'),
+            "duration": info.get('duration'),
+            "videos": video_formats,
+            "audios": audio_formats,
+            "url": target_url,
+            "original_url": url,
+            "strategy": success_strategy
+        }
+        analyze_cache.set(cache_key, result)
+        observe_span(ANALYZE_SECONDS, time.monotonic() - analyze_started, cache='miss', outcome='ok')
+        # El token no va a la caché de análisis: caduca mucho antes
+        return {**result, "token": token}
+
+    except HTTPException as e:
+        observe_span(ANALYZE_SECONDS, time.monotonic() - analyze_started, cache='miss', outcome=e.status_code)
+        # Re-lanzar HTTPExceptions sin modificar (no convertirlas en 500)
+        raise
+    except Exception as e:
+        observe_span(ANALYZE_SECONDS, time.monotonic() - analyze_started, cache='miss', outcome=500)
+        import traceback
+        traceback.print_exc()
+        print(f"Error analizando (yt-dlp): {e}")
+        raise HTTPException(status_code=500, detail=f"Error al analizar el video: {str(e)}")
+
+@app.get("/cache/stats")
+def cache_stats():
+    """Contadores de la caché de análisis (hits/misses/evictions) para dimensionarla."""
+    return {**analyze_cache.snapshot(), 'info_tokens': info_tokens.snapshot()}
+
+
+@app.get("/strategies/stats")
+def strategies_stats():
+    """Historial reciente de cada estrategia de extracción por dominio."""
+    return strategy_scheduler.snapshot()
+
+
+@app.get("/ydl-pool/stats")
+def ydl_pool_stats():
+    """Instancias de YoutubeDL creadas, reutilizadas y recicladas, y las libres por perfil."""
+    return ydl_pool.snapshot()
+
+
+@app.get("/resolver/stats")
+def resolver_stats():
+    """Caché de resolución de páginas y perfil aprendido de cada dominio."""
+    return resolution_cache.snapshot()
+
+
+@app.get("/download-selected")
+def download_selected(request: Request, url: str, format_id: str, client: str = None, use_cookies: str = 'true',
+                      delivery: str = 'file', token: str = None, priority: int = 0):
+    """Inicia la descarga en background y devuelve un file_id para seguir el progreso.
+
+    delivery='stream' sólo resuelve los formatos; get_file los transmite mientras FFmpeg
+    los produce. Si el formato no se puede transmitir, se descarga a disco como siempre.
+    token (de /analyze) reutiliza esa extracción; si caducó, se extrae de nuevo.
+    priority (0..DOWNLOAD_MAX_PRIORITY, mayor = más urgente) ordena la cola y el reparto de ancho de banda.
+    """
+    return JSONResponse({'file_id': submit_download(request, url, format_id, client, use_cookies, delivery, token,
+                                                    priority)})
+
+
+def submit_download(request: Request, url: str, format_id: str, client: Optional[str] = None,
+                    use_cookies: str = 'true', delivery: str = 'file', token: Optional[str] = None,
+                    priority: int = 0) -> str:
+    """Crea y encola el trabajo de descarga (o lo adjunta a uno igual en curso); devuelve su file_id."""
+    if not url or not format_id:
+        raise HTTPException(status_code=400, detail="URL y format_id requeridos")
+    if not 0 <= priority <= DOWNLOAD_MAX_PRIORITY:
+        raise HTTPException(status_code=400, detail=f"priority debe estar entre 0 y {DOWNLOAD_MAX_PRIORITY}")
+
+    file_id = str(uuid.uuid4())
+
+    # Deduplicación: mismo (url canónica, format_id) -> mismo artefacto / misma descarga en curso
+    key = artifact_key(url, format_id)
+    if _attach_to_existing(key, file_id):
+        return file_id
+
+    # Desde aquí file_id es el principal de un vuelo: todo rechazo tiene que cerrarlo
+    # Un dominio con el breaker abierto no ocupa un worker durante minutos
+    try:
+        check_source(url)
+    except HTTPException as e:
+        _abandon_flight(key, file_id, e)
+        raise
+
+    # Procesar parámetros de estrategia
+    use_cookies_bool = use_cookies.lower() == 'true'
+    
+    # Determinar cliente
+    # Si viene del frontend, usarlo. Si no, fallback al default robusto.
+    if client and client != 'null':
+        target_clients = [client] if ',' not in client else client.split(',')
+    else:
+        # yt-dlp prueba los clientes en orden dentro de la descarga y no dice cuál funcionó:
+        # se consulta el orden de /analyze sin contar un intento ni sondear
+        target_clients = strategy_scheduler.ranking(strategy_scope(url), ['tv_embedded', 'android', 'ios', 'mweb'])
+
+    print(f"[INFO] Iniciando descarga ({file_id}) con cliente={target_clients} cookies={use_cookies_bool}")
+
+    # Configuración base con EJS y Node.js para evitar el bot en la descarga también
+    base_opts = {
+        'noplaylist': True,
+        'quiet': True,
+        'http_headers': DEFAULT_HEADERS,
+        'nocheckcertificate': True,
+        'geo_bypass': True,
+        'retries': 10,
+        'concurrent_fragment_downloads': FRAGMENT_CONCURRENCY,
+        'fragment_retries': FRAGMENT_RETRIES,
+        'outtmpl': str(DOWNLOAD_DIR / f"{file_id}.%(ext)s"),
+        'cookiefile': YOUTUBE_COOKIES_FILE if (YOUTUBE_COOKIES_FILE and use_cookies_bool) else None,
+        'js_runtimes': {YTDLP_JS_RUNTIME: {}},
+        'extractor_args': {'youtube': {'player_client': target_clients}},
+    }
+
+    ydl_opts = {**base_opts}
+
+    preset = AUDIO_PRESETS.get(format_id)
+    if preset:
+        # Sólo audio: yt-dlp descarga el original y el transcodificador produce el formato final
+        ydl_opts['format'] = preset['select']
+        final_ext = preset['ext']
+    else:
+        # Descarga de Video MP4 - MODO RÁPIDO (Stream Copy)
+        # Forzamos EXACTAMENTE el format_id seleccionado + mejor audio
+        ydl_opts.update({
+            'format': f"{format_id}+bestaudio[ext=m4a]/bestaudio/best",
+            'merge_output_format': 'mp4',
+            'postprocessor_args': {
+                'ffmpeg': [
+                    '-c', 'copy',
+                    '-map', '0:v:0',
+                    '-map', '1:a:0',
+                    '-shortest'
+                ]
+            }
+        })
+        final_ext = "mp4"
+
+    # Agregar hook de progreso
+    ydl_opts['progress_hooks'] = [make_progress_hook(file_id, metric_scope(strategy_scope(url))),
+                                  make_bandwidth_hook(file_id)]
+    ydl_opts['postprocessor_hooks'] = [make_postprocessor_hook()]
+
+    # Las conversiones a MP3 (FFmpeg intensivo) van a un carril de CPU más pequeño;
+    # los audios con stream copy no recodifican y van con las descargas normales
+    lane = 'cpu' if preset and preset['codec'] != 'copy' else 'io'
+    target = _prepare_stream if delivery == 'stream' else _run_download
+    info = info_tokens.get(token, canonicalize_url(url))
+    if token and info is None:
+        print(f"[INFO] Token de extracción caducado o ajeno para {file_id}, se extraerá de nuevo")
+    args = (file_id, url, final_ext, ydl_opts, key, info, format_id if preset else None)
+    job = DownloadJob(file_id, _client_id(request), lane, target, args, priority, key)
+
+    # Encolar (admisión: 507 sin espacio en disco, 429 si el cliente tiene demasiados trabajos,
+    # 503 si la cola está llena)
+    try:
+        disk_janitor.ensure_room()
+        position = download_scheduler.submit(job)
+    except HTTPException as e:
+        # Rechazada sin tocar el origen: si era la petición de prueba del breaker, la libera
+        domain_breaker.release_probe(strategy_scope(url))
+        _abandon_flight(key, file_id, e)
+        raise
+    update_progress(file_id, {'queue_position': position, 'message': f'En cola (posición {position})...'})
+
+    return file_id
+
+
+# --- STORE DE TRABAJOS / PROGRESO ---
+# Estado de cada descarga ({percent, status, message, filename, path, ...}) con expiración.
+# 'memory' sirve para un solo proceso; 'sqlite' comparte el estado entre workers de uvicorn
+# (o réplicas en el mismo host) para que /progress y /get-file funcionen en cualquiera.
+# Sólo se comparte el estado de los trabajos. Los vuelos de deduplicación, los holders de la
+# caché de artefactos, la cola del planificador y las transmisiones activas son de cada
+# proceso: un proceso puede desalojar un artefacto al que apunta un trabajo de otro (ese
+# /get-file responde 404). Con varios procesos, ARTIFACT_CACHE_MAX_BYTES debe dejar margen
+# de sobra para que el desalojo por tamaño no alcance a artefactos recién entregados.
+JOB_STORE = os.environ.get('JOB_STORE', 'memory').lower()
+JOB_STORE_PATH = os.environ.get('JOB_STORE_PATH', str(DOWNLOAD_DIR / "jobs.sqlite3"))
+JOB_TTL = int(os.environ.get('JOB_TTL', 3600))                      # trabajos sin actividad ni recogida
+JOB_ERROR_TTL = int(os.environ.get('JOB_ERROR_TTL', 300))           # trabajos fallidos
+JOB_DELIVERED_TTL = int(os.environ.get('JOB_DELIVERED_TTL', 600))   # ventana de gracia tras la primera entrega
+JOB_MAX_DELIVERIES = int(os.environ.get('JOB_MAX_DELIVERIES', 5))   # descargas completas permitidas en esa ventana
+JOB_REAPER_INTERVAL = int(os.environ.get('JOB_REAPER_INTERVAL', 30))
+
+
+class InMemoryJobStore:
+    """Trabajos en un dict del proceso, con expiración."""
+
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+        self._jobs = {}  # {file_id: (expires_at, data)}
+        self._lock = threading.Lock()
+
+    def create(self, file_id: str, data: dict, ttl: Optional[int] = None):
+        with self._lock:
+            self._jobs[file_id] = (time.time() + (ttl or self.ttl), dict(data))
+
+    def get(self, file_id: str) -> Optional[dict]:
+        with self._lock:
+            item = self._jobs.get(file_id)
+            if item is None or item[0] <= time.time():
+                return None
+            return dict(item[1])
+
+    def update(self, file_id: str, fields: dict, ttl: Optional[int] = None) -> bool:
+        """Mezcla `fields` en el trabajo y renueva su expiración. False si ya no existe."""
+        with self._lock:
+            item = self._jobs.get(file_id)
+            if item is None:
+                return False
+            item[1].update(fields)
+            self._jobs[file_id] = (time.time() + (ttl or self.ttl), item[1])
+            return True
+
+    def delete(self, file_id: str):
+        with self._lock:
+            self._jobs.pop(file_id, None)
+
+    def reap(self) -> int:
+        now = time.time()
+        with self._lock:
+            expired = [fid for fid, (expires_at, _) in self._jobs.items() if expires_at <= now]
+            for fid in expired:
+                del self._jobs[fid]
+        return len(expired)
+
+    def count(self) -> int:
+        with self._lock:
+            return len(self._jobs)
+
+
+class SQLiteJobStore:
+    """Trabajos en un archivo SQLite (WAL) compartido entre procesos, con expiración.
+
+    Bloquea (lock del proceso y hasta 10 s de espera de SQLite): desde el event loop, siempre
+    a través de run_in_threadpool.
+    """
+
+    def __init__(self, path: str, ttl: int):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=10, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs (file_id TEXT PRIMARY KEY, data TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS jobs_expires_at ON jobs (expires_at)")
+        print(f"[INFO] Store de trabajos compartido en: {path}")
+
+    def create(self, file_id: str, data: dict, ttl: Optional[int] = None):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO jobs (file_id, data, expires_at) VALUES (?, ?, ?)",
+                (file_id, json.dumps(data, ensure_ascii=False), time.time() + (ttl or self.ttl))
+            )
+
+    def get(self, file_id: str) -> Optional[dict]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT data FROM jobs WHERE file_id = ? AND expires_at > ?", (file_id, time.time())
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def update(self, file_id: str, fields: dict, ttl: Optional[int] = None) -> bool:
+        with self._lock:
+            # Leer-modificar-escribir atómico también frente a otros procesos
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._db.execute("SELECT data FROM jobs WHERE file_id = ?", (file_id,)).fetchone()
+                if row is None:
+                    self._db.execute("COMMIT")
+                    return False
+                data = json.loads(row[0])
+                data.update(fields)
+                self._db.execute(
+                    "UPDATE jobs SET data = ?, expires_at = ? WHERE file_id = ?",
+                    (json.dumps(data, ensure_ascii=False), time.time() + (ttl or self.ttl), file_id)
+                )
+                self._db.execute("COMMIT")
+                return True
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def delete(self, file_id: str):
+        with self._lock:
+            self._db.execute("DELETE FROM jobs WHERE file_id = ?", (file_id,))
+
+    def reap(self) -> int:
+        with self._lock:
+            return self._db.execute("DELETE FROM jobs WHERE expires_at <= ?", (time.time(),)).rowcount
+
+    def count(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM jobs WHERE expires_at > ?", (time.time(),)).fetchone()[0]
+
+
+if JOB_STORE == 'sqlite':
+    job_store = SQLiteJobStore(JOB_STORE_PATH, JOB_TTL)
+else:
+    job_store = InMemoryJobStore(JOB_TTL)
+
+
+def _reap_jobs_forever():
+    """Expira trabajos abandonados y suelta las referencias a artefactos que ya nadie va a recoger."""
+    while True:
+        time.sleep(JOB_REAPER_INTERVAL)
+        try:
+            removed = job_store.reap()
+            released = artifact_cache.release_orphans(lambda holder: job_store.get(holder) is not None)
+            if removed or released:
+                print(f"[INFO] Reaper: {removed} trabajos expirados, {released} referencias liberadas")
+        except Exception as e:
+            print(f"[WARN] Reaper de trabajos: {e}")
+
+
+# --- PUB/SUB DE PROGRESO (para /progress/{file_id}/stream) ---
+PROGRESS_MIN_INTERVAL = 0.25  # segundos entre escrituras de progreso de un mismo hook
+PROGRESS_STREAM_MAX_RATE = float(os.environ.get('PROGRESS_STREAM_MAX_RATE', 4))  # eventos/s por trabajo
+PROGRESS_STREAM_KEEPALIVE = 15.0  # segundos sin cambios antes de enviar un comentario keepalive
+
+
+class _ProgressSubscription:
+    """Señal 'hay cambios' de un suscriptor; sólo se guarda el flag, el estado se lee al despertar."""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.event = asyncio.Event()
+
+    def notify(self):
+        # Llamado desde hilos de descarga: el Event sólo se toca desde su propio loop
+        self.loop.call_soon_threadsafe(self.event.set)
+
+    async def wait(self, timeout: float):
+        try:
+            await asyncio.wait_for(self.event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self.event.clear()
+
+
+class ProgressBroker:
+    """Canal pub/sub seguro entre los hilos de descarga y los streams asyncio."""
+
+    def __init__(self):
+        self._subscribers = {}  # {file_id: set[_ProgressSubscription]}
+        self._lock = threading.Lock()
+
+    def subscribe(self, file_id: str) -> _ProgressSubscription:
+        subscription = _ProgressSubscription(asyncio.get_running_loop())
+        with self._lock:
+            self._subscribers.setdefault(file_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, file_id: str, subscription: _ProgressSubscription):
+        with self._lock:
+            subs = self._subscribers.get(file_id)
+            if subs:
+                subs.discard(subscription)
+                if not subs:
+                    del self._subscribers[file_id]
+
+    def publish(self, file_id: str):
+        with self._lock:
+            subs = list(self._subscribers.get(file_id, ()))
+        for subscription in subs:
+            try:
+                subscription.notify()
+            except RuntimeError:
+                pass  # loop cerrado: el stream ya terminó
+
+
+progress_broker = ProgressBroker()
+
+
+def update_progress(file_id: str, fields: dict):
+    """Actualiza la entrada de progreso de una descarga (punto único de escritura).
+
+    Si la descarga es la principal de un vuelo compartido, la actualización se replica
+    a todas las peticiones adjuntas.
+    """
+    targets = [file_id]
+    with _flights_lock:
+        for flight in _flights.values():
+            if flight[0] == file_id:
+                targets = list(flight)
+                break
+    for target in targets:
+        if job_store.update(target, fields):
+            progress_broker.publish(target)
+
+
+# --- ANCHO DE BANDA (token bucket global y reparto justo entre trabajos) ---
+# Con BANDWIDTH_LIMIT (bytes/s, 0 = sin límite) las descargas de origen comparten ese caudal,
+# por debajo del enlace del contenedor para que /analyze y las entregas no se queden sin aire.
+# Reparto max-min ponderado: cada trabajo en curso pesa 1 + prioridad (x BANDWIDTH_SMALL_JOB_BOOST
+# si le quedan menos de BANDWIDTH_SMALL_JOB_BYTES, para que los pequeños terminen pronto) y lo que
+# no usa un trabajo limitado por su origen se reparte entre los demás. Se aplica con un token
+# bucket por trabajo más uno global: yt-dlp a través de su `ratelimit` y de un hook de progreso
+# que espera lo necesario; la descarga nativa por segmentos, en _pipe_segments.
+BANDWIDTH_LIMIT = int(os.environ.get('BANDWIDTH_LIMIT', 0))
+BANDWIDTH_MIN_RATE = int(os.environ.get('BANDWIDTH_MIN_RATE', 64 * 1024))      # suelo por trabajo
+BANDWIDTH_SMALL_JOB_BYTES = int(os.environ.get('BANDWIDTH_SMALL_JOB_BYTES', 20 * 1024 ** 2))
+BANDWIDTH_SMALL_JOB_BOOST = float(os.environ.get('BANDWIDTH_SMALL_JOB_BOOST', 2.0))
+BANDWIDTH_BURST_SECONDS = float(os.environ.get('BANDWIDTH_BURST_SECONDS', 0.5))
+BANDWIDTH_REBALANCE_INTERVAL = 1.0  # segundos entre recálculos del reparto
+# El `ratelimit` de yt-dlp sólo suaviza el ritmo dentro de cada bloque; va un poco por encima
+# de la asignación para que el límite efectivo sea el del token bucket y no se sumen esperas
+YTDLP_RATELIMIT_HEADROOM = 1.1
+
+
+class TokenBucket:
+    """Token bucket sin lock propio (lo protege BandwidthScheduler). rate=None: sin límite."""
+
+    def __init__(self, rate: Optional[float] = None):
+        self.rate = None
+        self.burst = 0.0
+        self._tokens = 0.0
+        self._last = time.monotonic()
+        self.set_rate(rate)
+
+    def set_rate(self, rate: Optional[float]):
+        self._refill()
+        self.rate = rate
+        self.burst = max(rate * BANDWIDTH_BURST_SECONDS, 64 * 1024) if rate else 0.0
+        self._tokens = min(self._tokens, self.burst)
+
+    def reserve(self, n: int) -> float:
+        """Consume n bytes (puede endeudarse) y devuelve cuánto hay que esperar antes de seguir."""
+        if not self.rate:
+            return 0.0
+        self._refill()
+        self._tokens -= n
+        return -self._tokens / self.rate if self._tokens < 0 else 0.0
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate:
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+
+class _BandwidthJob:
+    __slots__ = ('priority', 'bucket', 'params', 'rate', 'speed', 'remaining', 'source_limited',
+                 'window_bytes', 'window_delay', 'window_start')
+
+    def __init__(self, priority: int):
+        self.priority = priority
+        self.bucket = TokenBucket()
+        self.params = None          # params del YoutubeDL que descarga (para su `ratelimit`)
+        self.rate = None            # asignación actual (bytes/s)
+        self.speed = 0.0            # velocidad medida (media móvil)
+        self.remaining = None       # bytes que le quedan, si se conocen
+        self.source_limited = False # en la última ventana no lo frenamos nosotros: va al ritmo del origen
+        self.window_bytes = 0
+        self.window_delay = 0.0
+        self.window_start = None    # la ventana empieza con el primer bloque (no durante la extracción)
+
+
+class BandwidthScheduler:
+    """Límite global de caudal de origen con reparto justo y ponderado entre los trabajos activos."""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self._global = TokenBucket(limit or None)
+        self._jobs = {}  # {file_id: _BandwidthJob}
+        self._last_rebalance = 0.0
+        self._lock = threading.Lock()
+        self.stats = {'throttled_seconds': 0.0}
+
+    @contextmanager
+    def job(self, file_id: str, priority: int = 0):
+        """Registra el trabajo mientras dura (lo usa el worker del planificador de descargas)."""
+        with self._lock:
+            self._jobs[file_id] = _BandwidthJob(priority)
+            self._rebalance()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._jobs.pop(file_id, None)
+                self._rebalance()
+
+    @contextmanager
+    def bind_params(self, file_id: str, params: dict):
+        """Conecta el `ratelimit` de yt-dlp a la asignación del trabajo (HttpFD lo relee en cada bloque)
+        mientras dura el préstamo de la instancia; al salir lo desconecta y deja `ratelimit` como estaba,
+        antes de que la instancia vuelva al pool y la use otro trabajo."""
+        original = params.get('ratelimit')
+        with self._lock:
+            job = self._jobs.get(file_id)
+            if job is not None:
+                job.params = params
+                params['ratelimit'] = int(job.rate * YTDLP_RATELIMIT_HEADROOM) if job.rate else None
+        try:
+            yield
+        finally:
+            with self._lock:
+                if job is not None and job.params is params:
+                    job.params = None
+                params['ratelimit'] = original
+
+    def consume(self, file_id: str, n: int, remaining: Optional[int] = None) -> float:
+        """Anota n bytes descargados por el trabajo; devuelve los segundos que debe esperar."""
+        now = time.monotonic()
+        with self._lock:
+            delay = self._global.reserve(n)
+            job = self._jobs.get(file_id)
+            if job is not None:
+                delay = max(delay, job.bucket.reserve(n))
+                job.window_bytes += n
+                job.window_delay += delay
+                if remaining is not None:
+                    job.remaining = remaining
+                if job.window_start is None:
+                    job.window_start = now
+                elapsed = now - job.window_start
+                if elapsed >= BANDWIDTH_REBALANCE_INTERVAL:
+                    measured = job.window_bytes / elapsed
+                    job.speed = measured if not job.speed else 0.5 * job.speed + 0.5 * measured
+                    job.source_limited = job.window_delay < 0.05 * elapsed
+                    job.window_bytes = 0
+                    job.window_delay = 0.0
+                    job.window_start = now
+            if now - self._last_rebalance >= BANDWIDTH_REBALANCE_INTERVAL:
+                self._rebalance()
+            self.stats['throttled_seconds'] += delay
+        return delay
+
+    def speed(self, file_id: str) -> Optional[float]:
+        with self._lock:
+            job = self._jobs.get(file_id)
+            return job.speed if job is not None and job.speed else None
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                'limit': self.limit or None,
+                'throttled_seconds': round(self.stats['throttled_seconds'], 1),
+                'jobs': {
+                    file_id: {
+                        'priority': job.priority,
+                        'rate': int(job.rate) if job.rate else None,
+                        'speed': int(job.speed),
+                        'remaining': job.remaining,
+                    }
+                    for file_id, job in self._jobs.items()
+                },
+            }
+
+    # --- internos (llamar con el lock tomado) ---
+
+    def _weight(self, job: _BandwidthJob) -> float:
+        weight = 1.0 + max(0, job.priority)
+        if job.remaining is not None and job.remaining < BANDWIDTH_SMALL_JOB_BYTES:
+            weight *= BANDWIDTH_SMALL_JOB_BOOST
+        return weight
+
+    def _rebalance(self):
+        """Reparto max-min ponderado (water-filling) del límite global entre los trabajos activos."""
+        self._last_rebalance = time.monotonic()
+        if not self.limit:
+            return
+        unsettled = dict(self._jobs)
+        capacity = float(self.limit)
+        rates = {}
+        while unsettled:
+            weights = {fid: self._weight(job) for fid, job in unsettled.items()}
+            per_weight = capacity / sum(weights.values())
+            # Un trabajo al que no frenamos y que va claramente por debajo de su parte está limitado
+            # por el origen: se le deja algo de margen para crecer y el resto se reparte entre los demás
+            capped = {
+                fid: job.speed * 1.25 for fid, job in unsettled.items()
+                if job.source_limited and job.rate and job.speed and job.speed < 0.8 * job.rate
+                and job.speed * 1.25 < weights[fid] * per_weight
+            }
+            # Si todos van por debajo no hay a quién darle lo sobrante: se reparte igual
+            if not capped or len(capped) == len(unsettled):
+                rates.update({fid: weights[fid] * per_weight for fid in unsettled})
+                break
+            for fid, demand in capped.items():
+                rates[fid] = demand
+                capacity -= demand
+                del unsettled[fid]
+        for fid, rate in rates.items():
+            job = self._jobs[fid]
+            job.rate = max(BANDWIDTH_MIN_RATE, rate)
+            job.bucket.set_rate(job.rate)
+            if job.params is not None:
+                job.params['ratelimit'] = int(job.rate * YTDLP_RATELIMIT_HEADROOM)
+
+
+bandwidth = BandwidthScheduler(BANDWIDTH_LIMIT)
+
+
+def make_bandwidth_hook(file_id: str):
+    """Hook de progreso de yt-dlp que aplica el reparto de ancho de banda al trabajo.
+
+    yt-dlp lo llama desde su hilo tras cada bloque, así que esperar aquí frena la descarga.
+    Ignora los eventos de la descarga nativa: allí el límite ya lo aplica _pipe_segments.
+    """
+    last = [0]  # bytes ya contabilizados del stream actual
+
+    def hook(d):
+        if d['status'] == 'finished':
+            last[0] = 0
+            return
+        if d['status'] != 'downloading' or d.get('native'):
+            return
+        done = d.get('downloaded_bytes') or 0
+        total = d.get('total_bytes') or d.get('total_bytes_estimate')
+        delta = done - last[0]
+        last[0] = done
+        if delta > 0:
+            delay = bandwidth.consume(file_id, delta, int(total - done) if total else None)
+            if delay > 0:
+                time.sleep(delay)
+    return hook
+
+
+@app.get("/bandwidth/stats")
+def bandwidth_stats():
+    """Límite global, asignación y velocidad medida de cada descarga en curso."""
+    return bandwidth.snapshot()
+
+# --- FIN ANCHO DE BANDA ---
+
+
+def _format_eta(seconds) -> str:
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}" if seconds >= 3600 \
+        else f"{seconds // 60}:{seconds % 60:02d}"
+
+
+def make_progress_hook(file_id: str, extractor: str = 'unknown'):
+    """Crea un hook de progreso para yt-dlp que actualiza el store de trabajos."""
     download_count = [0]  # [0]=video, [1]=audio
+    last_write = [0.0]
+
+    def hook(d):
+        if d['status'] == 'finished':
+            # Throughput de cada stream (video, audio) para las métricas
+            size = d.get('total_bytes') or d.get('downloaded_bytes') or 0
+            elapsed = d.get('elapsed') or 0
+            if size:
+                DOWNLOAD_BYTES.inc(size, extractor=extractor)
+                if elapsed > 0:
+                    DOWNLOAD_THROUGHPUT.observe(size / elapsed, extractor=extractor)
+
+        if d['status'] == 'downloading':
+            # yt-dlp llama al hook por cada bloque; no hace falta escribir el store tan a menudo
+            now = time.monotonic()
+            if now - last_write[0] < PROGRESS_MIN_INTERVAL:
+                return
+            last_write[0] = now
+            try:
+                total = d.get('total_bytes') or d.get('total_bytes_estimate', 0)
+                done = d.get('downloaded_bytes', 0)
+                pct = (done / total * 100) if total > 0 else 0
+
+                if download_count[0] == 0:  # Descargando video (0-70%)
+                    mapped = pct * 0.70
+                    msg = f'📥 Descargando video... {pct:.0f}%'
+                else:                        # Descargando audio (70-90%)
+                    mapped = 70 + pct * 0.20
+                    msg = f'🎵 Descargando audio... {pct:.0f}%'
+
+                # Velocidad efectiva (ya con el reparto de ancho de banda aplicado) y ETA del stream
+                speed = d.get('speed') or bandwidth.speed(file_id)
+                eta = d.get('eta')
+                if eta is None and speed and total > done:
+                    eta = (total - done) / speed
+                if speed:
+                    msg += f' · {format_size(speed)}/s'
+                if eta is not None:
+                    msg += f' · {_format_eta(eta)}'
+
+                update_progress(file_id, {
+                    'percent': round(mapped, 1),
+                    'status': 'downloading',
+                    'message': msg,
+                    'speed': int(speed) if speed else None,
+                    'eta': int(eta) if eta is not None else None,
+                })
+            except Exception:
+                pass
+
+        elif d['status'] == 'finished':
+            download_count[0] += 1
+            if download_count[0] == 1:
+                update_progress(file_id, {
+                    'percent': 70, 'message': '🎵 Descargando audio...'
+                })
+            else:
+                update_progress(file_id, {
+                    'percent': 90, 'status': 'merging',
+                    'message': '⚙️ Combinando streams con FFmpeg...'
+                })
+    return hook
+
+
+def make_postprocessor_hook():
+    """Mide cuánto tarda cada postprocesador de yt-dlp (Merger, FFmpegExtractAudio...)."""
+    started = {}
+
+    def hook(d):
+        name = d.get('postprocessor') or 'unknown'
+        if d['status'] == 'started':
+            started[name] = time.monotonic()
+        elif d['status'] == 'finished' and name in started:
+            observe_span(POSTPROCESS_SECONDS, time.monotonic() - started.pop(name), postprocessor=name)
+    return hook
+
+
+def _run_download(file_id: str, url: str, final_ext: str, ydl_opts: dict, key: str, info: Optional[dict] = None,
+                  audio_preset: Optional[str] = None):
+    """Ejecuta yt-dlp + FFmpeg en un worker y publica el resultado en la caché de artefactos.
+
+    Con `info` (extracción de /analyze) sólo se vuelve a seleccionar el formato, sin extraer.
+    Con `audio_preset` el audio descargado se convierte (o remuxa) al formato del preset.
+    """
+    preset = AUDIO_PRESETS.get(audio_preset) if audio_preset else None
+    try:
+        with ydl_pool.lease(ydl_opts) as ydl, bandwidth.bind_params(file_id, ydl.params):
+            if info is not None:
+                info = ydl.process_ie_result(info, download=False)
+            else:
+                info = ydl.extract_info(url, download=False)
+            # HLS/DASH sencillos: segmentos en paralelo; el resto (o si falla) lo descarga yt-dlp
+            if info and not _download_segments(file_id, info, final_ext, ydl_opts.get('progress_hooks') or [], preset):
+                info = ydl.process_ie_result(info, download=True)
+            video_title = (info.get('title') if info else None) or 'video'
+
+        # Buscar el archivo generado
+        final_path = DOWNLOAD_DIR / f"{file_id}.{final_ext}"
+        if not final_path.exists():
+            found = list(DOWNLOAD_DIR.glob(f"{file_id}.*"))
+            if found and preset:
+                update_progress(file_id, {
+                    'percent': 90, 'status': 'merging',
+                    'message': '🎵 Convirtiendo audio...' if preset['codec'] != 'copy' else '⚙️ Preparando audio...'
+                })
+                transcode_file(found[0], final_path, preset)
+                found[0].unlink(missing_ok=True)
+            elif found:
+                final_path = found[0]
+                final_ext = final_path.suffix.lstrip('.')
+            else:
+                _finish_flight(key, file_id, {
+                    'status': 'error', 'message': 'Archivo no encontrado tras la descarga.'
+                })
+                return
+
+        user_filename = _user_filename(video_title, final_ext)
+        domain_breaker.record(strategy_scope(url), None)
+
+        artifact_path = artifact_cache.add(key, final_path, user_filename, file_id)
+        _finish_flight(key, file_id, {
+            'percent': 100, 'status': 'ready',
+            'message': '✅ ¡Listo! Descargando archivo...',
+            'filename': user_filename,
+            'path': str(artifact_path)
+        })
+
+    except Exception as e:
+        print(f"[ERROR] Descarga fallida ({file_id}): {e}")
+        domain_breaker.record(strategy_scope(url), classify_failure(str(e)))
+        _finish_flight(key, file_id, {
+            'status': 'error', 'message': f'Error: {str(e)[:200]}'
+        })
+        # Limpiar archivos parciales
+        for f in DOWNLOAD_DIR.glob(f"{file_id}.*"):
+            try: os.remove(f)
+            except: pass
+
+
+# --- DESCARGA NATIVA DE HLS/DASH POR SEGMENTOS ---
+# yt-dlp pide los fragmentos casi de uno en uno. Para manifiestos sencillos (HLS sin cifrar y
+# no en directo, DASH con lista de fragmentos) los segmentos se piden en paralelo con el cliente
+# compartido, con reintentos y backoff por segmento, y se escriben en orden en el stdin de FFmpeg
+# con un búfer acotado. Cualquier otro caso (o un fallo) vuelve a la ruta normal de yt-dlp.
+NATIVE_SEGMENTS = os.environ.get('NATIVE_SEGMENTS', 'true').lower() == 'true'
+NATIVE_STALL_TIMEOUT = int(os.environ.get('NATIVE_STALL_TIMEOUT', 300))         # s sin progreso (incluye el merge)
+FRAGMENT_CONCURRENCY = max(1, int(os.environ.get('FRAGMENT_CONCURRENCY', 8)))   # peticiones de segmentos a la vez
+# Segmentos descargados o en vuelo por delante del que se está escribiendo (memoria acotada)
+FRAGMENT_BUFFER = max(FRAGMENT_CONCURRENCY, int(os.environ.get('FRAGMENT_BUFFER', 2 * FRAGMENT_CONCURRENCY)))
+FRAGMENT_RETRIES = int(os.environ.get('FRAGMENT_RETRIES', 5))
+FRAGMENT_BACKOFF_BASE = 0.5   # segundos
+FRAGMENT_BACKOFF_MAX = 8.0
+FRAGMENT_READ_TIMEOUT = 30
+_SEGMENT_PROTOCOLS = {'m3u8', 'm3u8_native', 'http_dash_segments'}
+_RETRYABLE_STATUS = {408, 425, 429, 500, 502, 503, 504}
+_HLS_ATTR_RE = re.compile(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)')
+
+
+class UnsupportedManifest(Exception):
+    """El manifiesto usa algo que la ruta nativa no cubre (cifrado, directo, playlist maestra...)."""
+
+
+def _hls_segments(playlist: str, base_url: str) -> List[dict]:
+    """Segmentos de una media playlist HLS: [{'url', 'range'?}], con el EXT-X-MAP delante."""
+    lines = [line.strip() for line in playlist.splitlines() if line.strip()]
+    if not lines or lines[0] != '#EXTM3U':
+        raise UnsupportedManifest('no es un manifiesto HLS')
+    segments, byterange, next_offset, has_map, ended = [], None, 0, False, False
+    for line in lines[1:]:
+        if line.startswith('#EXT-X-STREAM-INF'):
+            raise UnsupportedManifest('playlist maestra')
+        elif line.startswith('#EXT-X-KEY'):
+            if dict(_HLS_ATTR_RE.findall(line)).get('METHOD', 'NONE') != 'NONE':
+                raise UnsupportedManifest('segmentos cifrados')
+        elif line.startswith('#EXT-X-MAP'):
+            if has_map:
+                raise UnsupportedManifest('varios EXT-X-MAP')
+            has_map = True
+            attrs = {k: v.strip('"') for k, v in _HLS_ATTR_RE.findall(line.split(':', 1)[1])}
+            segment = {'url': urljoin(base_url, attrs['URI'])}
+            if 'BYTERANGE' in attrs:
+                length, _, offset = attrs['BYTERANGE'].partition('@')
+                segment['range'] = (int(offset or 0), int(offset or 0) + int(length) - 1)
+            segments.append(segment)
+        elif line.startswith('#EXT-X-BYTERANGE:'):
+            byterange = line.split(':', 1)[1]
+        elif line.startswith('#EXT-X-ENDLIST'):
+            ended = True
+        elif not line.startswith('#'):
+            segment = {'url': urljoin(base_url, line)}
+            if byterange:
+                length, _, offset = byterange.partition('@')
+                start = int(offset) if offset else next_offset
+                segment['range'] = (start, start + int(length) - 1)
+                next_offset = start + int(length)
+                byterange = None
+            segments.append(segment)
+    if not ended:
+        raise UnsupportedManifest('emisión en directo')
+    if not segments:
+        raise UnsupportedManifest('manifiesto vacío')
+    return segments
+
+
+def _segment_source(fmt: dict) -> Optional[str]:
+    """'hls' / 'dash' si la ruta nativa puede descargar este formato, o None."""
+    protocol = fmt.get('protocol') or ''
+    if protocol not in _SEGMENT_PROTOCOLS or fmt.get('cookies') or fmt.get('has_drm'):
+        return None
+    if protocol == 'http_dash_segments':
+        return 'dash' if isinstance(fmt.get('fragments'), list) and fmt['fragments'] else None
+    return 'hls' if fmt.get('url') else None
+
+
+async def _fetch_segment(session: 'aiohttp.ClientSession', segment: dict, headers: dict) -> bytes:
+    if 'range' in segment:
+        headers = {**headers, 'Range': 'bytes=%d-%d' % segment['range']}
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=RESOLVER_TIMEOUT, sock_read=FRAGMENT_READ_TIMEOUT)
+    for attempt in range(FRAGMENT_RETRIES + 1):
+        try:
+            async with session.get(segment['url'], headers=headers, timeout=timeout) as response:
+                if response.status < 400:
+                    return await response.read()
+                if response.status not in _RETRYABLE_STATUS:
+                    response.raise_for_status()
+                error = f"HTTP {response.status}"
+        except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError) as e:
+            error = repr(e)
+        if attempt == FRAGMENT_RETRIES:
+            raise RuntimeError(f"Segmento fallido tras {FRAGMENT_RETRIES} reintentos ({error}): {segment['url']}")
+        # Backoff exponencial con jitter: muchos segmentos fallan a la vez cuando la CDN tiene un bache
+        delay = min(FRAGMENT_BACKOFF_BASE * 2 ** attempt, FRAGMENT_BACKOFF_MAX)
+        await asyncio.sleep(delay * random.uniform(0.5, 1.0))
+
+
+async def _segments_for(session: 'aiohttp.ClientSession', fmt: dict) -> List[dict]:
+    if _segment_source(fmt) == 'dash':
+        base = fmt.get('fragment_base_url') or fmt.get('url') or ''
+        return [{'url': f.get('url') or urljoin(base, f['path'])} for f in fmt['fragments']]
+    playlist = await _fetch_segment(session, {'url': fmt['url']}, fmt.get('http_headers') or {})
+    return _hls_segments(playlist.decode('utf-8', errors='replace'), fmt['url'])
+
+
+async def _pipe_segments(file_id: str, session: 'aiohttp.ClientSession', segments: List[dict], headers: dict,
+                         cmd: List[str], emit, deprioritized: bool = False):
+    """Descarga los segmentos en paralelo y los escribe en orden en el stdin de FFmpeg.
+
+    `emit` recibe los eventos de progreso; no debe bloquear (corre en el event loop).
+    """
+    fetch_slots = asyncio.Semaphore(FRAGMENT_CONCURRENCY)
+
+    async def fetch(segment):
+        async with fetch_slots:
+            data = await _fetch_segment(session, segment, headers)
+            # Reparto de ancho de banda: el hueco del semáforo se mantiene mientras se espera
+            delay = bandwidth.consume(file_id, len(data))
+            if delay > 0:
+                await asyncio.sleep(delay)
+            return data
+
+    proc = await asyncio.create_subprocess_exec(
+        *cmd, stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE
+    )
+    if deprioritized:
+        deprioritize(proc.pid)
+    stderr = asyncio.ensure_future(proc.stderr.read())
+    pending = deque()
+    started = time.monotonic()
+    done_bytes = 0
+    try:
+        scheduled = 0
+        for index in range(len(segments)):
+            # Ventana deslizante: como mucho FRAGMENT_BUFFER segmentos por delante del que se escribe
+            while scheduled < len(segments) and scheduled - index < FRAGMENT_BUFFER:
+                pending.append(asyncio.ensure_future(fetch(segments[scheduled])))
+                scheduled += 1
+            data = await pending.popleft()
+            try:
+                proc.stdin.write(data)
+                await proc.stdin.drain()
+            except (BrokenPipeError, ConnectionResetError):
+                # FFmpeg se cerró antes de tiempo: el motivo está en su stderr, no en el pipe roto
+                await proc.wait()
+                raise RuntimeError(f"FFmpeg terminó con código {proc.returncode}: "
+                                   f"{(await stderr)[-300:].decode(errors='replace')}")
+            done_bytes += len(data)
+            # Mismos eventos que el descargador de yt-dlp: el hook de progreso y las métricas no cambian.
+            # 'native' indica que el ancho de banda ya se ha contabilizado aquí
+            estimate = done_bytes / (index + 1) * len(segments)
+            elapsed = time.monotonic() - started
+            speed = done_bytes / elapsed if elapsed > 0 else None
+            emit({'status': 'downloading', 'downloaded_bytes': done_bytes, 'total_bytes_estimate': estimate,
+                  'speed': speed, 'eta': (estimate - done_bytes) / speed if speed else None, 'native': True})
+        proc.stdin.close()
+        if await proc.wait() != 0:
+            raise RuntimeError(f"FFmpeg terminó con código {proc.returncode}: {(await stderr)[-300:].decode(errors='replace')}")
+    finally:
+        for task in pending:
+            task.cancel()
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        stderr.cancel()
+    emit({'status': 'finished', 'total_bytes': done_bytes, 'elapsed': time.monotonic() - started, 'native': True})
+
+
+async def _native_download(file_id: str, formats: List[dict], final_ext: str, emit,
+                          preset: Optional[dict]) -> Path:
+    session = await get_http_session()
+    # Resolver todas las listas de segmentos antes de arrancar FFmpeg (UnsupportedManifest -> yt-dlp)
+    segment_lists = [await _segments_for(session, fmt) for fmt in formats]
+
+    final_path = DOWNLOAD_DIR / f"{file_id}.{final_ext}"
+    base_cmd = [FFMPEG_BIN, '-hide_banner', '-loglevel', 'error', '-y', '-i', 'pipe:0']
+    if len(formats) == 1:
+        # Audio: se convierte directamente desde el pipe (con la prioridad reducida si recodifica)
+        output_args = audio_codec_args(preset) if preset else ['-c', 'copy']
+        await _pipe_segments(file_id, session, segment_lists[0], formats[0].get('http_headers') or {},
+                             base_cmd + output_args + [str(final_path)], emit,
+                             deprioritized=bool(preset) and preset['codec'] != 'copy')
+        return final_path
+
+    # Video y audio por separado (uno tras otro, como yt-dlp) y luego merge con stream copy
+    parts = [DOWNLOAD_DIR / f"{file_id}.f{i}.mkv" for i in range(len(formats))]
+    for fmt, segments, part in zip(formats, segment_lists, parts):
+        await _pipe_segments(file_id, session, segments, fmt.get('http_headers') or {},
+                             base_cmd + ['-c', 'copy', str(part)], emit)
+    started = time.monotonic()
+    proc = await asyncio.create_subprocess_exec(
+        FFMPEG_BIN, '-hide_banner', '-loglevel', 'error', '-y', '-i', str(parts[0]), '-i', str(parts[1]),
+        '-map', '0:v:0', '-map', '1:a:0', '-c', 'copy', '-shortest', str(final_path),
+        stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE
+    )
+    _, stderr = await proc.communicate()
+    if proc.returncode != 0:
+        raise RuntimeError(f"Merge FFmpeg fallido: {stderr[-300:].decode(errors='replace')}")
+    observe_span(POSTPROCESS_SECONDS, time.monotonic() - started, postprocessor='Merger')
+    for part in parts:
+        part.unlink(missing_ok=True)
+    return final_path
+
+
+def _run_native(file_id: str, loop: asyncio.AbstractEventLoop, formats: List[dict], final_ext: str, hooks: list,
+                preset: Optional[dict]):
+    """Ejecuta _native_download en el event loop y espera desde el hilo del worker.
+
+    Los hooks de progreso tocan el store de trabajos (SQLite) y varios locks: no pueden
+    correr en el event loop. Los eventos vuelven por una cola y los hooks se llaman aquí,
+    en el worker, como con yt-dlp. Sin eventos en NATIVE_STALL_TIMEOUT s se cancela.
+    """
+    events = queue.SimpleQueue()
+    future = asyncio.run_coroutine_threadsafe(
+        _native_download(file_id, formats, final_ext, events.put, preset), loop)
+    last_event = time.monotonic()
+    while True:
+        done, _ = wait([future], timeout=0.5)
+        while True:
+            try:
+                event = events.get_nowait()
+            except queue.Empty:
+                break
+            last_event = time.monotonic()
+            for hook in hooks:
+                hook(event)
+        if done:
+            return future.result()
+        if time.monotonic() - last_event > NATIVE_STALL_TIMEOUT:
+            # Cancelar la tarea mata a FFmpeg y a las descargas pendientes (finally de _pipe_segments)
+            future.cancel()
+            raise RuntimeError(f"sin progreso en {NATIVE_STALL_TIMEOUT}s")
+
+
+def _download_segments(file_id: str, info: dict, final_ext: str, hooks: list, preset: Optional[dict] = None) -> bool:
+    """Descarga nativa en paralelo si los formatos elegidos lo permiten. False = que lo haga yt-dlp."""
+    formats = info.get('requested_formats') or [info]
+    loop = _app_loop
+    if (not NATIVE_SEGMENTS or loop is None or not loop.is_running() or len(formats) > 2
+            or not all(_segment_source(f) for f in formats)):
+        return False
+    try:
+        _run_native(file_id, loop, formats, final_ext, hooks, preset)
+        return True
+    except UnsupportedManifest as e:
+        print(f"[INFO] {file_id}: descarga nativa no aplicable ({e}), usando yt-dlp")
+    except Exception as e:
+        print(f"[WARN] {file_id}: descarga nativa fallida ({e}), reintentando con yt-dlp")
+    for f in DOWNLOAD_DIR.glob(f"{file_id}.*"):
+        try: os.remove(f)
+        except: pass
+    return False
+
+
+def _user_filename(title: str, ext: str) -> str:
+    safe_title = "".join(c for c in title if c.isalnum() or c in (' ', '-', '_')).strip()
+    return f"{safe_title}.{ext}"
+
+
+# --- TRANSCODIFICACIÓN DE AUDIO ---
+# Las opciones de audio son presets: MP3 en uno o varios niveles de calidad (recodificación, lo
+# más caro en CPU de cada trabajo) y m4a/opus originales con stream copy (sin recodificar).
+# FFmpeg se lanza con un número de hilos limitado y, en POSIX, con menos prioridad (nice) y
+# opcionalmente fijado a unos núcleos, para no quitar CPU al event loop ni a los merges.
+AUDIO_MP3_TIERS = [int(k) for k in os.environ.get('AUDIO_MP3_TIERS', '192').split(',') if k.strip()]  # kbps; el 1º es el de por defecto
+FFMPEG_THREADS = int(os.environ.get('FFMPEG_THREADS', 2))         # hilos por proceso de transcodificación
+TRANSCODE_NICE = int(os.environ.get('TRANSCODE_NICE', 10))        # 0 = misma prioridad que la app
+# Núcleos permitidos para transcodificar, p. ej. "2-3" o "1,3" (vacío = todos)
+TRANSCODE_CPUS = {
+    cpu for part in os.environ.get('TRANSCODE_CPUS', '').split(',') if part.strip()
+    for cpu in (range(int(part.split('-')[0]), int(part.split('-')[-1]) + 1))
+}
+
+AUDIO_PRESETS = {}  # {format_id: {ext, codec, bitrate, select, resolution}}
+for _i, _kbps in enumerate(AUDIO_MP3_TIERS):
+    AUDIO_PRESETS['best_audio_mp3' if _i == 0 else f'best_audio_mp3_{_kbps}'] = {
+        'ext': 'mp3', 'codec': 'libmp3lame', 'bitrate': f'{_kbps}k', 'select': 'bestaudio/best',
+        'resolution': 'Audio High Quality' if _i == 0 else f'Audio MP3 {_kbps} kbps',
+    }
+AUDIO_PRESETS['best_audio_m4a'] = {
+    'ext': 'm4a', 'codec': 'copy', 'select': 'bestaudio[ext=m4a]', 'resolution': 'Audio Original (AAC)',
+}
+AUDIO_PRESETS['best_audio_opus'] = {
+    'ext': 'opus', 'codec': 'copy', 'select': 'bestaudio[acodec=opus]', 'resolution': 'Audio Original (Opus)',
+}
+
+
+def audio_codec_args(preset: dict) -> List[str]:
+    if preset['codec'] == 'copy':
+        return ['-vn', '-c:a', 'copy']
+    return ['-vn', '-c:a', preset['codec'], '-b:a', preset['bitrate'], '-threads', str(FFMPEG_THREADS)]
+
+
+def deprioritize(pid: int):
+    """Baja la prioridad de un proceso hijo ya lanzado (sin preexec_fn, que no es seguro con hilos)."""
+    try:
+        if TRANSCODE_NICE and hasattr(os, 'setpriority'):
+            os.setpriority(os.PRIO_PROCESS, pid, TRANSCODE_NICE)
+        if TRANSCODE_CPUS and hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(pid, TRANSCODE_CPUS)
+    except (OSError, ValueError) as e:
+        print(f"[WARN] No se pudo ajustar la prioridad de FFmpeg ({pid}): {e}")
+
+
+def transcode_file(src: Path, dst: Path, preset: dict):
+    """Convierte (o remuxa con stream copy) un archivo de audio descargado al formato del preset."""
+    cmd = [FFMPEG_BIN, '-hide_banner', '-loglevel', 'error', '-nostdin', '-y',
+           '-threads', str(FFMPEG_THREADS), '-i', str(src)] + audio_codec_args(preset) + [str(dst)]
+    started = time.monotonic()
+    proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if preset['codec'] != 'copy':
+        deprioritize(proc.pid)
+    _, stderr = proc.communicate()
+    if proc.returncode != 0:
+        dst.unlink(missing_ok=True)
+        raise RuntimeError(f"FFmpeg ({preset['ext']}) terminó con código {proc.returncode}: "
+                           f"{stderr[-300:].decode(errors='replace')}")
+    observe_span(POSTPROCESS_SECONDS, time.monotonic() - started,
+                 postprocessor='Remux' if preset['codec'] == 'copy' else 'Transcode')
+
+# --- FIN TRANSCODIFICACIÓN ---
+
+
+# --- ENTREGA EN STREAMING (FFmpeg -> pipe -> respuesta chunked) ---
+# FFmpeg lee directamente las URLs de los formatos y escribe un contenedor que no necesita
+# seek (MP4 fragmentado, MPEG-TS o MP3) a stdout, que se reenvía al cliente según se produce.
+FFMPEG_BIN = os.environ.get('FFMPEG_BIN', 'ffmpeg')
+STREAM_MAX_CONCURRENT = int(os.environ.get('STREAM_MAX_CONCURRENT', 4))   # procesos FFmpeg de streaming a la vez
+# Conversiones a MP3 al vuelo: gastan CPU como el carril 'cpu' del planificador, con su propio tope
+STREAM_MAX_TRANSCODES = int(os.environ.get('STREAM_MAX_TRANSCODES', os.environ.get('TRANSCODE_WORKERS', 1)))
+STREAM_VIDEO_CONTAINER = os.environ.get('STREAM_VIDEO_CONTAINER', 'mp4')  # 'mp4' (fragmentado) o 'ts'
+# El streaming se ofrece sólo a partir de este tamaño estimado (0 = nunca). Por debajo compensa más
+# la descarga a disco: caché de artefactos, deduplicación, reanudación con Range, reparto de ancho
+# de banda y los fragmentos de yt-dlp (FFmpeg leyendo googlevideo de un tirón acaba estrangulado)
+STREAM_MIN_BYTES = int(os.environ.get('STREAM_MIN_BYTES', 0))
+STREAM_CHUNK_SIZE = 64 * 1024
+# Protocolos que FFmpeg lee por sí mismo; DASH segmentado, f4m, ism... requieren yt-dlp y archivo temporal
+STREAMABLE_PROTOCOLS = {'http', 'https', 'm3u8', 'm3u8_native'}
+_TS_VIDEO_CODECS = ('avc1', 'h264')
+_TS_AUDIO_CODECS = ('mp4a', 'aac', 'mp3')
+
+_active_streams = 0
+_active_transcodes = 0
+_active_streams_lock = threading.Lock()
+
+
+def _is_streamable(fmt: Optional[dict]) -> bool:
+    return bool(fmt) and fmt.get('protocol', 'https') in STREAMABLE_PROTOCOLS
+
+
+def _offer_stream(size: float) -> bool:
+    """Si la tabla de formatos marca como transmitible un archivo de este tamaño estimado."""
+    return STREAM_MIN_BYTES > 0 and size >= STREAM_MIN_BYTES
+
+
+def _stream_plan(info: dict, final_ext: str, preset: Optional[dict] = None) -> Optional[dict]:
+    """Describe cómo producir el archivo por pipe (entradas + contenedor), o None si no es posible."""
+    if preset and preset['codec'] == 'copy':
+        return None  # audio original: descargarlo es igual de rápido y el archivo queda en caché
+    formats = info.get('requested_formats') or [info]
+    inputs = []
+    for f in formats:
+        if not f.get('url') or not _is_streamable(f):
+            return None
+        inputs.append({
+            'url': f['url'],
+            'headers': f.get('http_headers') or {},
+            'vcodec': f.get('vcodec') or 'none',
+            'acodec': f.get('acodec') or 'none',
+        })
+
+    if preset:
+        return {'container': 'mp3', 'inputs': inputs[:1], 'audio_args': audio_codec_args(preset)}
+
+    container = 'mp4'
+    if STREAM_VIDEO_CONTAINER == 'ts':
+        vcodecs = [i['vcodec'] for i in inputs if i['vcodec'] != 'none']
+        acodecs = [i['acodec'] for i in inputs if i['acodec'] != 'none']
+        if all(c.startswith(_TS_VIDEO_CODECS) for c in vcodecs) and all(c.startswith(_TS_AUDIO_CODECS) for c in acodecs):
+            container = 'ts'
+    return {'container': container, 'inputs': inputs[:2]}
+
+
+def _ffmpeg_stream_cmd(plan: dict) -> List[str]:
+    cmd = [FFMPEG_BIN, '-hide_banner', '-loglevel', 'error', '-nostdin']
+    for inp in plan['inputs']:
+        if inp['headers']:
+            cmd += ['-headers', ''.join(f"{k}: {v}\r\n" for k, v in inp['headers'].items())]
+        cmd += ['-i', inp['url']]
+
+    if plan['container'] == 'mp3':
+        return cmd + plan['audio_args'] + ['-f', 'mp3', 'pipe:1']
+
+    if len(plan['inputs']) > 1:
+        cmd += ['-map', '0:v:0', '-map', '1:a:0', '-shortest']
+    else:
+        cmd += ['-map', '0:v:0', '-map', '0:a:0?']
+    cmd += ['-c', 'copy']
+    if plan['container'] == 'ts':
+        return cmd + ['-f', 'mpegts', 'pipe:1']
+    # MP4 fragmentado: moov vacío al principio, no hace falta volver atrás a reescribir índices
+    return cmd + ['-movflags', 'frag_keyframe+empty_moov+default_base_moof', '-f', 'mp4', 'pipe:1']
+
+
+def _check_stream_capacity(plan: dict):
+    """503 si no cabe otra transmisión de este tipo (llamar con _active_streams_lock tomado)."""
+    transcode = plan['container'] == 'mp3'
+    if _active_streams >= STREAM_MAX_CONCURRENT or (transcode and _active_transcodes >= STREAM_MAX_TRANSCODES):
+        raise HTTPException(
+            status_code=503, headers={'Retry-After': '10'},
+            detail="Demasiadas transmisiones en curso. Inténtalo de nuevo en unos segundos."
+        )
+
+
+def _stream_response(plan: dict, filename: str) -> StreamingResponse:
+    """Respuesta chunked alimentada por la salida de FFmpeg."""
+    global _active_streams, _active_transcodes
+    transcode = plan['container'] == 'mp3'
+    # El hueco se reserva al comprobar (límite estricto) y se devuelve una sola vez: al acabar el
+    # cuerpo o, si nunca llega a iterarse (cliente que se va antes), desde la tarea de fondo
+    with _active_streams_lock:
+        _check_stream_capacity(plan)
+        _active_streams += 1
+        if transcode:
+            _active_transcodes += 1
+    held = [True]
+
+    def release():
+        global _active_streams, _active_transcodes
+        with _active_streams_lock:
+            if not held[0]:
+                return
+            held[0] = False
+            _active_streams -= 1
+            if transcode:
+                _active_transcodes -= 1
+
+    cmd = _ffmpeg_stream_cmd(plan)
+
+    async def body():
+        proc = None
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                *cmd, stdin=asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL
+            )
+            if transcode:
+                deprioritize(proc.pid)
+            while True:
+                chunk = await proc.stdout.read(STREAM_CHUNK_SIZE)
+                if not chunk:
+                    break
+                SERVED_BYTES.inc(len(chunk), mode='stream')
+                yield chunk
+            if await proc.wait() != 0:
+                print(f"[WARN] FFmpeg (streaming) terminó con código {proc.returncode}")
+        finally:
+            # Cliente desconectado o error: no dejar FFmpeg huérfano
+            if proc is not None and proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+            release()
+
+    media_types = {'mp3': 'audio/mpeg', 'mp4': 'video/mp4', 'ts': 'video/mp2t'}
+    if plan['container'] == 'ts':
+        filename = f"{Path(filename).stem}.ts"
+    return StreamingResponse(body(), media_type=media_types[plan['container']], headers={
+        'Content-Disposition': _content_disposition(filename),
+    }, background=BackgroundTask(release))
+
+
+def _prepare_stream(file_id: str, url: str, final_ext: str, ydl_opts: dict, key: str, info: Optional[dict] = None,
+                    audio_preset: Optional[str] = None):
+    """Resuelve los formatos elegidos sin descargarlos; si no se pueden transmitir, descarga a disco."""
+    try:
+        with ydl_pool.lease(ydl_opts) as ydl:
+            if info is not None:
+                info = ydl.process_ie_result(info, download=False)
+            else:
+                info = ydl.extract_info(url, download=False)
+    except Exception as e:
+        print(f"[ERROR] Extracción para streaming fallida ({file_id}): {e}")
+        domain_breaker.record(strategy_scope(url), classify_failure(str(e)))
+        _finish_flight(key, file_id, {'status': 'error', 'message': f'Error: {str(e)[:200]}'})
+        return
+    domain_breaker.record(strategy_scope(url), None)
+
+    plan = _stream_plan(info, final_ext, AUDIO_PRESETS.get(audio_preset)) if info else None
+    if plan is None:
+        print(f"[INFO] {file_id}: formato no transmitible, descargando a disco")
+        return _run_download(file_id, url, final_ext, ydl_opts, key, info, audio_preset)
+
+    ext = 'mp3' if plan['container'] == 'mp3' else 'mp4'
+    _finish_flight(key, file_id, {
+        'percent': 100, 'status': 'ready',
+        'message': '✅ ¡Listo! Transmitiendo archivo...',
+        'filename': _user_filename(info.get('title') or 'video', ext),
+        'path': None,
+        'stream': plan
+    })
+
+
+# --- CACHÉ DE ARTEFACTOS Y DEDUPLICACIÓN DE DESCARGAS ---
+# Los archivos terminados se guardan por contenido (url canónica + format_id) y se comparten
+# entre peticiones. Cada file_id que apunta a un artefacto es un "holder"; sólo se pueden
+# desalojar (LRU) los artefactos sin holders.
+ARTIFACT_DIR = DOWNLOAD_DIR / "artifacts"
+ARTIFACT_CACHE_MAX_BYTES = int(os.environ.get('ARTIFACT_CACHE_MAX_BYTES', 2 * 1024 ** 3))
+
+
+def artifact_key(url: str, format_id: str) -> str:
+    return hashlib.sha256(f"{canonicalize_url(url)}\n{format_id}".encode('utf-8')).hexdigest()[:32]
 
-    def hook(d):
-        if d['status'] == 'downloading':
-            try:
-                total = d.get('total_bytes') or d.get('total_bytes_estimate', 0)
-                done = d.get('downloaded_bytes', 0)
-                pct = (done / total * 100) if total > 0 else 0
 
-                if download_count[0] == 0:  # Descargando video (0-70%)
-                    mapped = pct * 0.70
-                    msg = f'📥 Descargando video... {pct:.0f}%'
-                else:                        # Descargando audio (70-90%)
-                    mapped = 70 + pct * 0.20
-                    msg = f'🎵 Descargando audio... {pct:.0f}%'
+class ArtifactCache:
+    """Archivos terminados direccionados por clave, con conteo de referencias y desalojo LRU."""
 
-                download_progress[file_id].update({
-                    'percent': round(mapped, 1),
-                    'status': 'downloading',
-                    'message': msg
-                })
-            except Exception:
-                pass
+    def __init__(self, root: Path, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._entries = OrderedDict()  # {key: {'path', 'size', 'filename', 'holders', 'accessed'}}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._load()
 
-        elif d['status'] == 'finished':
-            download_count[0] += 1
-            if download_count[0] == 1:
-                download_progress[file_id].update({
-                    'percent': 70, 'message': '🎵 Descargando audio...'
-                })
+    def lookup(self, key: str) -> Optional[dict]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if not entry['path'].exists():
+                self._drop(key)
+                return None
+            self._entries.move_to_end(key)
+            entry['accessed'] = time.time()
+            return entry
+
+    def add(self, key: str, src: Path, filename: str, holder: str) -> Path:
+        """Mueve `src` a la caché bajo `key` (ya retenido por `holder`) y devuelve la ruta definitiva.
+
+        El holder se toma bajo el mismo lock que el desalojo: si no, un artefacto recién
+        añadido sin holders (o más grande que max_bytes) se desalojaría en el acto.
+        """
+        dest = self.root / f"{key}{src.suffix}"
+        os.replace(src, dest)
+        try:
+            (self.root / f"{key}.json").write_text(json.dumps({'filename': filename}), encoding='utf-8')
+        except OSError as e:
+            print(f"[WARN] No se pudo guardar metadatos del artefacto {key}: {e}")
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._entries[key]['size']
+                holders = self._entries[key]['holders']
             else:
-                download_progress[file_id].update({
-                    'percent': 90, 'status': 'merging',
-                    'message': '⚙️ Combinando streams con FFmpeg...'
-                })
-    return hook
+                holders = set()
+            holders.add(holder)
+            size = dest.stat().st_size
+            self._entries[key] = {'path': dest, 'size': size, 'filename': filename, 'holders': holders,
+                                  'accessed': time.time()}
+            self._entries.move_to_end(key)
+            self._bytes += size
+            self._evict()
+        return dest
 
+    def acquire(self, key: str, holder: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry['holders'].add(holder)
+                entry['accessed'] = time.time()
+                self._entries.move_to_end(key)
 
-def _run_download(file_id: str, url: str, final_ext: str, ydl_opts: dict):
-    """Ejecuta yt-dlp + FFmpeg en un hilo separado."""
-    try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=True)
-            video_title = (info.get('title') if info else None) or 'video'
+    def release(self, key: str, holder: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry['holders'].discard(holder)
+                self._evict()
 
-        # Buscar el archivo generado
-        final_path = DOWNLOAD_DIR / f"{file_id}.{final_ext}"
-        if not final_path.exists():
-            found = list(DOWNLOAD_DIR.glob(f"{file_id}.*"))
-            if found:
-                final_path = found[0]
-                final_ext = final_path.suffix.lstrip('.')
-            else:
-                download_progress[file_id].update({
-                    'status': 'error', 'message': 'Archivo no encontrado tras la descarga.'
-                })
-                return
+    def trim(self, max_bytes: Optional[int] = None, max_age: Optional[float] = None) -> int:
+        """Desaloja artefactos sin holders, del menos usado al más usado, hasta ocupar <= max_bytes
+        y todos los no usados en `max_age` segundos. Devuelve los bytes liberados."""
+        freed = 0
+        cutoff = time.time() - max_age if max_age else None
+        with self._lock:
+            for key in [k for k, e in self._entries.items() if not e['holders']]:
+                entry = self._entries[key]
+                too_big = max_bytes is not None and self._bytes > max_bytes
+                too_old = cutoff is not None and entry['accessed'] < cutoff
+                if not (too_big or too_old):
+                    continue
+                print(f"[INFO] Desalojando artefacto {key} ({format_size(entry['size'])})")
+                freed += entry['size']
+                self._drop(key)
+        return freed
 
-        safe_title = "".join(c for c in video_title if c.isalnum() or c in (' ', '-', '_')).strip()
-        user_filename = f"{safe_title}.{final_ext}"
+    @property
+    def bytes(self) -> int:
+        return self._bytes
 
-        download_progress[file_id].update({
-            'percent': 100, 'status': 'ready',
-            'message': '✅ ¡Listo! Descargando archivo...',
-            'filename': user_filename,
-            'path': str(final_path)
-        })
+    def release_orphans(self, is_alive) -> int:
+        """Suelta los holders cuyo trabajo ya no existe (expirado, o recogido por otro proceso)."""
+        with self._lock:
+            holders = [(key, h) for key, e in self._entries.items() for h in e['holders']]
+        dead = [(key, h) for key, h in holders if not is_alive(h)]
+        with self._lock:
+            for key, holder in dead:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    entry['holders'].discard(holder)
+            if dead:
+                self._evict()
+        return len(dead)
 
-    except Exception as e:
-        print(f"[ERROR] Descarga fallida ({file_id}): {e}")
-        download_progress[file_id].update({
-            'status': 'error', 'message': f'Error: {str(e)[:200]}'
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'held': sum(1 for e in self._entries.values() if e['holders']),
+            }
+
+    # --- internos (llamar con el lock tomado, salvo _load) ---
+
+    def _load(self):
+        # Recuperar artefactos de una ejecución anterior (sobreviven reinicios)
+        for path in sorted(self.root.iterdir(), key=lambda p: p.stat().st_mtime):
+            if path.suffix == '.json' or not path.is_file():
+                continue
+            key = path.stem
+            filename = f"video{path.suffix}"
+            try:
+                meta = json.loads((self.root / f"{key}.json").read_text(encoding='utf-8'))
+                filename = meta.get('filename') or filename
+            except (OSError, ValueError):
+                pass
+            stat = path.stat()
+            self._entries[key] = {'path': path, 'size': stat.st_size, 'filename': filename, 'holders': set(),
+                                  'accessed': stat.st_mtime}
+            self._bytes += stat.st_size
+        with self._lock:
+            self._evict()
+
+    def _drop(self, key: str):
+        entry = self._entries.pop(key)
+        self._bytes -= entry['size']
+        for path in (entry['path'], self.root / f"{key}.json"):
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f"[WARN] No se pudo borrar {path}: {e}")
+
+    def _evict(self):
+        if self._bytes <= self.max_bytes:
+            return
+        for key in [k for k, e in self._entries.items() if not e['holders']]:
+            if self._bytes <= self.max_bytes:
+                break
+            print(f"[INFO] Desalojando artefacto {key} ({format_size(self._entries[key]['size'])})")
+            self._drop(key)
+
+
+artifact_cache = ArtifactCache(ARTIFACT_DIR, ARTIFACT_CACHE_MAX_BYTES)
+
+# Descargas en vuelo: {artifact_key: [file_id principal, file_ids adjuntos...]}
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+def _attach_to_existing(key: str, file_id: str) -> bool:
+    """Si el artefacto ya existe o se está descargando, asocia `file_id` a él.
+
+    Si no, registra `file_id` como descarga principal del vuelo y devuelve False.
+    """
+    with _flights_lock:
+        entry = artifact_cache.lookup(key)
+        if entry is not None:
+            artifact_cache.acquire(key, file_id)
+            job_store.create(file_id, {
+                'percent': 100, 'status': 'ready',
+                'message': '✅ ¡Listo! Descargando archivo...',
+                'filename': entry['filename'], 'path': str(entry['path']),
+                'queue_position': None, 'artifact': key
+            })
+            print(f"[INFO] Artefacto en caché para {file_id} ({key})")
+            return True
+
+        flight = _flights.get(key)
+        if flight is not None:
+            primary = job_store.get(flight[0]) or {}
+            flight.append(file_id)
+            job_store.create(file_id, {**primary, 'artifact': key})
+            print(f"[INFO] {file_id} se une a la descarga en curso {flight[0]} ({key})")
+            return True
+
+        _flights[key] = [file_id]
+        # Dentro del lock: quien se una a este vuelo copia ya un estado completo
+        job_store.create(file_id, {
+            'percent': 0, 'status': 'queued',
+            'message': 'En cola...', 'filename': None, 'path': None,
+            'queue_position': None, 'artifact': key
         })
-        # Limpiar archivos parciales
-        for f in DOWNLOAD_DIR.glob(f"{file_id}.*"):
-            try: os.remove(f)
-            except: pass
+        return False
+
+
+def _abandon_flight(key: str, file_id: str, error: HTTPException):
+    """El principal del vuelo fue rechazado antes de encolarse: cierra el vuelo y pasa el error
+    a las peticiones que se hayan unido mientras tanto."""
+    with _flights_lock:
+        members = _flights.pop(key, None) or [file_id]
+    job_store.delete(file_id)
+    for member in members:
+        if member != file_id and job_store.update(member, {'status': 'error', 'message': f'Error: {error.detail}'},
+                                                  ttl=JOB_ERROR_TTL):
+            progress_broker.publish(member)
+
+
+def _finish_flight(key: str, file_id: str, fields: dict):
+    """Cierra el vuelo: todos los file_ids adjuntos reciben el resultado (y una referencia si está listo)."""
+    with _flights_lock:
+        members = _flights.pop(key, None) or [file_id]
+        if fields.get('status') == 'ready':
+            for member in members:
+                artifact_cache.acquire(key, member)
+    ttl = JOB_ERROR_TTL if fields.get('status') == 'error' else None
+    DOWNLOAD_JOBS.inc(outcome=fields.get('status', 'unknown'))
+    for member in members:
+        if job_store.update(member, fields, ttl=ttl):
+            progress_broker.publish(member)
+
+
+# --- JANITOR DE DOWNLOAD_DIR ---
+# Mantiene el directorio de descargas dentro de una cuota: borra intermedios huérfanos de yt-dlp
+# (.part, .f137.mp4, .ytdl, .temp...) de trabajos que ya no están activos, desaloja artefactos
+# sin reclamar por antigüedad y por marcas de agua, y rechaza trabajos nuevos antes de llenar el disco.
+DOWNLOAD_DIR_QUOTA_BYTES = int(os.environ.get('DOWNLOAD_DIR_QUOTA_BYTES', 4 * 1024 ** 3))
+DOWNLOAD_MIN_FREE_BYTES = int(os.environ.get('DOWNLOAD_MIN_FREE_BYTES', 512 * 1024 ** 2))  # libre en el disco
+JANITOR_HIGH_WATERMARK = float(os.environ.get('JANITOR_HIGH_WATERMARK', 0.90))   # fracción de la cuota
+JANITOR_LOW_WATERMARK = float(os.environ.get('JANITOR_LOW_WATERMARK', 0.75))
+JANITOR_MAX_AGE = int(os.environ.get('JANITOR_MAX_AGE', 6 * 3600))               # artefactos sin reclamar
+JANITOR_INTERVAL = int(os.environ.get('JANITOR_INTERVAL', 60))
+# Un intermedio modificado hace menos de esto se respeta aunque su trabajo no figure como activo:
+# puede estar escribiéndolo otro proceso (varios workers o un reinicio escalonado)
+JANITOR_ORPHAN_GRACE = int(os.environ.get('JANITOR_ORPHAN_GRACE', 60))
+
+# Los intermedios de yt-dlp empiezan por el file_id (outtmpl = "{file_id}.%(ext)s")
+_JOB_FILE_RE = re.compile(r'^([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})\.')
+_ACTIVE_STATUSES = ('queued', 'downloading', 'merging')
+
+
+class DiskJanitor:
+    def __init__(self, root: Path, quota: int):
+        self.root = root
+        self.quota = quota
+        self._usage = 0
+        self._usage_at = 0.0
+        self._lock = threading.Lock()
+
+    def usage(self, max_staleness: float = 5.0) -> int:
+        """Bytes ocupados en DOWNLOAD_DIR (recorrer el árbol como mucho cada `max_staleness` s)."""
+        if time.monotonic() - self._usage_at > max_staleness:
+            total = 0
+            for dirpath, _, filenames in os.walk(self.root):
+                for name in filenames:
+                    try:
+                        total += os.stat(os.path.join(dirpath, name)).st_size
+                    except OSError:
+                        pass
+            self._usage = total
+            self._usage_at = time.monotonic()
+        return self._usage
+
+    def reclaim_orphans(self, grace: float = JANITOR_ORPHAN_GRACE) -> int:
+        """Borra archivos de trabajos que ya no están activos. Devuelve los bytes liberados."""
+        freed = 0
+        cutoff = time.time() - grace
+        for path in self.root.iterdir():
+            match = _JOB_FILE_RE.match(path.name)
+            if not match or not path.is_file():
+                continue
+            job = job_store.get(match.group(1))
+            if job and job.get('status') in _ACTIVE_STATUSES:
+                continue
+            try:
+                stat = path.stat()
+                if stat.st_mtime > cutoff:
+                    continue
+                path.unlink()
+                freed += stat.st_size
+                print(f"[INFO] Janitor: huérfano eliminado {path.name} ({format_size(stat.st_size)})")
+            except OSError as e:
+                print(f"[WARN] Janitor: no se pudo borrar {path}: {e}")
+        return freed
+
+    def run_once(self) -> int:
+        with self._lock:
+            freed = self.reclaim_orphans()
+            freed += artifact_cache.trim(max_age=JANITOR_MAX_AGE)
+            usage = self.usage(max_staleness=0)
+            if usage > self.quota * JANITOR_HIGH_WATERMARK:
+                # Bajar hasta la marca inferior para no volver a dispararse en cada pasada
+                excess = usage - int(self.quota * JANITOR_LOW_WATERMARK)
+                freed += artifact_cache.trim(max_bytes=max(0, artifact_cache.bytes - excess))
+                usage = self.usage(max_staleness=0)
+                if usage > self.quota * JANITOR_HIGH_WATERMARK:
+                    print(f"[WARN] Janitor: {format_size(usage)} en uso, todo lo restante está reclamado o en curso")
+            return freed
+
+    def has_room(self) -> bool:
+        """Hay sitio para un trabajo nuevo (cuota propia y espacio libre real en el disco)."""
+        try:
+            free = shutil.disk_usage(self.root).free
+        except OSError:
+            free = DOWNLOAD_MIN_FREE_BYTES
+        return self.usage() < self.quota * JANITOR_HIGH_WATERMARK and free >= DOWNLOAD_MIN_FREE_BYTES
+
+    def ensure_room(self):
+        """Control de admisión: intenta liberar espacio y, si no hay, rechaza con 507."""
+        if self.has_room():
+            return
+        self.run_once()
+        if not self.has_room():
+            raise HTTPException(
+                status_code=507, headers={'Retry-After': '60'},
+                detail="El servidor no tiene espacio en disco ahora mismo. Inténtalo más tarde."
+            )
+
+
+disk_janitor = DiskJanitor(DOWNLOAD_DIR, DOWNLOAD_DIR_QUOTA_BYTES)
+
+
+def _janitor_forever():
+    # Al arrancar no hay trabajos propios en curso, pero puede haberlos de otro proceso (con el
+    # store en memoria no se ven): se aplica la misma gracia que en las pasadas normales
+    freed = disk_janitor.reclaim_orphans()
+    if freed:
+        print(f"[INFO] Janitor: {format_size(freed)} recuperados al arrancar")
+    while True:
+        try:
+            disk_janitor.run_once()
+        except Exception as e:
+            print(f"[WARN] Janitor: {e}")
+        time.sleep(JANITOR_INTERVAL)
+
+
+# --- PLANIFICADOR DE DESCARGAS (COLA + WORKERS) ---
+# En vez de un hilo por petición, un número fijo de workers consume una cola acotada.
+# Carril 'io': descargas de video (yt-dlp + merge con stream copy).
+# Carril 'cpu': conversiones a MP3, más pequeño para no dejar sin CPU al resto.
+DOWNLOAD_WORKERS = int(os.environ.get('DOWNLOAD_WORKERS', 3))
+TRANSCODE_WORKERS = int(os.environ.get('TRANSCODE_WORKERS', 1))
+DOWNLOAD_QUEUE_MAX = int(os.environ.get('DOWNLOAD_QUEUE_MAX', 50))                   # trabajos en espera (todos los carriles)
+DOWNLOAD_MAX_JOBS_PER_CLIENT = int(os.environ.get('DOWNLOAD_MAX_JOBS_PER_CLIENT', 3))  # en cola + en curso
+DOWNLOAD_MAX_PRIORITY = int(os.environ.get('DOWNLOAD_MAX_PRIORITY', 2))              # tope del parámetro priority
+# Proxies cuyo X-Forwarded-For se cree (IPs o redes separadas por comas). Por defecto, loopback y redes
+# privadas: el proxy de HF/Railway conecta desde ahí; un cliente directo no puede falsear su IP
+TRUSTED_PROXIES = [
+    ipaddress.ip_network(net.strip(), strict=False)
+    for net in os.environ.get(
+        'TRUSTED_PROXIES', '127.0.0.0/8,10.0.0.0/8,172.16.0.0/12,192.168.0.0/16,::1/128,fc00::/7'
+    ).split(',') if net.strip()
+]
+
+
+def _is_trusted_proxy(host: str) -> bool:
+    try:
+        addr = ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return any(addr in net for net in TRUSTED_PROXIES)
+
+
+def _client_id(request: Request) -> str:
+    """Identifica al cliente para los límites de equidad (IP real detrás del proxy de HF/Railway).
+
+    X-Forwarded-For sólo se atiende si la conexión viene de un proxy de confianza. Cada proxy añade
+    a la derecha la IP que le conecta, así que se toma el salto más a la derecha que no es nuestro:
+    lo que haya a su izquierda lo escribió el propio cliente.
+    """
+    peer = request.client.host if request.client else 'unknown'
+    forwarded = ','.join(request.headers.getlist('x-forwarded-for'))
+    if not forwarded or not _is_trusted_proxy(peer):
+        return peer
+    hops = [hop.strip() for hop in forwarded.split(',') if hop.strip()]
+    for hop in reversed(hops):
+        if not _is_trusted_proxy(hop):
+            return hop
+    return hops[0] if hops else peer
+
+
+class DownloadJob:
+    def __init__(self, file_id: str, client_id: str, lane: str, target, args: tuple, priority: int = 0,
+                 key: Optional[str] = None):
+        self.file_id = file_id
+        self.client_id = client_id
+        self.lane = lane
+        self.target = target
+        self.args = args
+        self.priority = priority  # mayor = más urgente
+        self.key = key            # vuelo (deduplicación) que cierra el trabajo
+        self.seq = 0
+        self.enqueued_at = 0.0
+
+
+class DownloadScheduler:
+    """Cola con prioridad por carriles, límites por cliente y control de admisión."""
+
+    def __init__(self, lanes: dict, max_queue: int, max_per_client: int):
+        self.lanes = lanes                      # {carril: nº de workers}
+        self.max_queue = max_queue
+        self.max_per_client = max_per_client
+        self._queues = {lane: [] for lane in lanes}
+        self._running = {}                      # {client_id: nº de trabajos en curso}
+        self._queued_by_client = {}             # {client_id: nº de trabajos en cola}
+        self._seq = 0
+        self._cond = threading.Condition()
+        self._started = False
+
+    def submit(self, job: DownloadJob) -> int:
+        """Encola el trabajo y devuelve su posición (1 = el próximo). Lanza 429/503 si no se admite."""
+        with self._cond:
+            self._ensure_workers()
+            queued = sum(len(q) for q in self._queues.values())
+            if queued >= self.max_queue:
+                raise HTTPException(
+                    status_code=503, headers={'Retry-After': '30'},
+                    detail="El servidor está ocupado. Inténtalo de nuevo en unos segundos."
+                )
+            active = self._running.get(job.client_id, 0) + self._queued_by_client.get(job.client_id, 0)
+            if active >= self.max_per_client:
+                raise HTTPException(
+                    status_code=429, headers={'Retry-After': '10'},
+                    detail=f"Ya tienes {active} descargas en curso. Espera a que termine alguna."
+                )
+            self._seq += 1
+            job.seq = self._seq
+            job.enqueued_at = time.monotonic()
+            self._queues[job.lane].append(job)
+            self._queued_by_client[job.client_id] = self._queued_by_client.get(job.client_id, 0) + 1
+            self._cond.notify_all()
+            return self._position(job)
+
+    def position(self, file_id: str) -> Optional[int]:
+        with self._cond:
+            for lane_jobs in self._queues.values():
+                for job in lane_jobs:
+                    if job.file_id == file_id:
+                        return self._position(job)
+        return None
+
+    def snapshot(self) -> dict:
+        with self._cond:
+            return {
+                'queued': {lane: len(q) for lane, q in self._queues.items()},
+                'running': sum(self._running.values()),
+                'workers': self.lanes,
+            }
+
+    # --- internos (llamar con el lock tomado) ---
+
+    def _ensure_workers(self):
+        if self._started:
+            return
+        self._started = True
+        for lane, count in self.lanes.items():
+            for i in range(count):
+                threading.Thread(target=self._worker, args=(lane,), name=f'dl-{lane}-{i}', daemon=True).start()
+
+    def _sort_key(self, job: DownloadJob):
+        # Prioridad primero; a igualdad, el cliente con menos trabajos en curso; después FIFO
+        return (-job.priority, self._running.get(job.client_id, 0), job.seq)
+
+    def _position(self, job: DownloadJob) -> int:
+        key = self._sort_key(job)
+        return 1 + sum(1 for other in self._queues[job.lane] if self._sort_key(other) < key)
+
+    def _worker(self, lane: str):
+        while True:
+            with self._cond:
+                while not self._queues[lane]:
+                    self._cond.wait()
+                lane_jobs = self._queues[lane]
+                job = min(lane_jobs, key=self._sort_key)
+                lane_jobs.remove(job)
+                self._queued_by_client[job.client_id] -= 1
+                if not self._queued_by_client[job.client_id]:
+                    del self._queued_by_client[job.client_id]
+                self._running[job.client_id] = self._running.get(job.client_id, 0) + 1
+
+            waited = time.monotonic() - job.enqueued_at
+            observe_span(QUEUE_WAIT_SECONDS, waited, lane=lane)
+            print(f"[INFO] Worker {lane} toma {job.file_id} (esperó {waited:.1f}s en cola)")
+            update_progress(job.file_id, {
+                'status': 'downloading', 'message': 'Iniciando descarga...', 'queue_position': None
+            })
+            try:
+                with bandwidth.job(job.file_id, job.priority):
+                    job.target(*job.args)
+            except Exception as e:
+                print(f"[ERROR] Worker {lane}: trabajo {job.file_id} falló: {e}")
+                # El objetivo no llegó a cerrar el trabajo: si no, él y los adjuntos a su vuelo
+                # esperarían hasta que el janitor los expire
+                data = job_store.get(job.file_id)
+                if data and data.get('status') in _ACTIVE_STATUSES:
+                    error = {'status': 'error', 'message': f'Error: {str(e)[:200]}'}
+                    if job.key is not None:
+                        _finish_flight(job.key, job.file_id, error)
+                    else:
+                        update_progress(job.file_id, error)
+            finally:
+                with self._cond:
+                    self._running[job.client_id] -= 1
+                    if not self._running[job.client_id]:
+                        del self._running[job.client_id]
+                    self._cond.notify_all()
+
+
+download_scheduler = DownloadScheduler(
+    lanes={'io': DOWNLOAD_WORKERS, 'cpu': TRANSCODE_WORKERS},
+    max_queue=DOWNLOAD_QUEUE_MAX,
+    max_per_client=DOWNLOAD_MAX_JOBS_PER_CLIENT,
+)
+
+# --- FIN PLANIFICADOR DE DESCARGAS ---
+
+
+def _progress_view(file_id: str) -> Optional[dict]:
+    """Estado de una descarga tal como se envía al cliente (con la posición en cola al día)."""
+    data = job_store.get(file_id)
+    if data is None:
+        return None
+    if data.get('status') == 'queued':
+        position = download_scheduler.position(file_id)
+        if position:
+            data = {**data, 'queue_position': position, 'message': f'En cola (posición {position})...'}
+    return dict(data)
 
 
 @app.get("/progress/{file_id}")
 def get_progress(file_id: str):
     """Devuelve el progreso actual de una descarga."""
-    data = download_progress.get(file_id)
+    data = _progress_view(file_id)
     if data is None:
         raise HTTPException(status_code=404, detail="Descarga no encontrada")
     return JSONResponse(data)
 
 
-@app.get("/get-file/{file_id}")
-def get_file(file_id: str, background_tasks: BackgroundTasks):
-    """Sirve el archivo cuando está listo. Sólo funciona si status='ready'."""
-    data = download_progress.get(file_id)
+@app.get("/progress/{file_id}/stream")
+async def stream_progress(file_id: str, request: Request):
+    """Progreso por Server-Sent Events: un evento por cambio, como máximo PROGRESS_STREAM_MAX_RATE por segundo."""
+    # El store puede ser SQLite (lock + disco): nunca se consulta directamente en el event loop
+    if await run_in_threadpool(_progress_view, file_id) is None:
+        raise HTTPException(status_code=404, detail="Descarga no encontrada")
+
+    async def events():
+        subscription = progress_broker.subscribe(file_id)
+        min_interval = 1.0 / PROGRESS_STREAM_MAX_RATE
+        last_sent = None
+        last_emit = 0.0
+        try:
+            while True:
+                data = await run_in_threadpool(_progress_view, file_id)
+                if data is None:
+                    yield "event: gone\ndata: {}\n\n"
+                    return
+                if data != last_sent:
+                    yield f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+                    last_sent = data
+                    last_emit = time.monotonic()
+                    if data.get('status') in ('ready', 'error'):
+                        return
+                elif time.monotonic() - last_emit >= PROGRESS_STREAM_KEEPALIVE:
+                    yield ": keepalive\n\n"
+                    last_emit = time.monotonic()
+
+                if await request.is_disconnected():
+                    return
+                # Coalescer: varias actualizaciones dentro del intervalo se envían como una sola
+                await asyncio.sleep(min_interval)
+                # Esperar el siguiente cambio; el timeout cubre cambios hechos por otro proceso
+                await subscription.wait(timeout=1.0)
+        finally:
+            progress_broker.unsubscribe(file_id, subscription)
+
+    return StreamingResponse(events(), media_type='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',  # evitar que proxies (nginx) acumulen el stream
+    })
+
+
+# --- ENTREGA DE ARCHIVOS (Range / ETag / sendfile) ---
+# Las descargas interrumpidas se reanudan con Range (If-Range/ETag evitan mezclar versiones).
+# El cuerpo se lee por trozos en el threadpool; detrás de nginx/Apache se puede delegar el
+# envío entero (con sendfile) mediante X-Accel-Redirect / X-Sendfile.
+DELIVERY_OFFLOAD = os.environ.get('DELIVERY_OFFLOAD', '').lower()   # '', 'x-accel' o 'x-sendfile'
+# Location interna de nginx ("internal; alias DOWNLOAD_DIR/;") para X-Accel-Redirect
+DELIVERY_OFFLOAD_PREFIX = os.environ.get('DELIVERY_OFFLOAD_PREFIX', '/_downloads/')
+FILE_CHUNK_SIZE = 256 * 1024
+_RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def _content_disposition(filename: str) -> str:
+    return f"attachment; filename*=utf-8''{quote(filename)}"
+
+
+def _parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """(inicio, fin) inclusivos de un Range de un solo tramo; None si no aplica (se sirve entero).
+    ValueError si el tramo no se puede satisfacer."""
+    match = _RANGE_RE.match(header.strip())
+    if not match or match.group(1) == match.group(2) == '':
+        return None  # varios tramos o sintaxis desconocida: se permite responder con el archivo completo
+    first, last = match.groups()
+    if first == '':
+        length = int(last)
+        if length == 0:
+            raise ValueError('rango vacío')
+        return max(0, size - length), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise ValueError('rango fuera del archivo')
+    return start, end
+
+
+class RangeFileResponse(Response):
+    """Archivo con soporte de Range, If-Range y ETag/If-None-Match."""
+
+    def __init__(self, path: str, filename: str, request: Request, media_type: str = 'application/octet-stream'):
+        self.path = path
+        stat = os.stat(path)
+        size = stat.st_size
+        etag = f'"{stat.st_mtime_ns:x}-{size:x}"'
+        last_modified = time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime(stat.st_mtime))
+        headers = {
+            'Accept-Ranges': 'bytes', 'ETag': etag, 'Last-Modified': last_modified,
+            'Content-Disposition': _content_disposition(filename),
+        }
+        status, self.start, self.end = 200, 0, size - 1
+
+        range_header = request.headers.get('range')
+        if_range = request.headers.get('if-range')
+        if request.headers.get('if-none-match') == etag and not range_header:
+            status = 304
+        elif range_header and (not if_range or if_range in (etag, last_modified)):
+            try:
+                byte_range = _parse_range(range_header, size)
+            except ValueError:
+                byte_range, status = None, 416
+                headers['Content-Range'] = f'bytes */{size}'
+            if byte_range:
+                status, (self.start, self.end) = 206, byte_range
+                headers['Content-Range'] = f'bytes {self.start}-{self.end}/{size}'
+
+        self.send_body = status in (200, 206) and request.method != 'HEAD'
+        if status == 304:
+            # Un 304 no lleva cabeceras de la representación (ni Content-Length ni tipo)
+            headers = {'ETag': etag, 'Last-Modified': last_modified}
+            media_type = None
+        else:
+            headers['Content-Length'] = str(self.end - self.start + 1 if status in (200, 206) else 0)
+        super().__init__(status_code=status, headers=headers, media_type=media_type)
+
+    async def __call__(self, scope, receive, send):
+        await send({'type': 'http.response.start', 'status': self.status_code, 'headers': self.raw_headers})
+        if not self.send_body:
+            await send({'type': 'http.response.body', 'body': b''})
+        else:
+            count = self.end - self.start + 1
+            with open(self.path, 'rb') as f:
+                await run_in_threadpool(f.seek, self.start)
+                while count > 0:
+                    chunk = await run_in_threadpool(f.read, min(FILE_CHUNK_SIZE, count))
+                    if not chunk:
+                        break
+                    count -= len(chunk)
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': count > 0})
+                    SERVED_BYTES.inc(len(chunk), mode='file')
+                if count > 0:
+                    await send({'type': 'http.response.body', 'body': b''})
+        if self.background is not None:
+            await self.background()
+
+
+def _offloaded_response(path: str, filename: str) -> Response:
+    """El proxy (nginx/Apache) sirve el archivo con sendfile, Range y ETag propios."""
+    headers = {'Content-Disposition': _content_disposition(filename)}
+    if DELIVERY_OFFLOAD == 'x-accel':
+        relative = Path(path).resolve().relative_to(DOWNLOAD_DIR.resolve()).as_posix()
+        headers['X-Accel-Redirect'] = DELIVERY_OFFLOAD_PREFIX.rstrip('/') + '/' + quote(relative)
+    else:
+        headers['X-Sendfile'] = str(Path(path).resolve())
+    SERVED_BYTES.inc(Path(path).stat().st_size, mode='offload')
+    return Response(headers=headers, media_type='application/octet-stream')
+
+
+def _release_delivery(file_id: str, data: dict, grace_until: float):
+    """Suelta el archivo del trabajo tras su última entrega; se marca antes para cortar reanudaciones."""
+    job_store.update(file_id, {'released': True}, ttl=max(1, int(grace_until - time.time())))
+    if data.get('artifact'):
+        artifact_cache.release(data['artifact'], file_id)
+    else:
+        cleanup_file(Path(data['path']))
+
+
+@app.api_route("/get-file/{file_id}", methods=['GET', 'HEAD'])
+def get_file(file_id: str, request: Request, background_tasks: BackgroundTasks):
+    """Sirve el archivo cuando está listo. Sólo funciona si status='ready'.
+
+    Tras la primera entrega el archivo sigue disponible JOB_DELIVERED_TTL segundos para
+    reintentos y reanudaciones (Range), hasta JOB_MAX_DELIVERIES descargas desde el principio.
+    Sólo cuenta como entrega un GET que envía el archivo (200/206); HEAD, 304 y 416 no gastan intentos.
+    """
+    data = job_store.get(file_id)
     if not data or data.get('status') != 'ready':
         raise HTTPException(status_code=404, detail="Archivo no disponible aún")
 
+    # Tras la última entrega el trabajo ya no retiene el archivo: tampoco se sirven reanudaciones,
+    # el artefacto podría desalojarse (o borrarse) a mitad de la respuesta
+    if data.get('released'):
+        raise HTTPException(status_code=410, detail="Se agotaron los intentos de descarga de este archivo")
+
     path = data['path']
     filename = data['filename']
 
-    if not path or not Path(path).exists():
+    if not data.get('stream') and (not path or not Path(path).exists()):
         raise HTTPException(status_code=404, detail="Archivo no encontrado en disco")
+    if data.get('stream') or DELIVERY_OFFLOAD in ('x-accel', 'x-sendfile'):
+        # FFmpeg o el proxy producen el cuerpo: a un HEAD sólo se le contesta con las cabeceras
+        # (y el 503 si ahora mismo no cabe otra transmisión: la página sondea así antes de navegar)
+        if request.method == 'HEAD':
+            if data.get('stream'):
+                with _active_streams_lock:
+                    _check_stream_capacity(data['stream'])
+            return Response(headers={'Content-Disposition': _content_disposition(filename)})
+        # El proxy resuelve Range/ETag por su cuenta: cualquier GET cuenta
+        response = (_stream_response(data['stream'], filename) if data.get('stream')
+                    else _offloaded_response(path, filename))
+    else:
+        response = RangeFileResponse(path, filename, request)
+        if not response.send_body:
+            return response
+
+    # Sólo cuentan las descargas desde el byte 0: reanudar o pedir tramos en paralelo no gasta intentos
+    range_header = request.headers.get('range') or ''
+    from_start = not range_header or range_header.strip().startswith('bytes=0-')
+    deliveries = data.get('deliveries', 0)
+    if from_start and deliveries >= JOB_MAX_DELIVERIES:
+        raise HTTPException(status_code=410, detail="Se agotaron los intentos de descarga de este archivo")
+    if from_start:
+        deliveries += 1
+
+    # La ventana de gracia empieza en la primera entrega y no se alarga con los reintentos;
+    # al expirar, el reaper suelta el artefacto
+    now = time.time()
+    grace_until = data.get('grace_until') or now + JOB_DELIVERED_TTL
+    job_store.update(file_id, {'delivered': True, 'deliveries': deliveries, 'grace_until': grace_until},
+                     ttl=max(1, int(grace_until - now)))
+
+    # Última entrega permitida: soltar nuestra referencia al terminar (el artefacto puede seguir sirviendo a otros)
+    if from_start and deliveries >= JOB_MAX_DELIVERIES and not data.get('stream'):
+        background_tasks.add_task(_release_delivery, file_id, data, grace_until)
+    return response
+
+
+
+# --- LOTES Y PLAYLISTS ---
+# /batch/analyze analiza varias URLs (o las entradas de una playlist) con concurrencia acotada
+# y emite cada resultado en NDJSON según termina. /batch/download encola las descargas poco a
+# poco (respetando el límite por cliente) y va metiendo cada archivo en un ZIP que se transmite
+# mientras se construye: nunca hay en disco más que los artefactos de los trabajos en curso.
+BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS', 50))
+BATCH_ANALYZE_CONCURRENCY = int(os.environ.get('BATCH_ANALYZE_CONCURRENCY', 3))
+BATCH_DOWNLOAD_CONCURRENCY = int(os.environ.get('BATCH_DOWNLOAD_CONCURRENCY', DOWNLOAD_MAX_JOBS_PER_CLIENT))
+BATCH_POLL_INTERVAL = float(os.environ.get('BATCH_POLL_INTERVAL', 1.0))
+BATCH_ZIP_BUFFER = int(os.environ.get('BATCH_ZIP_BUFFER', 16))   # trozos en vuelo hacia el cliente
+
+_PLAYLIST_PATH_RE = re.compile(r'/(?:playlist|sets|album)(?:/|$)', re.IGNORECASE)
+
+
+class BatchAnalyzeRequest(BaseModel):
+    urls: List[str]
+    playlist: Optional[bool] = None   # None = detectar por la URL
+
+
+class BatchDownloadItem(BaseModel):
+    url: str
+    format_id: str
+    token: Optional[str] = None
+
+
+class BatchDownloadRequest(BaseModel):
+    items: List[BatchDownloadItem]
+    use_cookies: bool = True
+
+
+class BatchCancelled(Exception):
+    """El cliente cerró la conexión del lote."""
+
+
+def _looks_like_playlist(url: str) -> bool:
+    """Playlist de YouTube sin video concreto, o rutas típicas de listas/álbumes."""
+    parsed = urlparse(url)
+    query = dict(parse_qsl(parsed.query))
+    if 'list' in query and 'v' not in query:
+        return True
+    return bool(_PLAYLIST_PATH_RE.search(parsed.path))
+
+
+def _expand_playlist(url: str) -> Tuple[Optional[str], List[str]]:
+    """Enumera las entradas de una playlist sin extraer cada video (extract_flat).
+
+    Devuelve (título, urls). Si la URL no es una playlist, (None, [url]).
+    """
+    ydl_opts = {
+        'quiet': True,
+        'no_warnings': True,
+        'noplaylist': False,
+        'extract_flat': 'in_playlist',
+        'playlistend': BATCH_MAX_ITEMS,
+        'nocheckcertificate': True,
+        'socket_timeout': 30,
+        'http_headers': DEFAULT_HEADERS,
+        'cookiefile': YOUTUBE_COOKIES_FILE,
+    }
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        info = ydl.extract_info(url, download=False)
+    if not info or info.get('_type') not in ('playlist', 'multi_video'):
+        return None, [url]
+    urls = []
+    for entry in info.get('entries') or []:
+        entry_url = entry and (entry.get('url') or entry.get('webpage_url'))
+        if entry_url:
+            urls.append(entry_url)
+    return info.get('title'), urls[:BATCH_MAX_ITEMS]
+
+
+def _ndjson(obj: dict) -> bytes:
+    return (json.dumps(obj, ensure_ascii=False) + "\n").encode('utf-8')
+
+
+@app.post("/batch/analyze")
+async def batch_analyze(body: BatchAnalyzeRequest):
+    """Analiza varias URLs o una playlist y transmite cada resultado (NDJSON) según termina.
+
+    Líneas: {"type": "batch"} con el número de entradas, un {"type": "item"} por entrada
+    (en orden de finalización, con su índice) y {"type": "done"} al final.
+    """
+    urls = [u.strip() for u in body.urls if u and u.strip()]
+    if not urls:
+        raise HTTPException(status_code=400, detail="Se requiere al menos una URL")
+
+    playlist_title = None
+    if len(urls) == 1 and (body.playlist or (body.playlist is None and _looks_like_playlist(urls[0]))):
+        try:
+            playlist_title, urls = await run_in_threadpool(_expand_playlist, urls[0])
+        except Exception as e:
+            print(f"[WARN] No se pudo enumerar la playlist {urls[0]}: {e}")
+            raise HTTPException(status_code=422, detail=f"No se pudo leer la playlist: {str(e)[:200]}")
+        if not urls:
+            raise HTTPException(status_code=404, detail="La playlist no tiene entradas")
+    if len(urls) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"Máximo {BATCH_MAX_ITEMS} URLs por lote")
+
+    semaphore = asyncio.Semaphore(BATCH_ANALYZE_CONCURRENCY)
+
+    async def analyze_one(index: int, url: str) -> dict:
+        async with semaphore:
+            try:
+                result = await analyze_video(url)
+                return {'type': 'item', 'index': index, 'url': url, 'ok': True, 'result': result}
+            except HTTPException as e:
+                return {'type': 'item', 'index': index, 'url': url, 'ok': False,
+                        'status': e.status_code, 'error': e.detail}
+            except Exception as e:
+                return {'type': 'item', 'index': index, 'url': url, 'ok': False,
+                        'status': 500, 'error': str(e)[:200]}
+
+    async def lines():
+        started = time.monotonic()
+        tasks = [asyncio.ensure_future(analyze_one(i, u)) for i, u in enumerate(urls)]
+        failed = 0
+        try:
+            yield _ndjson({'type': 'batch', 'count': len(urls), 'playlist': playlist_title})
+            for next_done in asyncio.as_completed(tasks):
+                item = await next_done
+                failed += 0 if item['ok'] else 1
+                yield _ndjson(item)
+            yield _ndjson({'type': 'done', 'ok': len(urls) - failed, 'failed': failed,
+                           'seconds': round(time.monotonic() - started, 2)})
+        finally:
+            # Cliente desconectado: no seguir analizando para nadie
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(lines(), media_type='application/x-ndjson', headers={'Cache-Control': 'no-cache'})
+
+
+class _QueueWriter:
+    """Archivo de sólo escritura (no seekable) que entrega lo escrito a la respuesta.
+
+    Lo usa un hilo productor; cada trozo cruza a la cola del event loop con
+    call_soon_threadsafe, así la respuesta espera sin ocupar un hilo del threadpool y se
+    cancela al momento si el cliente se va. `slots` acota los trozos en vuelo.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, chunks: asyncio.Queue, slots: threading.Semaphore,
+                 cancelled: threading.Event):
+        self._loop = loop
+        self._chunks = chunks
+        self._slots = slots
+        self._cancelled = cancelled
+
+    def write(self, data) -> int:
+        if data:
+            self.put(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def put(self, item):
+        # Sin huecos libres se frena al productor (backpressure) hasta que el cliente lea o se vaya
+        while not self._slots.acquire(timeout=1):
+            if self._cancelled.is_set():
+                raise BatchCancelled()
+        if self._cancelled.is_set():
+            raise BatchCancelled()
+        try:
+            self._loop.call_soon_threadsafe(self._chunks.put_nowait, item)
+        except RuntimeError:
+            # El event loop ya se cerró (apagado del servidor)
+            self._cancelled.set()
+            raise BatchCancelled()
+
+
+def _release_delivered(file_id: str, data: dict):
+    """Suelta el archivo de un trabajo del lote una vez copiado al ZIP (como una última entrega)."""
+    if data.get('artifact'):
+        artifact_cache.release(data['artifact'], file_id)
+    elif data.get('path'):
+        cleanup_file(Path(data['path']))
+    job_store.delete(file_id)
+
+
+def _build_batch_zip(request: Request, body: BatchDownloadRequest, writer: _QueueWriter,
+                     cancelled: threading.Event):
+    """Encola las descargas del lote y escribe cada archivo terminado en el ZIP (orden de llegada)."""
+    pending = list(enumerate(body.items))
+    running = {}   # {file_id: índice}
+    errors = []
+    width = len(str(len(body.items)))
+    use_cookies = 'true' if body.use_cookies else 'false'
+
+    with zipfile.ZipFile(writer, 'w', compression=zipfile.ZIP_STORED) as zf:
+        while pending or running:
+            if cancelled.is_set():
+                raise BatchCancelled()
+
+            # Encolar poco a poco: el lote no acapara la cola ni el disco
+            while pending and len(running) < BATCH_DOWNLOAD_CONCURRENCY:
+                index, item = pending[0]
+                try:
+                    file_id = submit_download(request, item.url, item.format_id, None, use_cookies, 'file', item.token)
+                except HTTPException as e:
+                    if e.status_code in (429, 503, 507) and running:
+                        break   # esperar a que termine alguno de los nuestros
+                    if e.status_code in (429, 503, 507):
+                        time.sleep(BATCH_POLL_INTERVAL)
+                        break
+                    pending.pop(0)
+                    errors.append(f"{index + 1}. {item.url}: {e.detail}")
+                    continue
+                pending.pop(0)
+                running[file_id] = index
+
+            finished = False
+            for file_id, index in list(running.items()):
+                data = job_store.get(file_id)
+                status = data.get('status') if data else 'error'
+                if status not in ('ready', 'error'):
+                    continue
+                finished = True
+                del running[file_id]
+                item = body.items[index]
+                if status == 'error' or not data.get('path') or not Path(data['path']).exists():
+                    message = (data or {}).get('message') or 'El trabajo expiró'
+                    errors.append(f"{index + 1}. {item.url}: {message}")
+                    continue
+                arcname = f"{index + 1:0{width}d} - {data['filename'] or Path(data['path']).name}"
+                zinfo = zipfile.ZipInfo.from_file(data['path'], arcname)
+                zinfo.compress_type = zipfile.ZIP_STORED
+                try:
+                    with open(data['path'], 'rb') as src, zf.open(zinfo, 'w', force_zip64=True) as dst:
+                        shutil.copyfileobj(src, dst, FILE_CHUNK_SIZE)
+                    SERVED_BYTES.inc(zinfo.file_size, mode='batch')
+                finally:
+                    _release_delivered(file_id, data)
+            if not finished and running:
+                time.sleep(BATCH_POLL_INTERVAL)
+
+        if errors:
+            zf.writestr('errores.txt', "\n".join(errors) + "\n")
+    print(f"[INFO] Lote ZIP terminado: {len(body.items) - len(errors)} archivos, {len(errors)} errores")
+
+
+@app.post("/batch/download")
+async def batch_download(request: Request, body: BatchDownloadRequest):
+    """Descarga varios formatos y los entrega en un único ZIP transmitido según se completa.
+
+    Los archivos van sin comprimir (el video ya lo está) y en orden de finalización;
+    los fallos se listan en errores.txt al final del ZIP.
+    """
+    if not body.items:
+        raise HTTPException(status_code=400, detail="Se requiere al menos un elemento")
+    if len(body.items) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"Máximo {BATCH_MAX_ITEMS} elementos por lote")
+
+    chunks = asyncio.Queue()
+    slots = threading.Semaphore(BATCH_ZIP_BUFFER)
+    cancelled = threading.Event()
+    writer = _QueueWriter(asyncio.get_running_loop(), chunks, slots, cancelled)
+
+    def produce():
+        try:
+            _build_batch_zip(request, body, writer, cancelled)
+        except BatchCancelled:
+            print("[INFO] Lote ZIP cancelado: el cliente cerró la conexión")
+        except Exception as e:
+            print(f"[ERROR] Lote ZIP falló: {e}")
+        finally:
+            try:
+                writer.put(None)
+            except BatchCancelled:
+                pass
+
+    threading.Thread(target=produce, name='batch-zip', daemon=True).start()
+
+    async def body_iter():
+        try:
+            while True:
+                # Si el cliente se desconecta, la espera se cancela aquí y el productor lo ve en su
+                # próximo put (o en el bucle de _build_batch_zip) sin terminar el elemento en curso
+                chunk = await chunks.get()
+                slots.release()
+                if chunk is None:
+                    break
+                yield chunk
+        finally:
+            cancelled.set()
+
+    return StreamingResponse(body_iter(), media_type='application/zip', headers={
+        'Content-Disposition': _content_disposition(f"sygnal-lote-{time.strftime('%Y%m%d-%H%M%S')}.zip"),
+        'Cache-Control': 'no-store',
+    })
+
+# --- FIN LOTES Y PLAYLISTS ---
+
+# Gauges calculados en cada scrape a partir del estado vivo
+Gauge('sygnal_download_jobs_running', 'Trabajos de descarga en curso', lambda: download_scheduler.snapshot()['running'])
+Gauge('sygnal_download_jobs_queued', 'Trabajos de descarga en cola por carril',
+      lambda: {(lane,): n for lane, n in download_scheduler.snapshot()['queued'].items()}, ('lane',))
+Gauge('sygnal_jobs_stored', 'Trabajos en el store (incluye terminados sin expirar)', lambda: job_store.count())
+Gauge('sygnal_threads', 'Hilos vivos en el proceso', threading.active_count)
+Gauge('sygnal_active_streams', 'Transmisiones FFmpeg en curso', lambda: _active_streams)
+Gauge('sygnal_active_stream_transcodes', 'Conversiones a MP3 al vuelo en curso', lambda: _active_transcodes)
+Gauge('sygnal_download_dir_bytes', 'Bytes ocupados en DOWNLOAD_DIR', lambda: disk_janitor.usage())
+Gauge('sygnal_artifact_cache_bytes', 'Bytes en la caché de artefactos', lambda: artifact_cache.bytes)
+Gauge('sygnal_analyze_cache_events', 'Contadores acumulados de la caché de análisis',
+      lambda: {(k,): v for k, v in analyze_cache.snapshot().items() if k in ('hits', 'misses', 'evictions', 'expired')},
+      ('event',))
+
+
+@app.get("/metrics")
+def metrics():
+    """Métricas en formato de texto de Prometheus."""
+    lines = []
+    for metric in metrics_registry:
+        lines.extend(metric.render())
+    return PlainTextResponse("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
+
+
+# --- ARRANQUE EN FRÍO: CALENTAMIENTO Y READINESS ---
+# En HF Spaces/Railway el contenedor escala a cero, así que cada arranque en frío cuenta.
+# El import de main.py no carga yt_dlp ni aiohttp (ver _LazyModule); con WARMUP=true un hilo
+# los carga después de abrir el puerto, instancia un YoutubeDL (registro de extractores y el
+# de YouTube) y prepara el runtime de JS de EJS, para que el primer /analyze no lo pague.
+# /ready informa del estado: 503 mientras calienta, 200 cuando termina (aunque falle algún paso).
+WARMUP = os.environ.get('WARMUP', 'true').lower() == 'true'
+WARMUP_DELAY = float(os.environ.get('WARMUP_DELAY', 1.0))   # deja a uvicorn abrir el puerto antes
+
+
+class WarmupState:
+    """Estado del calentamiento: pasos completados con su duración y el error, si lo hubo."""
+
+    def __init__(self, enabled: bool):
+        self.state = 'pending' if enabled else 'disabled'
+        self.steps = {}       # {paso: segundos}
+        self.errors = {}      # {paso: mensaje}
+        self.started_at = None
+        self.finished_at = None
+        self._lock = threading.Lock()
+
+    def begin(self):
+        with self._lock:
+            self.state = 'warming'
+            self.started_at = time.time()
+
+    def step(self, name: str, fn):
+        started = time.perf_counter()
+        try:
+            detail = fn()
+        except Exception as e:
+            print(f"[WARN] Calentamiento: el paso {name} falló: {e}")
+            with self._lock:
+                self.errors[name] = str(e)[:200]
+            return None
+        with self._lock:
+            self.steps[name] = round(time.perf_counter() - started, 3)
+        return detail
+
+    def finish(self):
+        with self._lock:
+            self.state = 'ready'
+            self.finished_at = time.time()
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                'state': self.state,
+                'ready': self.state in ('ready', 'disabled'),
+                'module_load_seconds': MODULE_LOAD_SECONDS,
+                'steps': dict(self.steps),
+                'errors': dict(self.errors),
+                'warmup_seconds': round(self.finished_at - self.started_at, 3) if self.finished_at else None,
+            }
+
+
+warmup_state = WarmupState(WARMUP)
+
+
+def _warm_js_runtime(ydl) -> Optional[str]:
+    """Lanza el runtime de JS una vez (yt-dlp consulta su versión) y carga los scripts de EJS."""
+    runtime = ydl._js_runtimes.get(YTDLP_JS_RUNTIME)
+    info = runtime.info if runtime else None
+    try:
+        import yt_dlp_ejs.yt.solver
+        yt_dlp_ejs.yt.solver.lib()
+        yt_dlp_ejs.yt.solver.core()
+    except ImportError:
+        print("[WARN] Calentamiento: yt-dlp-ejs no está instalado")
+    return info.version if info else None
+
+
+def _warmup():
+    """Precarga lo que el primer /analyze pagaría: módulos, extractores y runtime de JS."""
+    time.sleep(WARMUP_DELAY)
+    warmup_state.begin()
+    warmup_state.step('import_yt_dlp', lambda: yt_dlp.version.__version__)
+    warmup_state.step('import_aiohttp', lambda: aiohttp.__version__)
+    ydl = warmup_state.step('youtubedl', lambda: yt_dlp.YoutubeDL({
+        'quiet': True, 'no_warnings': True, 'js_runtimes': {YTDLP_JS_RUNTIME: {}},
+    }))
+    if ydl is not None:
+        warmup_state.step('youtube_extractor', lambda: ydl.get_info_extractor('Youtube'))
+        version = warmup_state.step('js_runtime', lambda: _warm_js_runtime(ydl))
+        print(f"[INFO] Calentamiento: runtime de JS {YTDLP_JS_RUNTIME} {version or 'no disponible'}")
+        ydl.close()
+    warmup_state.finish()
+    print(f"[INFO] Calentamiento terminado: {warmup_state.snapshot()['steps']}")
+
+
+@app.get("/ready")
+def readiness():
+    """Readiness para el orquestador: 503 mientras calienta, 200 cuando ya puede servir rápido."""
+    snapshot = warmup_state.snapshot()
+    return JSONResponse(snapshot, status_code=200 if snapshot['ready'] else 503)
+
+# --- FIN ARRANQUE EN FRÍO ---
+
+
+def start_background_services():
+    """Hilos de mantenimiento que viven mientras la app está levantada."""
+    threading.Thread(target=_reap_jobs_forever, name='job-reaper', daemon=True).start()
+    threading.Thread(target=_janitor_forever, name='janitor', daemon=True).start()
+    if WARMUP:
+        threading.Thread(target=_warmup, name='warmup', daemon=True).start()
 
-    # Limpiar tras entregar
-    background_tasks.add_task(cleanup_file, Path(path))
-    # Limpiar entrada del progreso tras un rato
-    def _cleanup_progress():
-        import time; time.sleep(60)
-        download_progress.pop(file_id, None)
-    threading.Thread(target=_cleanup_progress, daemon=True).start()
 
-    return FileResponse(path=path, filename=filename, media_type='application/octet-stream')
+# Lo que tarda el import de main.py (incluye FastAPI); lo reporta /ready y lo mide benchmarks/bench_startup.py
+MODULE_LOAD_SECONDS = round(time.perf_counter() - _MODULE_LOAD_STARTED, 3)
 
 
 if __name__ == "__main__":